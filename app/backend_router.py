@@ -0,0 +1,222 @@
+"""Backend router - per-request failover between the HTTP and Selenium backends"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.cancellation import CancelToken, RequestCancelled
+from app.config import settings
+from app.history import History
+
+logger = logging.getLogger(__name__)
+
+
+class BackendScore:
+    """Recent success rate and latency of one backend (exponentially weighted)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.success_rate = 1.0
+        self.latency: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+        self.chosen = 0
+        self.failovers_to = 0
+        self.last_failure: Optional[float] = None
+
+    def score(self, latency_scale: float) -> float:
+        """Higher is better: success rate discounted by latency (unmeasured counts as slow)"""
+        latency = self.latency if self.latency is not None else latency_scale
+        return self.success_rate / (1.0 + latency / latency_scale)
+
+    def stats(self) -> Dict:
+        return {
+            "name": self.name,
+            "success_rate": round(self.success_rate, 3),
+            "latency_ewma_seconds": round(self.latency, 3) if self.latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "chosen": self.chosen,
+            "failovers_to": self.failovers_to
+        }
+
+
+class BackendRouter:
+    """
+    Ranks backends by recent success rate and latency.
+
+    A backend whose success rate drops below `unhealthy_below` is tried
+    last and probed in the background until it recovers.
+    """
+
+    def __init__(
+        self,
+        backends: List[str],
+        alpha: float = 0.2,
+        latency_scale: float = 30.0,
+        unhealthy_below: float = 0.5
+    ):
+        self.backends = {name: BackendScore(name) for name in backends}
+        self.alpha = alpha
+        self.latency_scale = latency_scale
+        self.unhealthy_below = unhealthy_below
+        self._lock = threading.Lock()
+
+    def healthy(self, name: str) -> bool:
+        return self.backends[name].success_rate >= self.unhealthy_below
+
+    def ranked(self) -> List[str]:
+        """Backends in the order they should be tried (ties keep the configured order)"""
+        return sorted(
+            self.backends,
+            key=lambda name: (not self.healthy(name), -self.backends[name].score(self.latency_scale))
+        )
+
+    def record(self, name: str, ok: bool, latency: Optional[float] = None):
+        with self._lock:
+            backend = self.backends[name]
+            backend.requests += 1
+            backend.success_rate += self.alpha * ((1.0 if ok else 0.0) - backend.success_rate)
+            if ok and latency is not None:
+                backend.latency = latency if backend.latency is None else backend.latency + self.alpha * (latency - backend.latency)
+            if not ok:
+                backend.failures += 1
+                backend.last_failure = time.time()
+
+    def record_choice(self, name: str, failover: bool):
+        with self._lock:
+            self.backends[name].chosen += 1
+            if failover:
+                self.backends[name].failovers_to += 1
+
+    async def run_probes(self, probe: Callable[[str], Awaitable[bool]], interval: float = 30.0):
+        """Probe unhealthy backends until cancelled so they can recover"""
+        while True:
+            await asyncio.sleep(interval)
+            for name in list(self.backends):
+                if self.healthy(name):
+                    continue
+                try:
+                    ok = await probe(name)
+                except Exception as e:
+                    logger.info(f"Probe of {name} backend failed: {e}")
+                    ok = False
+                self.record(name, ok)
+                if ok and self.healthy(name):
+                    logger.info(f"Backend {name} recovered")
+
+    def stats(self) -> Dict:
+        return {
+            "order": self.ranked(),
+            "backends": [self.backends[name].stats() for name in self.backends]
+        }
+
+
+class FailoverClient:
+    """
+    Conversation client that fails each request over between backends.
+
+    Backend clients are created on first use. The conversation's history is
+    kept here and handed to the HTTP client before each request, since that
+    backend sends the full history upstream.
+    """
+
+    def __init__(
+        self,
+        router: BackendRouter,
+        factories: Dict[str, Callable[[Optional[str]], object]],
+        conversation_id: Optional[str] = None
+    ):
+        """
+        Args:
+            router: Shared router that ranks the backends
+            factories: Backend name -> callable creating a client for a conversation ID
+            conversation_id: Conversation this client serves
+        """
+        self.router = router
+        self.factories = factories
+        self.conversation_id = conversation_id
+        self.clients: Dict[str, object] = {}
+        self.messages_history = History()
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    def _client(self, name: str):
+        if name not in self.clients:
+            self.clients[name] = self.factories[name](self.conversation_id)
+        return self.clients[name]
+
+    def send_message(
+        self,
+        user_message: str,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, str]:
+        """
+        Send through the best backend, failing over within the overall timeout
+
+        Once part of a reply has been passed to `on_delta` the request no
+        longer fails over, since the caller already has that part.
+        """
+        self.last_used = time.time()
+        order = [name for name in self.router.ranked() if name in self.factories]
+        deadline = time.time() + (timeout or settings.chat_timeout)
+        last_error: Optional[Exception] = None
+        streamed = False
+
+        def forward(text: str):
+            nonlocal streamed
+            streamed = True
+            on_delta(text)
+
+        for attempt, name in enumerate(order):
+            start_time = time.time()
+            if start_time >= deadline:
+                break
+            try:
+                client = self._client(name)
+                if hasattr(client, "set_history"):
+                    client.set_history(self.messages_history)
+                response = client.send_message(user_message, deadline - start_time, cancel, forward if on_delta else None)
+            except RequestCancelled:
+                raise
+            except Exception as e:
+                self.router.record(name, False)
+                if streamed:
+                    raise
+                logger.warning(f"{name} backend failed{', failing over' if attempt + 1 < len(order) else ''}: {e}")
+                last_error = e
+                continue
+
+            self.router.record(name, True, time.time() - start_time)
+            self.router.record_choice(name, failover=attempt > 0)
+            self.messages_history = self.messages_history.append("user", user_message).append("assistant", response["content"])
+            return response
+
+        raise last_error or Exception("No backend available")
+
+    def get_conversation_history(self) -> History:
+        return self.messages_history
+
+    def set_history(self, history: History):
+        """Replace the history handed to the backends with the next request"""
+        self.messages_history = history
+
+    def fork(self, conversation_id: Optional[str] = None, length: Optional[int] = None) -> "FailoverClient":
+        client = FailoverClient(self.router, self.factories, conversation_id)
+        client.messages_history = self.messages_history if length is None else self.messages_history.truncate(length)
+        return client
+
+    def clear_history(self):
+        self.messages_history = History()
+        for client in self.clients.values():
+            client.clear_history()
+
+    def close(self):
+        for client in self.clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning(f"Error closing client: {e}")
@@ -0,0 +1,68 @@
+"""Cancellation of upstream work when the caller goes away or its deadline passes"""
+import threading
+from contextlib import contextmanager
+from typing import Callable, List
+
+
+class RequestCancelled(Exception):
+    """The caller disconnected or its deadline passed; the upstream work was abandoned"""
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed while it waited for a slot, before any upstream work"""
+
+
+class CancelToken:
+    """
+    Set from the event loop, checked by clients working in threadpool threads.
+
+    Blocking operations register a callback (e.g. closing a streamed
+    response) so they are interrupted at once instead of at the next check.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self.reason = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep up to `seconds`, waking early on cancellation; True if cancelled"""
+        return self._event.wait(seconds)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RequestCancelled(f"Request {self.reason}")
+
+    @contextmanager
+    def on_cancel(self, callback: Callable[[], None]):
+        """Run `callback` if the token is cancelled while inside the block"""
+        with self._lock:
+            already = self._event.is_set()
+            if not already:
+                self._callbacks.append(callback)
+        if already:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
@@ -1 +1,28 @@
-"""Chat clients for interfacing with GovChat"""
+"""Chat clients for interfacing with GovChat
+
+Backends are registered by import path and only imported when first used,
+so HTTP mode never loads Selenium.
+"""
+import importlib
+from typing import Dict
+
+_BACKENDS: Dict[str, str] = {
+    "http": "app.clients.chat_http_client:ChatHTTPClient",
+    "selenium": "app.clients.chat_selenium_client:ChatSeleniumClient",
+    "hybrid": "app.clients.chat_hybrid_client:ChatHybridClient",
+}
+
+
+def register_backend(name: str, target: str):
+    """Register a backend client class as "package.module:ClassName" """
+    _BACKENDS[name] = target
+
+
+def load_backend(name: str):
+    """Import and return the client class registered for a backend"""
+    try:
+        target = _BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown chat backend: {name}")
+    module_name, _, class_name = target.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
@@ -0,0 +1,377 @@
+"""
+Browser host - runs many conversations as tabs in a few Chrome processes
+instead of one whole browser per conversation.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+
+logger = logging.getLogger(__name__)
+
+PROFILES = ("default", "performance")
+
+# Resources the performance profile never downloads
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp3", "*.mp4", "*.webm", "*.ogg", "*.wav", "*.m4a"
+]
+
+
+def create_driver(headless: bool = False, profile: str = "default", user_data_dir: Optional[str] = None) -> webdriver.Chrome:
+    """
+    Launch a Chrome WebDriver
+    
+    Args:
+        headless: Run browser in headless mode
+        profile: "default", or "performance" for a lean, fast-starting browser
+            (new headless mode, eager page loads, no images, fonts or media)
+        user_data_dir: Chrome profile directory to use (cookies, cache)
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown Selenium profile: {profile}")
+    performance = profile == "performance"
+    chrome_options = Options()
+
+    if headless:
+        chrome_options.add_argument("--headless=new" if performance else "--headless")
+
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+
+    if user_data_dir:
+        chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+
+    if performance:
+        # Return from get() at DOMContentLoaded instead of waiting for every subresource
+        chrome_options.page_load_strategy = "eager"
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_argument("--mute-audio")
+        chrome_options.add_argument("--autoplay-policy=user-gesture-required")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--no-first-run")
+        chrome_options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2
+        })
+
+    return webdriver.Chrome(options=chrome_options)
+
+
+def configure_tab(driver: webdriver.Chrome, profile: str = "default"):
+    """
+    Apply a launch profile's per-tab settings to the current window
+
+    CDP commands only reach the target the driver is attached to, so every
+    new tab needs them again (before it loads anything).
+    """
+    if profile == "performance":
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+
+
+class Browser:
+    """One Chrome process; a single WebDriver session drives all of its tabs"""
+
+    def __init__(self, driver: Optional[webdriver.Chrome] = None, user_data_dir: Optional[str] = None):
+        """A browser without a driver is a placeholder whose launch is in progress"""
+        self.driver = None
+        self.user_data_dir = None
+        # WebDriver talks to one window at a time, so every command holds this lock
+        self.lock = threading.RLock()
+        self.tabs = 0
+        self.current_handle: Optional[str] = None
+        self.spare_handle: Optional[str] = None
+        # Set once the launch has finished (driver is None if it failed)
+        self.ready = threading.Event()
+        if driver is not None:
+            self.attach(driver, user_data_dir)
+
+    def attach(self, driver: webdriver.Chrome, user_data_dir: Optional[str] = None):
+        self.driver = driver
+        self.user_data_dir = user_data_dir
+        self.current_handle = driver.current_window_handle
+        self.spare_handle = self.current_handle
+        self.ready.set()
+
+
+class BrowserTab:
+    """A conversation's tab inside a shared browser"""
+
+    def __init__(self, browser: Browser, handle: str):
+        self.browser = browser
+        self.handle = handle
+
+    @property
+    def driver(self) -> webdriver.Chrome:
+        return self.browser.driver
+
+    @contextmanager
+    def active(self):
+        """Lock the browser and make this tab the current window"""
+        with self.browser.lock:
+            if self.browser.current_handle != self.handle:
+                self.browser.driver.switch_to.window(self.handle)
+                self.browser.current_handle = self.handle
+            yield self.browser.driver
+
+
+class BrowserHost:
+    """
+    Multiplexes conversations as tabs over a bounded number of browsers.
+
+    Tabs in one browser share its cookies, so use one host per upstream
+    account.
+    """
+
+    def __init__(
+        self,
+        headless: bool = False,
+        tabs_per_browser: int = 8,
+        max_browsers: int = 4,
+        profile: str = "default",
+        user_data_template: Optional[str] = None
+    ):
+        """
+        Args:
+            headless: Run browsers in headless mode
+            tabs_per_browser: Maximum tabs (conversations) per browser
+            max_browsers: Maximum browsers this host launches
+            profile: Launch profile passed to create_driver and configure_tab
+            user_data_template: Pre-seeded Chrome profile directory; each
+                browser starts from a private copy of it
+        """
+        self.headless = headless
+        self.tabs_per_browser = tabs_per_browser
+        self.max_browsers = max_browsers
+        self.profile = profile
+        self.user_data_template = user_data_template
+        self.browsers: List[Browser] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, headless: bool = False, **overrides) -> "BrowserHost":
+        settings = dict(
+            headless=headless,
+            tabs_per_browser=int(os.getenv("SELENIUM_TABS_PER_BROWSER", "8")),
+            max_browsers=int(os.getenv("SELENIUM_MAX_BROWSERS", "4")),
+            profile=os.getenv("SELENIUM_PROFILE", "default"),
+            user_data_template=os.getenv("SELENIUM_USER_DATA_TEMPLATE") or None
+        )
+        settings.update(overrides)
+        return cls(**settings)
+
+    def _launch(self, browser: Browser):
+        """Start Chrome for a placeholder browser (slow; never called under the host lock)"""
+        user_data_dir = None
+        if self.user_data_template:
+            user_data_dir = tempfile.mkdtemp(prefix="chat-browser-")
+            shutil.copytree(self.user_data_template, user_data_dir, dirs_exist_ok=True)
+        try:
+            driver = create_driver(self.headless, self.profile, user_data_dir)
+        except Exception:
+            if user_data_dir:
+                shutil.rmtree(user_data_dir, ignore_errors=True)
+            raise
+        browser.attach(driver, user_data_dir)
+
+    @staticmethod
+    def _quit(browser: Browser):
+        if browser.driver is None:
+            # Still launching; its launcher quits it when it finds it dropped
+            return
+        try:
+            browser.driver.quit()
+        finally:
+            if browser.user_data_dir:
+                shutil.rmtree(browser.user_data_dir, ignore_errors=True)
+
+    def _reserve_browser(self) -> Browser:
+        """
+        A browser with a tab reserved for the caller
+
+        A new browser is added as a placeholder under the lock and launched
+        outside it, so other callers are not held up by Chrome starting;
+        callers that pick a browser still launching wait for it.
+        """
+        with self._lock:
+            candidates = [b for b in self.browsers if b.tabs < self.tabs_per_browser]
+            if candidates:
+                browser = min(candidates, key=lambda b: b.tabs)
+                launch = False
+            elif len(self.browsers) < self.max_browsers:
+                browser = Browser()
+                self.browsers.append(browser)
+                launch = True
+            else:
+                raise RuntimeError(
+                    f"Browser host is full ({self.max_browsers} browsers x {self.tabs_per_browser} tabs)"
+                )
+            browser.tabs += 1
+
+        if not launch:
+            browser.ready.wait()
+            if browser.driver is None:
+                raise RuntimeError("Browser failed to launch")
+            return browser
+
+        try:
+            self._launch(browser)
+        except Exception:
+            with self._lock:
+                if browser in self.browsers:
+                    self.browsers.remove(browser)
+            browser.ready.set()
+            raise
+        with self._lock:
+            dropped = browser not in self.browsers
+            launched = len(self.browsers)
+        if dropped:
+            # The host was closed while Chrome started
+            self._quit(browser)
+            raise RuntimeError("Browser host closed")
+        logger.info(f"Launched browser {launched}/{self.max_browsers}")
+        return browser
+
+    def open_tab(self, url: str, cookies: Optional[Dict[str, str]] = None) -> BrowserTab:
+        """Open `url` in a new tab (installing `cookies`) and return it"""
+        browser = self._reserve_browser()
+        try:
+            with browser.lock:
+                driver = browser.driver
+                if browser.spare_handle:
+                    handle, browser.spare_handle = browser.spare_handle, None
+                    driver.switch_to.window(handle)
+                else:
+                    driver.switch_to.new_window("tab")
+                    handle = driver.current_window_handle
+                browser.current_handle = handle
+
+                configure_tab(driver, self.profile)
+                driver.get(url)
+                if cookies:
+                    for name, value in cookies.items():
+                        driver.add_cookie({"name": name, "value": value})
+                    driver.refresh()
+        except Exception:
+            self._release(browser)
+            raise
+        return BrowserTab(browser, handle)
+
+    def close_tab(self, tab: BrowserTab):
+        """
+        Close a tab; the browser is shut down with its last tab
+
+        A browser that no longer answers (it crashed or hung) is discarded
+        with all its tabs, so new tabs open in a working one.
+        """
+        browser = tab.browser
+        with self._lock:
+            if browser not in self.browsers:
+                # Already discarded
+                return
+        if browser.tabs > 1:
+            try:
+                with browser.lock:
+                    browser.driver.switch_to.window(tab.handle)
+                    browser.driver.close()
+                    browser.current_handle = None
+            except Exception as e:
+                if not self._responds(browser):
+                    self.discard(browser)
+                    return
+                # Only the tab was gone
+                logger.warning(f"Error closing tab: {e}")
+                browser.current_handle = None
+        self._release(browser)
+
+    def abandon_tab(self, tab: BrowserTab, wait: float = 5.0):
+        """
+        Close the tab of a hung conversation, from another thread
+
+        If the browser can be driven within `wait` seconds, only the tab is
+        closed and the hung call fails at its next command to it; the other
+        tabs keep working. A browser that stays locked or does not answer is
+        discarded with all its tabs.
+        """
+        browser = tab.browser
+        with self._lock:
+            if browser not in self.browsers:
+                return
+        if browser.tabs <= 1:
+            # Nothing else lives in this browser
+            self.discard(browser)
+            return
+        if not browser.lock.acquire(timeout=wait):
+            self.discard(browser)
+            return
+        try:
+            browser.driver.switch_to.window(tab.handle)
+            browser.driver.close()
+            browser.current_handle = None
+        except Exception as e:
+            if not self._responds(browser):
+                browser.lock.release()
+                self.discard(browser)
+                return
+            logger.warning(f"Error closing a hung tab: {e}")
+            browser.current_handle = None
+        browser.lock.release()
+        logger.warning("Closed a tab that stopped responding")
+        self._release(browser)
+
+    @staticmethod
+    def _responds(browser: Browser) -> bool:
+        try:
+            with browser.lock:
+                browser.driver.window_handles
+            return True
+        except Exception:
+            return False
+
+    def discard(self, browser: Browser):
+        """Drop a crashed browser and its tabs"""
+        with self._lock:
+            if browser not in self.browsers:
+                return
+            self.browsers.remove(browser)
+        logger.warning(f"Discarding a browser that stopped responding ({browser.tabs} tabs)")
+        try:
+            self._quit(browser)
+        except Exception:
+            pass
+
+    def _release(self, browser: Browser):
+        with self._lock:
+            browser.tabs -= 1
+            if browser.tabs > 0 or browser not in self.browsers:
+                return
+            self.browsers.remove(browser)
+        with browser.lock:
+            self._quit(browser)
+        logger.info("Browser closed")
+
+    def close(self):
+        """Shut down every browser"""
+        with self._lock:
+            browsers, self.browsers = self.browsers, []
+        for browser in browsers:
+            try:
+                self._quit(browser)
+            except Exception as e:
+                logger.warning(f"Error closing browser: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "browsers": len(self.browsers),
+            "max_browsers": self.max_browsers,
+            "tabs": sum(b.tabs for b in self.browsers),
+            "tabs_per_browser": self.tabs_per_browser
+        }
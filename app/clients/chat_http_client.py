@@ -3,17 +3,27 @@ import requests
 import json
 import time
 import uuid
-import os
-from typing import List, Dict, Optional
-from datetime import datetime
-from dotenv import load_dotenv
+from typing import Callable, List, Dict, Optional
 import logging
 
-load_dotenv()
+from app.cancellation import CancelToken
+from app.clients.stream_parser import StreamParser
+from app.clients.timeouts import GapTimer, adaptive_timeouts, host_key
+from app.clients.transport import ConnectionPool, abort_response, create_session, post_json, set_read_timeout
+from app.output_limits import OutputLimitReached
+from app import tracing
+from app.config import settings
+from app.history import History
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bytes read from the upstream per iteration when streaming a response
+RESPONSE_CHUNK_SIZE = 16 * 1024
+
+
+class UpstreamAuthError(Exception):
+    """The chat website rejected the session's credentials (401/403)"""
+
 
 class ChatHTTPClient:
     """
@@ -21,7 +31,16 @@ class ChatHTTPClient:
     This client reverse-engineers the API calls the website makes.
     """
     
-    def __init__(self, conversation_id: Optional[str] = None, base_url: Optional[str] = None, api_endpoint: Optional[str] = None):
+    def __init__(
+        self,
+        conversation_id: Optional[str] = None,
+        base_url: Optional[str] = None,
+        api_endpoint: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        session: Optional[requests.Session] = None,
+        pool: Optional[ConnectionPool] = None,
+    ):
         """
         Initialize the chat HTTP client
         
@@ -29,78 +48,132 @@ class ChatHTTPClient:
             conversation_id: Optional existing conversation ID to continue
             base_url: Base URL of the chat website (from .env if not provided)
             api_endpoint: Specific API endpoint path (from .env if not provided)
+            headers: Extra headers (e.g. per-account credentials) for every request
+            cookies: Cookies (e.g. per-account session) for every request
+            session: Shared session to use instead of a private one (it is
+                not closed by this client), e.g. a harvested browser session
+            pool: Connections shared with other conversations of the upstream;
+                the client's own session (headers, cookies) runs over them
         """
-        self.base_url = base_url or os.getenv("CHAT_WEBSITE_URL", "https://example-chat.com")
-        self.api_endpoint = api_endpoint or os.getenv("CHAT_API_ENDPOINT", "")
-        self.session = requests.Session()
+        self.base_url = base_url or settings.chat_website_url
+        self.api_endpoint = api_endpoint or settings.chat_api_endpoint
+        self.pool = pool
+        self._owns_session = session is None
+        self.session = session or create_session(pool=pool)
         self.conversation_id = conversation_id or str(uuid.uuid4())
-        self.messages_history: List[Dict[str, str]] = []
+        self.messages_history = History()
+        self.created_at = time.time()
+        self.last_used = self.created_at
         logger.info(f"Initialized HTTP client for: {self.base_url}")
-        self._initialize_session()
+        self._initialize_session(headers, cookies)
     
-    def _initialize_session(self):
+    def _initialize_session(self, headers: Optional[Dict[str, str]] = None, cookies: Optional[Dict[str, str]] = None):
         """Initialize session with proper headers"""
         self.session.headers.update({
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
             "Content-Type": "application/json",
             "Accept": "application/json",
         })
+        if headers:
+            self.session.headers.update(headers)
+        if cookies:
+            self.session.cookies.update(cookies)
+    
+    def set_upstream(
+        self,
+        base_url: str,
+        api_endpoint: str = "",
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        session=None,
+        pool: Optional[ConnectionPool] = None,
+    ):
+        """
+        Point this client at a different upstream.
+        
+        The full history is sent with every request, so a conversation can
+        move between upstreams without losing context.
+        """
+        if self._owns_session:
+            self.session.close()
+        self.pool = pool
+        self._owns_session = session is None
+        self.session = session or create_session(pool=pool)
+        self.base_url = base_url
+        self.api_endpoint = api_endpoint
+        self._initialize_session(headers, cookies)
+        logger.info(f"HTTP client moved to: {self.base_url}")
     
-    def send_message(self, user_message: str, timeout: int = 120) -> Dict[str, str]:
+    def send_message(
+        self,
+        user_message: str,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, str]:
         """
         Send a message to the chat website and get a response
         
         Args:
             user_message: The user's message
-            timeout: Timeout in seconds
+            timeout: Timeout in seconds (CHAT_TIMEOUT if not provided)
+            cancel: Token that aborts the upstream request when the caller goes away
+            on_delta: Called with each piece of the reply as it arrives (SSE and
+                NDJSON responses); other replies arrive as a single piece. It
+                may raise OutputLimitReached to end the reply early.
         
         Returns:
             Dictionary with 'role' and 'content' keys
         """
         try:
+            self.last_used = time.time()
             logger.info(f"Sending message: {user_message[:100]}...")
             
-            # Add message to history
-            self.messages_history.append({
-                "role": "user",
-                "content": user_message
-            })
+            # The history only keeps the message once the reply arrives, so a
+            # cancelled request leaves it unchanged
+            history = self.messages_history.append("user", user_message)
             
             # Prepare the API request payload
-            payload = self._prepare_messages_payload()
+            with tracing.span("http.prepare", messages=len(history)):
+                payload = self._prepare_messages_payload(history)
             
-            # Make the request
-            response = self._make_api_request(payload, timeout)
+            streamed = False
             
-            if response:
-                assistant_message = self._extract_response(response)
-                self.messages_history.append({
-                    "role": "assistant",
-                    "content": assistant_message
-                })
-                
-                logger.info(f"Received response: {assistant_message[:100]}...")
-                return {
-                    "role": "assistant",
-                    "content": assistant_message
-                }
-            else:
-                raise Exception("No response from chat API")
+            def forward(text: str):
+                nonlocal streamed
+                streamed = True
+                on_delta(text)
+            
+            try:
+                # Make the request
+                response = self._make_api_request(payload, timeout or settings.chat_timeout, cancel, forward if on_delta else None)
+                if not response:
+                    raise Exception("No response from chat API")
+                with tracing.span("http.extract"):
+                    assistant_message = self._extract_response(response)
+                if on_delta and not streamed:
+                    on_delta(assistant_message)
+            except OutputLimitReached as limit:
+                # on_delta ended the reply early; the upstream stream is already closed
+                logger.info(f"Stopped reading the reply ({limit.finish_reason})")
+                assistant_message = limit.text
+            
+            self.messages_history = history.append("assistant", assistant_message)
+            
+            logger.info(f"Received response: {assistant_message[:100]}...")
+            return {
+                "role": "assistant",
+                "content": assistant_message
+            }
         
         except Exception as e:
             logger.error(f"Error sending message: {e}")
             raise
     
-    def _prepare_messages_payload(self) -> Dict:
+    def _prepare_messages_payload(self, history: Optional[History] = None) -> Dict:
         """Prepare request in the format expected by chat API"""
         # Build messages array - only include user/assistant messages, not system
-        messages = [
-            {
-                "role": msg["role"],
-                "content": msg["content"]
-            }
-            for msg in self.messages_history
-        ]
+        messages = (history if history is not None else self.messages_history).to_list()
         
         # Extract system prompt if available
         system_prompt = "You are a helpful AI assistant. Follow the user's instructions carefully. Respond using markdown."
@@ -119,9 +192,20 @@ class ChatHTTPClient:
             "key": ""
         }
     
-    def _make_api_request(self, payload: Dict, timeout: int) -> Optional[Dict]:
+    def _make_api_request(
+        self,
+        payload: Dict,
+        timeout: float,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> Optional[Dict]:
         """
         Make the actual API request to the chat website
+        
+        A cancelled `cancel` token interrupts the streamed read and raises
+        RequestCancelled. `on_delta` gets the text of streamed replies as it
+        is parsed. Connect, first-byte and idle-read timeouts come from the
+        endpoint's recent latencies (see AdaptiveTimeouts), within `timeout`.
         """
         # If specific endpoint is configured, use it
         if self.api_endpoint:
@@ -136,27 +220,55 @@ class ChatHTTPClient:
                 f"{self.base_url}/v1/chat/completions",
             ]
         
+        body = json.dumps(payload).encode("utf-8")
+        auth_rejected = False
+        deadline = time.monotonic() + timeout
         for endpoint in endpoints_to_try:
+            if cancel:
+                cancel.raise_if_cancelled()
+            limits = adaptive_timeouts.for_request(host_key(endpoint), endpoint, max(0.001, deadline - time.monotonic()))
+            sent_at = time.monotonic()
             try:
                 logger.info(f"Trying endpoint: {endpoint}")
-                response = self.session.post(
-                    endpoint,
-                    json=payload,
-                    timeout=timeout
-                )
-                
-                logger.info(f"Response status: {response.status_code}")
-                logger.debug(f"Response text: {response.text[:500]}")
-                
-                if response.status_code == 200:
-                    logger.info(f"Success with endpoint: {endpoint}")
-                    # Try to parse as JSON
+                # Time to response headers (the upstream's think time for non-streaming APIs)
+                with tracing.span("http.wait", endpoint=endpoint, request_bytes=len(body)) as wait_span:
                     try:
-                        return response.json()
-                    except ValueError:
-                        # Response is not JSON, return raw text
-                        logger.warning("Response is not JSON, returning as text")
-                        return {"message": response.text}
+                        response = post_json(self.session, self.base_url, endpoint, body, (limits.connect, limits.first_byte))
+                    except requests.exceptions.ConnectTimeout:
+                        adaptive_timeouts.record_timeout(host_key(endpoint), "connect", time.monotonic() - sent_at)
+                        raise
+                    except requests.exceptions.Timeout:
+                        adaptive_timeouts.record_timeout(endpoint, "first_byte", time.monotonic() - sent_at)
+                        raise
+                    adaptive_timeouts.record(endpoint, "first_byte", time.monotonic() - sent_at)
+                    wait_span.set(status=response.status_code)
+                
+                try:
+                    logger.info(f"Response status: {response.status_code}")
+                    
+                    if response.status_code == 200:
+                        # Parse the body as it arrives instead of holding bytes, text and JSON copies
+                        parser = StreamParser(response.headers.get("Content-Type", ""), settings.chat_max_response_bytes)
+                        # From here the read timeout bounds each pause in the body
+                        set_read_timeout(response, limits.idle)
+                        gaps = GapTimer()
+                        with tracing.span("http.read") as read_span:
+                            try:
+                                self._read_response(response, parser, cancel, on_delta, gaps)
+                            except requests.exceptions.RequestException:
+                                if gaps.longest < limits.idle * 0.95:
+                                    raise
+                                adaptive_timeouts.record_timeout(endpoint, "idle", gaps.longest)
+                                raise requests.exceptions.Timeout(f"No data for {limits.idle:.1f}s")
+                            adaptive_timeouts.record(endpoint, "idle", gaps.longest)
+                            read_span.set(response_bytes=parser.received, format=parser.kind)
+                        logger.info(f"Success with endpoint: {endpoint} ({parser.received} bytes, {parser.kind})")
+                        return parser.result()
+                    
+                    if response.status_code in (401, 403):
+                        auth_rejected = True
+                finally:
+                    response.close()
                 
             except requests.exceptions.Timeout:
                 logger.warning(f"Timeout on {endpoint}")
@@ -165,8 +277,51 @@ class ChatHTTPClient:
                 logger.warning(f"Request failed on {endpoint}: {e}")
                 continue
         
+        if auth_rejected:
+            raise UpstreamAuthError(f"Chat API rejected the session credentials at {self.base_url}")
         return None
     
+    def _read_response(
+        self,
+        response,
+        parser: StreamParser,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        gaps: Optional[GapTimer] = None
+    ):
+        """Feed a streamed response body to `parser`, stopping at once if cancelled"""
+        chunks = response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE)
+        if gaps is not None:
+            chunks = gaps.chunks(chunks)
+        if cancel is None:
+            for chunk in chunks:
+                text = parser.feed(chunk)
+                if text and on_delta:
+                    on_delta(text)
+            self._flush(parser, on_delta)
+            return
+        
+        try:
+            with cancel.on_cancel(lambda: abort_response(response)):
+                for chunk in chunks:
+                    text = parser.feed(chunk)
+                    cancel.raise_if_cancelled()
+                    if text and on_delta:
+                        on_delta(text)
+        except Exception:
+            # Closing the response mid-read surfaces as a connection error
+            cancel.raise_if_cancelled()
+            raise
+        cancel.raise_if_cancelled()
+        self._flush(parser, on_delta)
+    
+    @staticmethod
+    def _flush(parser: StreamParser, on_delta: Optional[Callable[[str], None]]):
+        """Forward the text of a last line or event that the body ended without terminating"""
+        text = parser.flush()
+        if text and on_delta:
+            on_delta(text)
+    
     def _extract_response(self, response_data: Dict) -> str:
         """
         Extract the response text from chat website's response format
@@ -200,15 +355,46 @@ class ChatHTTPClient:
         # Fallback to string representation
         return str(response_data)
     
-    def get_conversation_history(self) -> List[Dict[str, str]]:
-        """Get the full conversation history"""
-        return self.messages_history.copy()
+    def get_conversation_history(self) -> History:
+        """Get the full conversation history (an immutable snapshot)"""
+        return self.messages_history
+    
+    def set_history(self, history: History):
+        """Replace the history sent with the next request"""
+        self.messages_history = history
+    
+    def fork(self, conversation_id: Optional[str] = None, length: Optional[int] = None) -> "ChatHTTPClient":
+        """
+        Create a new client that continues from this conversation
+        
+        Args:
+            conversation_id: ID for the new conversation
+            length: Keep only the first `length` messages (default: all)
+        
+        The history is shared structurally, so forking does not copy it.
+        """
+        client = self._new_client(conversation_id)
+        client.messages_history = self.messages_history if length is None else self.messages_history.truncate(length)
+        return client
+    
+    def _new_client(self, conversation_id: Optional[str]) -> "ChatHTTPClient":
+        """Empty client for the same upstream and credentials"""
+        return ChatHTTPClient(
+            conversation_id=conversation_id,
+            base_url=self.base_url,
+            api_endpoint=self.api_endpoint,
+            headers=dict(self.session.headers),
+            cookies=self.session.cookies.get_dict(),
+            session=None if self._owns_session else self.session,
+            pool=self.pool
+        )
     
     def clear_history(self):
         """Clear the conversation history"""
-        self.messages_history = []
+        self.messages_history = History()
         self.conversation_id = str(uuid.uuid4())
     
     def close(self):
         """Close the session"""
-        self.session.close()
+        if self._owns_session:
+            self.session.close()
@@ -0,0 +1,222 @@
+"""
+Hybrid client for chat websites: a browser logs in and passes challenges,
+then conversations talk to the API over plain HTTP with the browser's session.
+"""
+import os
+import threading
+import time
+import logging
+from typing import Callable, Dict, List, Optional
+
+from app.cancellation import CancelToken
+from app.clients.chat_http_client import ChatHTTPClient, UpstreamAuthError
+from app.clients.chat_selenium_client import ChatSeleniumClient
+from app.clients.transport import create_session
+from app.config import env_bool, settings
+
+logger = logging.getLogger(__name__)
+
+# Collects what the page knows that the HTTP API may require
+_HARVEST_SCRIPT = """
+const meta = document.querySelector(
+    "meta[name='csrf-token'], meta[name='csrf_token'], meta[name='_csrf'], meta[name='xsrf-token']"
+);
+let token = null;
+if (arguments[0]) {
+    try { token = window.localStorage.getItem(arguments[0]); } catch (e) { token = null; }
+}
+return {
+    userAgent: navigator.userAgent,
+    language: navigator.language,
+    csrf: meta ? meta.getAttribute('content') : null,
+    token: token
+};
+"""
+
+# Cookies that carry a CSRF token to be echoed back in a header
+CSRF_COOKIE_NAMES = ("XSRF-TOKEN", "csrftoken", "csrf_token", "_csrf")
+
+
+class HarvestFailed(Exception):
+    """The browser could not harvest a session (or did not recently, and is backing off)"""
+
+
+class SessionHarvester:
+    """
+    Owns one browser per upstream and the HTTP session harvested from it.
+
+    The browser is only used to log in / pass bot checks and to refresh the
+    session; every hybrid conversation shares `session`.
+
+    After a failed harvest, further attempts fail at once with HarvestFailed
+    for `backoff` seconds, doubling with each consecutive failure up to
+    `max_backoff`, so a broken login does not launch Chrome for every request.
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        headless: Optional[bool] = None,
+        token_storage_key: Optional[str] = None,
+        csrf_header: Optional[str] = None,
+        backoff: Optional[float] = None,
+        max_backoff: Optional[float] = None
+    ):
+        """
+        Args:
+            base_url: Base URL of the chat website (from .env if not provided)
+            cookies: Cookies to install in the browser before harvesting
+            headless: Run the browser headless (HYBRID_HEADLESS, default true)
+            token_storage_key: localStorage key holding a bearer token, if the
+                site keeps one there (HYBRID_TOKEN_STORAGE_KEY)
+            csrf_header: Header to send the CSRF token in (HYBRID_CSRF_HEADER)
+            backoff: Seconds to wait after a failed harvest (HYBRID_RETRY_BACKOFF)
+            max_backoff: Longest wait after repeated failures (HYBRID_RETRY_BACKOFF_MAX)
+        """
+        self.base_url = base_url or settings.chat_website_url
+        self.cookies = cookies or {}
+        self.headless = headless if headless is not None else env_bool("HYBRID_HEADLESS", default=True)
+        self.token_storage_key = token_storage_key or os.getenv("HYBRID_TOKEN_STORAGE_KEY") or None
+        self.csrf_header = csrf_header or os.getenv("HYBRID_CSRF_HEADER", "X-CSRF-Token")
+        self.backoff = backoff if backoff is not None else float(os.getenv("HYBRID_RETRY_BACKOFF", "5"))
+        self.max_backoff = max_backoff if max_backoff is not None else float(os.getenv("HYBRID_RETRY_BACKOFF_MAX", "300"))
+        self.session = create_session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        })
+        self.version = 0
+        self.refreshed_at: Optional[float] = None
+        self.failures = 0
+        self._retry_at = 0.0
+        self._browser: Optional[ChatSeleniumClient] = None
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        """Harvest a session if none has been harvested yet"""
+        if self.version == 0:
+            self.refresh(0)
+
+    def refresh(self, seen_version: int):
+        """
+        Re-harvest the session through the browser. Blocks; call it off the event loop.
+
+        Args:
+            seen_version: Session version the caller found rejected; if another
+                request has already refreshed past it, nothing is done
+
+        Raises:
+            HarvestFailed: The harvest failed, now or within the backoff window
+        """
+        with self._lock:
+            if self.version > seen_version:
+                return
+            wait = self._retry_at - time.monotonic()
+            if wait > 0:
+                raise HarvestFailed(f"Session harvest for {self.base_url} failed recently; retrying in {wait:.1f}s")
+            try:
+                self._harvest()
+            except Exception as e:
+                self.failures += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+                self._retry_at = time.monotonic() + delay
+                logger.error(f"❌ Session harvest failed ({self.failures} in a row), next attempt in {delay:.1f}s: {str(e)}")
+                # Start from a fresh browser next time
+                self._close_browser()
+                raise HarvestFailed(f"Session harvest for {self.base_url} failed: {str(e)}") from e
+            self.failures = 0
+            self._retry_at = 0.0
+
+    def _harvest(self):
+        if self._browser is None:
+            logger.info(f"Opening browser to harvest a session for: {self.base_url}")
+            self._browser = ChatSeleniumClient(headless=self.headless, base_url=self.base_url, cookies=self.cookies)
+        else:
+            logger.info(f"Refreshing session through the browser for: {self.base_url}")
+            with self._browser.tab.active() as driver:
+                driver.refresh()
+            self._browser._wait_until_ready()
+
+        with self._browser.tab.active() as driver:
+            page_state = driver.execute_script(_HARVEST_SCRIPT, self.token_storage_key)
+            browser_cookies = driver.get_cookies()
+        self._apply(page_state, browser_cookies)
+        self.version += 1
+        self.refreshed_at = time.time()
+
+    def _apply(self, page_state: Dict, browser_cookies: List[Dict]):
+        self.session.cookies.clear()
+        csrf = page_state.get("csrf")
+        for cookie in browser_cookies:
+            self.session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie.get("domain"),
+                path=cookie.get("path", "/")
+            )
+            if not csrf and cookie["name"] in CSRF_COOKIE_NAMES:
+                csrf = cookie["value"]
+
+        self.session.headers["User-Agent"] = page_state["userAgent"]
+        if page_state.get("language"):
+            self.session.headers["Accept-Language"] = page_state["language"]
+        if csrf:
+            self.session.headers[self.csrf_header] = csrf
+        if page_state.get("token"):
+            self.session.headers["Authorization"] = f"Bearer {page_state['token']}"
+        logger.info(f"Harvested {len(browser_cookies)} cookies{' and a CSRF token' if csrf else ''}")
+
+    def _close_browser(self):
+        if self._browser:
+            try:
+                self._browser.close()
+            except Exception as e:
+                logger.warning(f"Error closing the harvesting browser: {str(e)}")
+            self._browser = None
+
+    def close(self):
+        self._close_browser()
+        self.session.close()
+
+
+class ChatHybridClient(ChatHTTPClient):
+    """
+    HTTP client that borrows its session from a SessionHarvester.
+
+    Requests go straight to the chat API; when it answers 401/403 the
+    session is refreshed through the browser once and the request retried.
+    The first session is harvested by the first request, on its worker
+    thread, so creating a client never blocks the event loop.
+    """
+
+    def __init__(self, harvester: SessionHarvester, conversation_id: Optional[str] = None, api_endpoint: Optional[str] = None):
+        self.harvester = harvester
+        super().__init__(
+            conversation_id=conversation_id,
+            base_url=harvester.base_url,
+            api_endpoint=api_endpoint,
+            session=harvester.session
+        )
+
+    def _initialize_session(self, headers: Optional[Dict[str, str]] = None, cookies: Optional[Dict[str, str]] = None):
+        """Headers and cookies come from the harvested session"""
+
+    def _make_api_request(
+        self,
+        payload: Dict,
+        timeout: float,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> Optional[Dict]:
+        self.harvester.ensure()
+        version = self.harvester.version
+        try:
+            return super()._make_api_request(payload, timeout, cancel, on_delta)
+        except UpstreamAuthError:
+            logger.info("Session rejected by chat API, refreshing through the browser")
+            self.harvester.refresh(version)
+            return super()._make_api_request(payload, timeout, cancel, on_delta)
+
+    def _new_client(self, conversation_id: Optional[str]) -> "ChatHybridClient":
+        return ChatHybridClient(self.harvester, conversation_id, self.api_endpoint)
@@ -5,20 +5,86 @@ Use this if HTTP reverse-engineering doesn't work.
 import time
 import uuid
 import os
-from typing import List, Dict, Optional
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
-from dotenv import load_dotenv
+from typing import Callable, List, Dict, Optional
 import logging
+import threading
+from urllib.parse import urlparse
 
-load_dotenv()
+from app.cancellation import CancelToken
+from app.clients.browser_host import BrowserHost
+from app import tracing
+from app.config import settings
+from app.history import History
+from app.output_limits import OutputLimitReached
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+INPUT_SELECTORS = [
+    "textarea[placeholder*='message' i]",
+    "input[type='text'][placeholder*='message' i]",
+    "textarea",
+    "input[type='text']",
+    "[contenteditable='true']"
+]
+
+SEND_SELECTORS = [
+    "button[type='submit']",
+    "button[aria-label*='send' i]",
+    "button[class*='send' i]",
+    "button svg[class*='send' i]"
+]
+
+MESSAGE_SELECTORS = [
+    ".message.assistant",
+    "[class*='assistant']",
+    "[class*='bot']",
+    "[class*='response']",
+    "div[role='article']"
+]
+
+LOADING_INDICATORS = ["loading", "thinking", "typing", "...", "please wait"]
+
+# Selectors that worked, per site: {site: {"input" | "send" | "message": selector}}
+_selector_cache: Dict[str, Dict[str, str]] = {}
+_selector_cache_lock = threading.Lock()
+
+# Returns the first matching input and the first visible send button
+_FIND_INPUT_SCRIPT = """
+function first(selectors, visibleOnly) {
+    for (const selector of selectors) {
+        let el = null;
+        try { el = document.querySelector(selector); } catch (e) { continue; }
+        if (el && (!visibleOnly || el.offsetParent !== null)) {
+            if (el.tagName.toLowerCase() === 'svg') { el = el.closest('button') || el; }
+            return [selector, el];
+        }
+    }
+    return [null, null];
+}
+const input = first(arguments[0], false);
+const send = first(arguments[1], true);
+return {inputSelector: input[0], input: input[1], sendSelector: send[0], send: send[1]};
+"""
+
+# Returns {selector: {count, text, loading}} for every message selector
+_MESSAGE_STATE_SCRIPT = """
+const indicators = arguments[1];
+const state = {};
+for (const selector of arguments[0]) {
+    let nodes;
+    try { nodes = document.querySelectorAll(selector); } catch (e) { continue; }
+    const latest = nodes.length ? nodes[nodes.length - 1] : null;
+    const text = latest ? (latest.innerText || '').trim() : '';
+    const lower = text.toLowerCase();
+    state[selector] = {
+        count: nodes.length,
+        text: text,
+        loading: indicators.some(function (i) { return lower.indexOf(i) !== -1; })
+    };
+}
+return state;
+"""
+
 
 class ChatSeleniumClient:
     """
@@ -26,70 +92,109 @@ class ChatSeleniumClient:
     More reliable but slower than HTTP requests.
     """
     
-    def __init__(self, headless: bool = False, base_url: Optional[str] = None):
+    def __init__(
+        self,
+        headless: bool = False,
+        base_url: Optional[str] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        host: Optional[BrowserHost] = None
+    ):
         """
         Initialize Selenium WebDriver
         
         Args:
             headless: Run browser in headless mode
             base_url: Base URL of the chat website (from .env if not provided)
+            cookies: Session cookies (e.g. per-account login) to install before chatting
+            host: Shared browser host to open this conversation as a tab in
+                (a private browser is launched if not provided)
         """
-        self.base_url = base_url or os.getenv("CHAT_WEBSITE_URL", "https://example-chat.com")
-        self.headless = headless or os.getenv("SELENIUM_HEADLESS", "false").lower() == "true"
+        self.base_url = base_url or settings.chat_website_url
+        self.headless = headless or settings.selenium_headless
+        self.cookies = cookies or {}
+        self._owns_host = host is None
+        self.host = host or BrowserHost.from_env(headless=self.headless, tabs_per_browser=1, max_browsers=1)
+        self.tab = None
         self.driver = None
-        self.messages_history: List[Dict[str, str]] = []
+        self.messages_history = History()
+        self.created_at = time.time()
+        self.last_used = self.created_at
         logger.info(f"Initialized Selenium client for: {self.base_url}")
         self._setup_driver()
     
     def _setup_driver(self):
-        """Setup Chrome WebDriver"""
-        chrome_options = Options()
-        
-        if self.headless:
-            chrome_options.add_argument("--headless")
-        
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-        
-        self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.get(self.base_url)
+        """Open the chat page in a tab of the browser host"""
+        self.tab = self.host.open_tab(self.base_url, self.cookies)
+        self.driver = self.tab.driver
         
-        # Wait for page to load
-        time.sleep(3)
+        # Wait until the chat input is usable rather than for a fixed time
+        self._wait_until_ready()
         logger.info("Driver initialized and page loaded")
     
-    def send_message(self, user_message: str, timeout: int = 120) -> Dict[str, str]:
+    def _wait_until_ready(self, timeout: Optional[float] = None):
+        """Wait for the chat input to appear (one script call per check)"""
+        timeout = timeout if timeout is not None else settings.selenium_ready_timeout
+        deadline = time.time() + timeout
+        while True:
+            with self.tab.active() as driver:
+                found = driver.execute_script(
+                    _FIND_INPUT_SCRIPT,
+                    self._candidates("input", INPUT_SELECTORS),
+                    []
+                )
+            if found["input"]:
+                self._learn("input", found["inputSelector"])
+                return
+            if time.time() >= deadline:
+                logger.warning(f"Chat input not found within {timeout:.0f}s, continuing anyway")
+                return
+            time.sleep(0.1)
+    
+    def send_message(
+        self,
+        user_message: str,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, str]:
         """
         Send a message via browser and wait for response
         
         Args:
             user_message: The user's message
-            timeout: Maximum time to wait for response in seconds
+            timeout: Maximum time to wait for response in seconds (CHAT_TIMEOUT if not provided)
+            cancel: Token that stops waiting for the reply when the caller goes away
+            on_delta: Called with the text the reply grows by between polls; it
+                may raise OutputLimitReached to end the reply early
         
         Returns:
             Dictionary with 'role' and 'content' keys
         """
         try:
+            self.last_used = time.time()
             logger.info(f"Sending message via Selenium: {user_message[:100]}...")
             
+            # Count existing messages so only a new reply is picked up
+            with tracing.span("selenium.baseline"):
+                baseline = {selector: info["count"] for selector, info in self._message_state().items()}
+            
             # Find and interact with chat input
-            self._send_input_message(user_message)
+            if cancel:
+                cancel.raise_if_cancelled()
+            with tracing.span("selenium.input"):
+                self._send_input_message(user_message)
             
             # Wait for response
-            response_text = self._wait_for_response(timeout)
+            with tracing.span("selenium.poll") as poll_span:
+                try:
+                    response_text = self._wait_for_response(timeout or settings.chat_timeout, baseline, cancel, poll_span, on_delta)
+                except OutputLimitReached as limit:
+                    # on_delta ended the reply early: stop watching the page
+                    logger.info(f"Stopped waiting for the reply ({limit.finish_reason})")
+                    response_text = limit.text
             
             # Store in history
-            self.messages_history.append({
-                "role": "user",
-                "content": user_message
-            })
-            
-            self.messages_history.append({
-                "role": "assistant",
-                "content": response_text
-            })
+            self.messages_history = self.messages_history.append("user", user_message).append("assistant", response_text)
             
             logger.info(f"Received response: {response_text[:100]}...")
             
@@ -102,127 +207,190 @@ class ChatSeleniumClient:
             logger.error(f"Error sending message: {e}")
             raise
     
-    def _send_input_message(self, message: str):
+    def _site_selectors(self) -> Dict[str, str]:
+        """Selectors learned for this site (shared by all clients of the site)"""
+        site = urlparse(self.base_url).netloc or self.base_url
+        with _selector_cache_lock:
+            return _selector_cache.setdefault(site, {})
+    
+    def _candidates(self, kind: str, defaults: List[str]) -> List[str]:
+        """Selector list with the learned one (if any) tried first"""
+        learned = self._site_selectors().get(kind)
+        if not learned:
+            return defaults
+        return [learned] + [selector for selector in defaults if selector != learned]
+    
+    def _learn(self, kind: str, selector: Optional[str]):
+        if selector:
+            selectors = self._site_selectors()
+            if selectors.get(kind) != selector:
+                logger.info(f"Learned {kind} selector: {selector}")
+                selectors[kind] = selector
+    
+    def _message_state(self) -> Dict:
+        """Count, latest text and loading flag for every candidate message selector, in one round trip"""
+        with self.tab.active() as driver:
+            return driver.execute_script(
+                _MESSAGE_STATE_SCRIPT,
+                self._candidates("message", MESSAGE_SELECTORS),
+                LOADING_INDICATORS
+            )
+    
+    def _send_input_message(self, message: str, timeout: float = 10):
         """
         Find the chat input field and send the message
         These selectors may need adjustment based on actual website structure
         """
         try:
-            # Try different input field selectors
-            input_selectors = [
-                "textarea[placeholder*='message' i]",
-                "input[type='text'][placeholder*='message' i]",
-                "textarea",
-                "input[type='text']",
-                "[contenteditable='true']"
-            ]
-            
-            input_element = None
-            for selector in input_selectors:
-                try:
-                    input_element = WebDriverWait(self.driver, 5).until(
-                        EC.presence_of_element_located((By.CSS_SELECTOR, selector))
+            # One script call checks every input and send-button selector at once
+            deadline = time.time() + timeout
+            while True:
+                with self.tab.active() as driver:
+                    found = driver.execute_script(
+                        _FIND_INPUT_SCRIPT,
+                        self._candidates("input", INPUT_SELECTORS),
+                        self._candidates("send", SEND_SELECTORS)
                     )
-                    logger.info(f"Found input with selector: {selector}")
-                    break
-                except:
-                    continue
-            
-            if not input_element:
-                raise Exception("Could not find input element")
-            
-            # Clear and send message
-            input_element.clear()
-            input_element.send_keys(message)
-            
-            # Find and click send button
-            send_selectors = [
-                "button[type='submit']",
-                "button:has-text('Send')",
-                "button[aria-label*='send' i]",
-                "button[class*='send' i]",
-                "button svg[class*='send' i]"
-            ]
-            
-            send_button = None
-            for selector in send_selectors:
-                try:
-                    send_button = self.driver.find_element(By.CSS_SELECTOR, selector)
-                    if send_button.is_displayed():
-                        logger.info(f"Found send button with selector: {selector}")
-                        break
-                except:
-                    continue
-            
-            if send_button:
-                send_button.click()
-            else:
-                # Try Enter key as fallback
-                input_element.send_keys("\n")
-            
-            time.sleep(1)
+                    if found["input"]:
+                        # Elements belong to this tab, so type and send before releasing it
+                        self._submit(found, message)
+                        return
+                if time.time() >= deadline:
+                    raise Exception("Could not find input element")
+                time.sleep(0.2)
             
         except Exception as e:
             logger.error(f"Error sending input: {e}")
             raise
     
-    def _wait_for_response(self, timeout: int) -> str:
-        """Wait for AI response to appear"""
+    def _submit(self, found: Dict, message: str):
+        """Type the message into the found input and send it (tab must be active)"""
+        input_element = found["input"]
+        self._learn("input", found["inputSelector"])
+        
+        # Clear and send message
+        input_element.clear()
+        input_element.send_keys(message)
+        
+        send_button = found["send"]
+        if send_button:
+            self._learn("send", found["sendSelector"])
+            send_button.click()
+        else:
+            # Try Enter key as fallback
+            input_element.send_keys("\n")
+    
+    def _wait_for_response(
+        self,
+        timeout: float,
+        baseline: Optional[Dict[str, int]] = None,
+        cancel: Optional[CancelToken] = None,
+        poll_span=None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """
+        Wait for AI response to appear
+        
+        Args:
+            timeout: Maximum time to wait in seconds
+            baseline: Message counts per selector from before the message was sent
+            cancel: Token that ends the wait early (raises RequestCancelled)
+            poll_span: Tracing span that records the number of DOM polls
+            on_delta: Called with the text the reply grows by while it is written;
+                a reply the page rewrites rather than extends is not re-sent
+        
+        The reply is complete once its text is free of loading indicators
+        and unchanged between two polls. While it is written, text that grew
+        since the previous poll is passed to `on_delta`, loading indicator
+        or not, so a static "Thinking..." placeholder is never sent.
+        """
         start_time = time.time()
-        last_response_count = 0
+        baseline = baseline or {}
+        cancel = cancel or CancelToken()
+        polls = 0
+        emitted = ""
+        previous = None
+        
+        def emit(text: str):
+            nonlocal emitted
+            if on_delta and len(text) > len(emitted) and text.startswith(emitted):
+                on_delta(text[len(emitted):])
+                emitted = text
         
         while time.time() - start_time < timeout:
+            cancel.raise_if_cancelled()
             try:
-                # Look for message elements
-                message_selectors = [
-                    ".message.assistant",
-                    "[class*='assistant']",
-                    "[class*='bot']",
-                    "[class*='response']",
-                    "div[role='article']"
-                ]
-                
-                for selector in message_selectors:
-                    try:
-                        messages = self.driver.find_elements(By.CSS_SELECTOR, selector)
-                        if len(messages) > last_response_count:
-                            # New message appeared
-                            latest = messages[-1]
-                            response_text = latest.text.strip()
-                            
-                            if response_text and not self._is_loading_text(response_text):
-                                return response_text
-                            
-                            last_response_count = len(messages)
-                    except:
-                        continue
+                polls += 1
+                if poll_span:
+                    poll_span.set(polls=polls)
+                state = self._message_state()
+                for selector, info in state.items():
+                    if info["count"] > baseline.get(selector, 0):
+                        # New message appeared
+                        text = info["text"]
+                        if text and text == previous and not info["loading"]:
+                            self._learn("message", selector)
+                            emit(text)
+                            return text
+                        if text and previous and text != previous and text.startswith(previous):
+                            # Still being written
+                            emit(text)
+                        previous = text
+                        break
                 
-                time.sleep(0.5)
+                cancel.wait(0.5)
                 
+            except OutputLimitReached:
+                raise
             except Exception as e:
                 logger.warning(f"Error waiting for response: {e}")
-                time.sleep(0.5)
+                cancel.wait(0.5)
         
         raise TimeoutError(f"No response received within {timeout} seconds")
     
-    def _is_loading_text(self, text: str) -> bool:
-        """Check if text indicates loading state"""
-        loading_indicators = ["loading", "thinking", "typing", "...", "please wait"]
-        return any(indicator in text.lower() for indicator in loading_indicators)
+    def get_conversation_history(self) -> History:
+        """Get the full conversation history (an immutable snapshot)"""
+        return self.messages_history
     
-    def get_conversation_history(self) -> List[Dict[str, str]]:
-        """Get the full conversation history"""
-        return self.messages_history.copy()
+    def fork(self, conversation_id: Optional[str] = None, length: Optional[int] = None):
+        """Browser sessions hold their history in the page and cannot be forked"""
+        raise NotImplementedError("Conversations cannot be forked in Selenium mode")
     
     def clear_history(self):
         """Clear conversation history"""
-        self.messages_history = []
+        self.messages_history = History()
         # Optionally refresh the page
-        self.driver.refresh()
-        time.sleep(2)
+        with self.tab.active() as driver:
+            driver.refresh()
+        self._wait_until_ready()
+    
+    def alive(self) -> bool:
+        """Whether this conversation's tab still exists in a browser that answers"""
+        if self.tab is None:
+            return False
+        try:
+            with self.tab.browser.lock:
+                return self.tab.handle in self.tab.driver.window_handles
+        except Exception:
+            return False
+    
+    def abandon(self):
+        """
+        Give up on a hung conversation from another thread: its tab is
+        closed (or, if the browser does not answer, the browser is quit) so
+        the blocked call fails, while other tabs of a working browser stay open
+        """
+        tab, self.tab = self.tab, None
+        if tab:
+            self.host.abandon_tab(tab)
+        if self._owns_host:
+            self.host.close()
     
     def close(self):
-        """Close the browser driver"""
-        if self.driver:
-            self.driver.quit()
+        """Close this conversation's tab (and the browser, if it is private)"""
+        if self.tab:
+            self.host.close_tab(self.tab)
+            self.tab = None
             logger.info("Driver closed")
+        if self._owns_host:
+            self.host.close()
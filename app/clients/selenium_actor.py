@@ -0,0 +1,221 @@
+"""
+Selenium actor - one conversation's browser tab driven from a dedicated thread
+
+WebDriver calls block for the length of a page wait. Run in the shared
+threadpool, a few slow browsers can hold every worker thread. An actor
+instead owns its client on its own thread, takes commands from a queue and
+hands results back through futures, so the event loop only awaits them.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from app.cancellation import CancelToken
+from app.config import settings
+from app.history import History
+
+logger = logging.getLogger(__name__)
+
+_actor_ids = itertools.count(1)
+
+
+class _Worker:
+    """A worker thread with its own command queue and client (replaced wholesale on restart)"""
+
+    def __init__(self, actor: "SeleniumActor", name: str):
+        self.actor = actor
+        self.commands: queue.Queue = queue.Queue()
+        self.client = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            method, args, future, context = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if self.client is None:
+                    self.client = self.actor.factory()
+                result = context.run(getattr(self.client, method), *args)
+            except BaseException as e:
+                self._recover(e)
+                future.set_exception(e)
+            else:
+                if self.current:
+                    self.actor.messages_history = self.client.get_conversation_history()
+                future.set_result(result)
+        self._close_client()
+
+    @property
+    def current(self) -> bool:
+        """False once the actor has replaced this worker"""
+        return self.actor._worker is self
+
+    def _recover(self, error: BaseException):
+        """After a failed command, drop the client if its browser or tab died"""
+        if self.client is None or not self.current or self.client.alive():
+            return
+        logger.warning(f"{self.thread.name}: browser tab lost ({type(error).__name__}), reopening on the next command")
+        self.actor.crashes += 1
+        # The page held the conversation, so it starts over with the new tab
+        self.actor.messages_history = History()
+        self._close_client()
+
+    def _close_client(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception as e:
+                logger.warning(f"Error closing Selenium client: {e}")
+            self.client = None
+
+
+class SeleniumActor:
+    """
+    Conversation client that runs a ChatSeleniumClient on a dedicated thread.
+
+    `send_message` is a coroutine. Commands run one at a time in submission
+    order; the browser tab is opened by the first one. A command that fails
+    because the tab or browser died drops the client, and the next command
+    opens a fresh tab. A command still running `stall_grace` seconds after
+    its timeout (and cancellation) means the tab is hung: the worker thread
+    is abandoned with its tab, and a new one takes over.
+    """
+
+    def __init__(self, factory: Callable[[], object], stall_grace: Optional[float] = None):
+        """
+        Args:
+            factory: Creates the ChatSeleniumClient (called on the actor's thread)
+            stall_grace: Seconds past a command's timeout before the browser is
+                considered hung (SELENIUM_STALL_GRACE, default 15)
+        """
+        self.factory = factory
+        self.stall_grace = stall_grace if stall_grace is not None else float(os.getenv("SELENIUM_STALL_GRACE", "15"))
+        self.name = f"selenium-actor-{next(_actor_ids)}"
+        self.messages_history = History()
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.crashes = 0
+        self.restarts = 0
+        self._worker = _Worker(self, self.name)
+
+    def _submit(self, method: str, *args) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        # Run in the caller's context so tracing spans reach the actor's thread
+        self._worker.commands.put((method, args, future, contextvars.copy_context()))
+        return future
+
+    def _restart(self, reason: str):
+        stuck = self._worker
+        logger.warning(f"{self.name}: {reason}, restarting on a new thread")
+        self.restarts += 1
+        self.messages_history = History()
+        self._worker = _Worker(self, f"{self.name}.{self.restarts}")
+        # Queued commands move to the new worker; the stuck one exits when its call returns
+        while True:
+            try:
+                command = stuck.commands.get_nowait()
+            except queue.Empty:
+                break
+            if command is not None:
+                self._worker.commands.put(command)
+        stuck.commands.put(None)
+        client = stuck.client
+        if client is not None:
+            # Closing the tab makes the blocked WebDriver call fail; that can
+            # wait on the browser, so it happens off the event loop
+            threading.Thread(target=self._abandon, args=(client,), name=f"{stuck.thread.name}.abandon", daemon=True).start()
+
+    @staticmethod
+    def _abandon(client):
+        try:
+            client.abandon()
+        except Exception as e:
+            logger.warning(f"Error abandoning a hung Selenium client: {e}")
+
+    async def send_message(
+        self,
+        user_message: str,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, str]:
+        """Send a message via the actor's browser tab (see ChatSeleniumClient.send_message)"""
+        self.last_used = time.time()
+        timeout = timeout or settings.chat_timeout
+        cancel = cancel or CancelToken()
+        future = self._submit("send_message", user_message, timeout, cancel, on_delta)
+        waiter = asyncio.wrap_future(future)
+        # If abandoned, its outcome arrives after the caller has moved on
+        waiter.add_done_callback(lambda done: done.cancelled() or done.exception())
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=timeout)
+        except asyncio.CancelledError:
+            await self._stop(future, waiter, cancel, "cancelled", timeout)
+            raise
+        if not done:
+            await self._stop(future, waiter, cancel, f"timed out after {timeout:g}s", timeout)
+            raise TimeoutError(f"No response received within {timeout:g} seconds")
+        return waiter.result()
+
+    async def _stop(self, future: concurrent.futures.Future, waiter: asyncio.Future, cancel: CancelToken, reason: str, timeout: float):
+        """
+        Stop a command and wait until it has, or until the worker is restarted
+
+        Not started yet: it never will be; running: the client stops at its
+        next check. One still running `stall_grace` seconds later means the
+        tab is hung. The check runs to the end even if the caller is
+        cancelled meanwhile (the cancellation is raised afterwards), so a
+        hung tab is always abandoned and callers keep their slots until then.
+        """
+        future.cancel()
+        cancel.cancel(reason)
+        check = asyncio.ensure_future(asyncio.wait({waiter}, timeout=self.stall_grace))
+        interrupted = False
+        while not check.done():
+            try:
+                await asyncio.shield(check)
+            except asyncio.CancelledError:
+                interrupted = True
+        done, _ = check.result()
+        if not done:
+            self._restart(f"no response {self.stall_grace:g}s past a {timeout:g}s command that was {reason}")
+        if interrupted:
+            raise asyncio.CancelledError()
+
+    def call(self, method: str, *args, timeout: Optional[float] = None):
+        """Run a client method on the actor's thread and wait for it (blocking)"""
+        return self._submit(method, *args).result(timeout)
+
+    def get_conversation_history(self) -> History:
+        return self.messages_history
+
+    def fork(self, conversation_id: Optional[str] = None, length: Optional[int] = None):
+        """Browser sessions hold their history in the page and cannot be forked"""
+        raise NotImplementedError("Conversations cannot be forked in Selenium mode")
+
+    def clear_history(self):
+        self.call("clear_history")
+
+    def close(self):
+        """Stop the actor; its thread closes the tab once queued commands are done"""
+        self._worker.commands.put(None)
+
+    def stats(self) -> Dict:
+        return {
+            "name": self.name,
+            "queued": self._worker.commands.qsize(),
+            "crashes": self.crashes,
+            "restarts": self.restarts
+        }
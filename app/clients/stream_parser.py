@@ -0,0 +1,166 @@
+"""Incremental parsing of upstream response bodies (JSON, SSE and NDJSON)"""
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseTooLarge(Exception):
+    """The upstream response exceeded the configured maximum size"""
+
+
+def delta_text(event: Any) -> str:
+    """Text carried by one streamed event, in any of the common formats"""
+    if isinstance(event, str):
+        return event
+    if not isinstance(event, dict):
+        return ""
+    if event.get("choices"):
+        choice = event["choices"][0]
+        for key in ("delta", "message"):
+            part = choice.get(key)
+            if isinstance(part, dict) and isinstance(part.get("content"), str):
+                return part["content"]
+        if isinstance(choice.get("text"), str):
+            return choice["text"]
+        return ""
+    message = event.get("message")
+    if isinstance(message, dict) and isinstance(message.get("content"), str):
+        return message["content"]
+    for key in ("content", "text", "response", "delta", "message"):
+        if isinstance(event.get(key), str):
+            return event[key]
+    return ""
+
+
+class StreamParser:
+    """
+    Consumes a response body chunk by chunk.
+
+    SSE bodies are parsed event by event (per the SSE spec, so whitespace in
+    the data is kept) and NDJSON bodies line by line, and only the assembled
+    text is kept; other bodies are buffered once as bytes and decoded as JSON
+    at the end, falling back to text. Feeding more than `max_bytes` raises
+    ResponseTooLarge.
+    """
+
+    def __init__(self, content_type: str = "", max_bytes: Optional[int] = None):
+        content_type = content_type.split(";")[0].strip().lower()
+        if content_type == "text/event-stream":
+            self.kind = "sse"
+        elif content_type in ("application/x-ndjson", "application/jsonl", "application/ndjson"):
+            self.kind = "ndjson"
+        else:
+            self.kind = "json"
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.done = False
+        self._buffer = bytearray()
+        self._parts: List[str] = []
+        # Data lines of the SSE event being read
+        self._event_data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> str:
+        """
+        Parse the next chunk of the body
+
+        Returns:
+            Text that became available with this chunk (streaming formats only)
+        """
+        self.received += len(chunk)
+        if self.max_bytes and self.received > self.max_bytes:
+            raise ResponseTooLarge(f"Response exceeded {self.max_bytes} bytes")
+
+        self._buffer += chunk
+        if self.kind == "json":
+            return ""
+        return self._parse_lines()
+
+    def _parse_lines(self) -> str:
+        # Only complete lines are parsed; a partial last line stays buffered
+        end = self._buffer.rfind(b"\n")
+        if end < 0:
+            return ""
+        lines = bytes(self._buffer[:end]).split(b"\n")
+        del self._buffer[:end + 1]
+
+        new_parts = []
+        for line in lines:
+            # Only the line ending is removed; whitespace inside the text is part of it
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            text = self._parse_sse_line(line) if self.kind == "sse" else self._parse_data(line)
+            if text:
+                new_parts.append(text)
+        self._parts.extend(new_parts)
+        return "".join(new_parts)
+
+    def _parse_sse_line(self, line: bytes) -> str:
+        # Per the SSE spec, data lines accumulate until a blank line ends the event,
+        # and a single space after the colon is not part of the value
+        if not line:
+            return self._dispatch_event()
+        if line == b"data" or line.startswith(b"data:"):
+            value = line[5:]
+            if value.startswith(b" "):
+                value = value[1:]
+            self._event_data.append(value)
+        return ""
+
+    def _dispatch_event(self) -> str:
+        if not self._event_data:
+            return ""
+        data = b"\n".join(self._event_data)
+        self._event_data = []
+        if data.strip() == b"[DONE]":
+            self.done = True
+            return ""
+        return self._parse_data(data)
+
+    def _parse_data(self, data: bytes) -> str:
+        if not data.strip():
+            return ""
+        try:
+            return delta_text(json.loads(data))
+        except ValueError:
+            # Plain-text data is a text delta itself
+            return data.decode("utf-8", errors="replace")
+
+    @property
+    def text(self) -> str:
+        """Text assembled so far (streaming formats only)"""
+        return "".join(self._parts)
+
+    def flush(self) -> str:
+        """
+        Parse what is left once the body has ended
+
+        Returns:
+            Text of a last NDJSON line without a newline, or of a last SSE
+            event without the blank line after it (streaming formats only)
+        """
+        if self.kind == "json":
+            return ""
+        text = ""
+        if self._buffer:
+            self._buffer += b"\n"
+            text = self._parse_lines()
+        if self.kind == "sse":
+            # A body may end without the blank line after its last event
+            last = self._dispatch_event()
+            self._parts.append(last)
+            text += last
+        return text
+
+    def result(self) -> Dict:
+        """The parsed body, in the shape _extract_response understands"""
+        if self.kind != "json":
+            self.flush()
+            return {"content": self.text}
+
+        try:
+            return json.loads(self._buffer)
+        except ValueError:
+            logger.warning("Response is not JSON, returning as text")
+        return {"message": self._buffer.decode("utf-8", errors="replace")}
@@ -0,0 +1,185 @@
+"""
+Adaptive upstream timeouts - connect, first-byte and idle-read limits per endpoint
+
+A single fixed timeout has to be long enough for the slowest legitimate
+reply, so a dead connection holds its slot for just as long. Each phase
+instead gets a limit derived from recent latencies of the same endpoint:
+`factor` × the `quantile` of a rolling window of samples, clamped to a
+floor and a ceiling (and to the request's remaining budget).
+"""
+import collections
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def host_key(url: str) -> str:
+    """host:port of a URL, the key of its connect samples"""
+    parts = urlsplit(url)
+    return f"{parts.hostname}:{parts.port or (443 if parts.scheme == 'https' else 80)}"
+
+
+class LatencySketch:
+    """The last `window` latency samples of one endpoint and phase"""
+
+    def __init__(self, window: int = 200):
+        self.samples: Deque[float] = collections.deque(maxlen=window)
+        self.total = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.total += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass(frozen=True)
+class Phase:
+    """Floor and ceiling of one phase's timeout, in seconds"""
+    name: str
+    floor: float
+    ceiling: float
+
+
+@dataclass(frozen=True)
+class Timeouts:
+    connect: float
+    first_byte: float
+    idle: float
+
+
+class GapTimer:
+    """Longest pause while reading a streamed body, including the wait for its first chunk"""
+
+    def __init__(self):
+        self.longest = 0.0
+        self._last = time.monotonic()
+
+    def chunks(self, iterator: Iterable[bytes]) -> Iterator[bytes]:
+        try:
+            for chunk in iterator:
+                now = time.monotonic()
+                self.longest = max(self.longest, now - self._last)
+                self._last = now
+                yield chunk
+        except Exception:
+            # A read that timed out (or was aborted) waited at least this long
+            self.longest = max(self.longest, time.monotonic() - self._last)
+            raise
+
+
+class AdaptiveTimeouts:
+    """
+    Per-endpoint timeouts from rolling latency quantiles.
+
+    - connect: TCP connect time to the endpoint's host (sampled by keep-warm
+      and by connects that time out)
+    - first_byte: request sent to response headers
+    - idle: longest pause between chunks of one response body
+
+    Until an endpoint has `min_samples` samples of a phase, that phase uses
+    its ceiling. A request that times out is recorded at the limit it hit,
+    so an upstream that slows down pushes its own limits up instead of
+    timing out forever.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.99,
+        factor: float = 3.0,
+        window: int = 200,
+        min_samples: int = 20,
+        connect: Phase = Phase("connect", 1.0, 10.0),
+        first_byte: Phase = Phase("first_byte", 5.0, 120.0),
+        idle: Phase = Phase("idle", 5.0, 60.0)
+    ):
+        self.quantile = quantile
+        self.factor = factor
+        self.window = window
+        self.min_samples = min_samples
+        self.phases = {phase.name: phase for phase in (connect, first_byte, idle)}
+        self.timeouts_hit: Dict[str, int] = collections.Counter()
+        self._sketches: Dict[tuple, LatencySketch] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "AdaptiveTimeouts":
+        """Build from TIMEOUT_QUANTILE, TIMEOUT_FACTOR, TIMEOUT_WINDOW, TIMEOUT_MIN_SAMPLES and the {CONNECT,FIRST_BYTE,IDLE}_TIMEOUT_{MIN,MAX} bounds"""
+        def phase(name: str, floor: str, ceiling: str) -> Phase:
+            prefix = f"{name.upper()}_TIMEOUT"
+            return Phase(name, float(os.getenv(f"{prefix}_MIN", floor)), float(os.getenv(f"{prefix}_MAX", ceiling)))
+
+        return cls(
+            quantile=float(os.getenv("TIMEOUT_QUANTILE", "0.99")),
+            factor=float(os.getenv("TIMEOUT_FACTOR", "3")),
+            window=int(os.getenv("TIMEOUT_WINDOW", "200")),
+            min_samples=int(os.getenv("TIMEOUT_MIN_SAMPLES", "20")),
+            connect=phase("connect", "1", "10"),
+            first_byte=phase("first_byte", "5", str(settings.chat_timeout)),
+            idle=phase("idle", "5", "60")
+        )
+
+    def record(self, endpoint: str, phase: str, seconds: float):
+        with self._lock:
+            sketch = self._sketches.get((endpoint, phase))
+            if sketch is None:
+                sketch = self._sketches[(endpoint, phase)] = LatencySketch(self.window)
+            sketch.add(seconds)
+
+    def record_timeout(self, endpoint: str, phase: str, limit: float):
+        logger.warning(f"{phase} timeout ({limit:.1f}s) on {endpoint}")
+        self.timeouts_hit[phase] += 1
+        self.record(endpoint, phase, limit)
+
+    def limit(self, endpoint: str, phase: str) -> float:
+        bounds = self.phases[phase]
+        sketch = self._sketches.get((endpoint, phase))
+        if sketch is None or len(sketch.samples) < self.min_samples:
+            return bounds.ceiling
+        with self._lock:
+            observed = sketch.quantile(self.quantile)
+        return min(bounds.ceiling, max(bounds.floor, observed * self.factor))
+
+    def for_request(self, host: str, endpoint: str, budget: float) -> Timeouts:
+        """Timeouts for one request to `endpoint` on `host`, none longer than `budget`"""
+        return Timeouts(
+            connect=min(budget, self.limit(host, "connect")),
+            first_byte=min(budget, self.limit(endpoint, "first_byte")),
+            idle=min(budget, self.limit(endpoint, "idle"))
+        )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            keys = sorted(self._sketches)
+            observed = {key: self._sketches[key].quantile(self.quantile) for key in keys}
+            totals = {key: self._sketches[key].total for key in keys}
+        endpoints: Dict[str, Dict] = {}
+        for endpoint, phase in keys:
+            endpoints.setdefault(endpoint, {})[phase] = {
+                "samples": totals[(endpoint, phase)],
+                f"p{self.quantile * 100:g}_seconds": round(observed[(endpoint, phase)], 3),
+                "timeout_seconds": round(self.limit(endpoint, phase), 3)
+            }
+        return {
+            "quantile": self.quantile,
+            "factor": self.factor,
+            "bounds": {name: {"min": phase.floor, "max": phase.ceiling} for name, phase in self.phases.items()},
+            "timeouts_hit": dict(self.timeouts_hit),
+            "endpoints": endpoints
+        }
+
+
+# Shared by every client, so all conversations of an endpoint feed one sketch
+adaptive_timeouts = AdaptiveTimeouts.from_env()
@@ -0,0 +1,263 @@
+"""
+Upstream HTTP transports: requests (HTTP/1.1) or httpx with h2 (HTTP/2).
+
+Both are used through the same small subset of the requests.Session API
+(headers, cookies, post/get/head with stream=True, iter_content, close),
+so clients do not care which one they hold.
+"""
+import gzip
+import logging
+import socket
+from typing import Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Upstreams (base URLs) that rejected gzip-compressed request bodies
+_gzip_rejected = set()
+
+
+class HTTP2Response:
+    """A streamed httpx response behind the requests.Response attributes clients use"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.http_version = response.http_version
+
+    def iter_content(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        import httpx
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    @property
+    def content(self) -> bytes:
+        return b"".join(self.iter_content())
+
+    def close(self):
+        self._response.close()
+
+
+class HTTP2Session:
+    """
+    requests-style session over an httpx client with HTTP/2 enabled.
+
+    Concurrent requests to the same upstream are multiplexed as streams over
+    a few connections instead of one socket each, so the conversations of an
+    upstream should share one ConnectionPool. Cookies live in a requests
+    cookie jar shared with httpx.
+    """
+
+    def __init__(self, prior_knowledge: bool = False, max_connections: int = 10, transport=None):
+        """
+        Args:
+            prior_knowledge: Speak HTTP/2 to plain http:// URLs without
+                negotiation (h2c); https:// URLs negotiate it through ALPN
+            max_connections: Connections kept per session
+            transport: Shared httpx transport (a ConnectionPool's) to use
+                instead of a private one; it is not closed with the session
+        """
+        import httpx
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self._shared_transport = transport is not None
+        self._client = httpx.Client(
+            http1=not prior_knowledge,
+            http2=True,
+            cookies=self.cookies,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport
+        )
+        self.headers = self._client.headers
+
+    def request(self, method: str, url: str, data=None, json=None, headers=None, timeout=None, stream: bool = False):
+        import httpx
+        if isinstance(timeout, tuple):
+            # requests-style (connect, read)
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            request = self._client.build_request(method, url, content=data, json=json, headers=headers, timeout=timeout)
+            response = HTTP2Response(self._client.send(request, stream=True))
+        except httpx.ConnectTimeout as e:
+            # Kept apart so adaptive timeouts record it as a connect sample, as with HTTP/1.1
+            raise requests.exceptions.ConnectTimeout(e)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e)
+        if not stream:
+            response._response.read()
+        return response
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        # Closing the client would close the transport's connections too
+        if not self._shared_transport:
+            self._client.close()
+
+
+class PooledSession(requests.Session):
+    """requests.Session whose connections belong to a ConnectionPool; closing it leaves them open"""
+
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    """
+    Connections to one upstream, shared by the sessions of its conversations.
+
+    Each session from session() keeps its own headers and cookie jar and only
+    borrows the pool's HTTPAdapter (or HTTP/2 transport), so conversations
+    reuse warm connections without seeing each other's cookies.
+    """
+
+    def __init__(self, http2: Optional[bool] = None, size: Optional[int] = None):
+        """
+        Args:
+            http2: Pool HTTP/2 connections (CHAT_HTTP2 if not provided; needs h2)
+            size: Idle HTTP/1.1 connections kept (requests keeps 10)
+        """
+        self.adapter: Optional[HTTPAdapter] = None
+        self.transport = None
+        if settings.chat_http2 if http2 is None else http2:
+            try:
+                import httpx
+                max_connections = settings.chat_http2_max_connections
+                self.transport = httpx.HTTPTransport(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+                )
+            except ImportError:
+                logger.warning("HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+        if self.transport is None:
+            self.adapter = HTTPAdapter(pool_maxsize=size) if size else HTTPAdapter()
+
+    def session(self):
+        """New session (own headers and cookies) over this pool's connections"""
+        return create_session(pool=self)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.adapter.close()
+
+
+def create_session(http2: Optional[bool] = None, pool_size: Optional[int] = None, pool: Optional[ConnectionPool] = None):
+    """
+    New upstream session: HTTP/2 when enabled (CHAT_HTTP2) and h2 is installed,
+    otherwise a requests.Session. Either way gzip/brotli responses are accepted.
+
+    Args:
+        pool_size: Idle HTTP/1.1 connections kept per host (requests keeps 10),
+            for sessions used by many threads at once
+        pool: Shared connections to use; the session only adds its own
+            headers and cookies
+    """
+    if pool is not None:
+        if pool.transport is not None:
+            session = HTTP2Session(transport=pool.transport)
+        else:
+            session = PooledSession()
+            session.mount("http://", pool.adapter)
+            session.mount("https://", pool.adapter)
+        session.headers["Accept-Encoding"] = DEFAULT_ACCEPT_ENCODING
+        return session
+    if settings.chat_http2 if http2 is None else http2:
+        try:
+            session = HTTP2Session(max_connections=settings.chat_http2_max_connections)
+        except ImportError:
+            logger.warning("HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+        else:
+            session.headers["Accept-Encoding"] = DEFAULT_ACCEPT_ENCODING
+            return session
+    session = requests.Session()
+    if pool_size:
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = DEFAULT_ACCEPT_ENCODING
+    return session
+
+
+def _response_socket(response) -> Optional[socket.socket]:
+    # requests -> urllib3 -> http.client -> buffered socket reader
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    return getattr(getattr(fp, "raw", None), "_sock", None)
+
+
+def set_read_timeout(response, seconds: float):
+    """
+    Limit each further read of a streamed response body to `seconds`.
+
+    The request's read timeout also covered the wait for the headers; from
+    here on it bounds the pauses between chunks.
+    """
+    if isinstance(response, HTTP2Response):
+        # httpcore looks the read timeout up again for every read
+        timeouts = response._response.request.extensions.get("timeout")
+        if timeouts is not None:
+            timeouts["read"] = seconds
+        return
+    sock = _response_socket(response)
+    if sock is not None:
+        sock.settimeout(seconds)
+
+
+def abort_response(response):
+    """
+    Interrupt a streamed response that another thread is reading.
+
+    The socket is shut down rather than the response closed, since closing
+    waits for the reader to let go of the stream. HTTP/2 streams share their
+    connection, so readers of those stop at the next chunk instead.
+    """
+    if isinstance(response, HTTP2Response):
+        return
+    sock = _response_socket(response)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def post_json(session, base_url: str, url: str, body: bytes, timeout):
+    """
+    POST a JSON body as a streamed request.
+
+    Bodies of CHAT_COMPRESS_MIN_BYTES or more (when set) are gzip-compressed; if the
+    upstream answers 400/415 to a compressed body and accepts the plain one,
+    it is not sent compressed bodies again.
+    """
+    min_bytes = settings.chat_compress_min_bytes
+    if min_bytes and len(body) >= min_bytes and base_url not in _gzip_rejected:
+        response = session.post(url, data=gzip.compress(body, 6), headers={"Content-Encoding": "gzip"}, timeout=timeout, stream=True)
+        if response.status_code not in (400, 415):
+            return response
+        response.close()
+        response = session.post(url, data=body, timeout=timeout, stream=True)
+        if response.status_code not in (400, 415):
+            logger.info(f"{base_url} does not accept gzip request bodies, sending them uncompressed")
+            _gzip_rejected.add(base_url)
+        return response
+    return session.post(url, data=body, timeout=timeout, stream=True)
@@ -0,0 +1,57 @@
+"""Configuration - loads .env and sets up logging once per process"""
+import logging
+import os
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+BACKENDS = ("http", "selenium", "hybrid", "auto")
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    """Read a true/false environment variable"""
+    return os.getenv(name, "true" if default else "false").lower() == "true"
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Core settings shared by the server and the clients"""
+    chat_website_url: str
+    chat_api_endpoint: str
+    chat_backend: str
+    chat_timeout: float
+    selenium_headless: bool
+    selenium_ready_timeout: float
+    chat_max_response_bytes: int
+    chat_http2: bool
+    chat_http2_max_connections: int
+    chat_compress_min_bytes: int
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        # USE_SELENIUM is kept as the default for CHAT_BACKEND
+        backend = os.getenv("CHAT_BACKEND") or ("selenium" if env_bool("USE_SELENIUM") else "http")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown CHAT_BACKEND: {backend}")
+        return cls(
+            chat_website_url=os.getenv("CHAT_WEBSITE_URL", "https://example-chat.com"),
+            chat_api_endpoint=os.getenv("CHAT_API_ENDPOINT", ""),
+            chat_backend=backend,
+            chat_timeout=float(os.getenv("CHAT_TIMEOUT", "120")),
+            selenium_headless=env_bool("SELENIUM_HEADLESS"),
+            selenium_ready_timeout=float(os.getenv("SELENIUM_READY_TIMEOUT", "15")),
+            chat_max_response_bytes=int(os.getenv("CHAT_MAX_RESPONSE_BYTES", str(8 * 1024 * 1024))),
+            chat_http2=env_bool("CHAT_HTTP2"),
+            chat_http2_max_connections=int(os.getenv("CHAT_HTTP2_MAX_CONNECTIONS", "4")),
+            chat_compress_min_bytes=int(os.getenv("CHAT_COMPRESS_MIN_BYTES", "0"))
+        )
+
+
+settings = Settings.from_env()
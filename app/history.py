@@ -0,0 +1,211 @@
+"""Persistent, structurally shared conversation history"""
+import hashlib
+import sys
+import weakref
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Texts shorter than this are cheaper to store twice than to deduplicate
+SHARED_TEXT_MIN_LENGTH = 64
+# Only every DIGEST_INTERVAL-th message stores the rolling hash of its prefix
+DIGEST_INTERVAL = 8
+
+
+class SharedText:
+    """A message text shared by every message with identical content"""
+    __slots__ = ("value", "__weakref__")
+
+    def __init__(self, value: str):
+        self.value = value
+
+
+class ContentPool:
+    """
+    Deduplicates message texts across conversations by content.
+
+    Entries are weak, so a text is dropped as soon as no stored message
+    uses it any more.
+    """
+
+    def __init__(self, min_length: int = SHARED_TEXT_MIN_LENGTH):
+        self.min_length = min_length
+        self._texts: "weakref.WeakValueDictionary[str, SharedText]" = weakref.WeakValueDictionary()
+
+    def share(self, content: str) -> Union[str, SharedText]:
+        if len(content) < self.min_length:
+            return content
+        shared = self._texts.get(content)
+        if shared is None:
+            shared = SharedText(content)
+            self._texts[content] = shared
+        return shared
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+
+content_pool = ContentPool()
+
+
+def message_digest(parent_digest: int, role: str, content: str) -> int:
+    """Rolling 64-bit hash of a message and everything before it"""
+    digest = hashlib.blake2b(parent_digest.to_bytes(8, "little"), digest_size=8)
+    digest.update(role.encode())
+    digest.update(b"\0")
+    digest.update(content.encode("utf-8", "surrogatepass"))
+    return int.from_bytes(digest.digest(), "little")
+
+
+class MessageNode:
+    """One message, linked to the history that precedes it"""
+    __slots__ = ("role", "_content", "parent", "jump", "length", "digest")
+
+    def __init__(self, role: str, content: str, parent: Optional["MessageNode"]):
+        self.role = sys.intern(role)
+        self._content = content_pool.share(content)
+        self.parent = parent
+        self.length = parent.length + 1 if parent else 1
+        # Skip pointer to an earlier message (Myers' jump pointers), so any
+        # ancestor is found in O(log n) steps instead of walking every parent
+        jump = parent.jump if parent else None
+        if jump is not None and jump.jump is not None and parent.length - jump.length == jump.length - jump.jump.length:
+            self.jump = jump.jump
+        else:
+            self.jump = parent
+        # Identifies this message together with its whole prefix; kept on
+        # checkpoints only (None elsewhere), hashing the messages since the last one
+        self.digest = None
+        if self.length % DIGEST_INTERVAL == 0:
+            since = [self]
+            node = parent
+            while node is not None and node.digest is None:
+                since.append(node)
+                node = node.parent
+            digest = node.digest if node is not None else 0
+            for message in reversed(since):
+                digest = message_digest(digest, message.role, message.content)
+            self.digest = digest
+
+    @property
+    def content(self) -> str:
+        content = self._content
+        return content if content.__class__ is str else content.value
+
+
+def _same(node: MessageNode, message: Tuple[str, str]) -> bool:
+    role, content = message
+    return node.role == role and node.content == content
+
+
+class History:
+    """
+    Immutable message history backed by a persistent linked list.
+
+    Appending returns a new History that shares every earlier message with
+    the old one, so snapshots and forks are O(1) and a common prefix is
+    stored only once no matter how many conversations branch from it.
+    """
+    __slots__ = ("_tail",)
+
+    def __init__(self, tail: Optional[MessageNode] = None):
+        self._tail = tail
+
+    def append(self, role: str, content: str) -> "History":
+        return History(MessageNode(role, content, self._tail))
+
+    def truncate(self, length: int) -> "History":
+        """History holding only the first `length` messages"""
+        return History(self._node_at(length))
+
+    def _node_at(self, length: int) -> Optional[MessageNode]:
+        """The message ending the first `length` messages, in O(log n) steps"""
+        node = self._tail
+        while node is not None and node.length > length:
+            jump = node.jump
+            node = jump if jump is not None and jump.length >= length else node.parent
+        return node
+
+    def __len__(self) -> int:
+        return self._tail.length if self._tail else 0
+
+    def __bool__(self) -> bool:
+        return self._tail is not None
+
+    def iter_reversed(self) -> Iterator[MessageNode]:
+        """Messages from newest to oldest"""
+        node = self._tail
+        while node is not None:
+            yield node
+            node = node.parent
+
+    def __iter__(self) -> Iterator[MessageNode]:
+        """Messages from oldest to newest"""
+        return reversed(list(self.iter_reversed()))
+
+    def slice(self, start: int, stop: int) -> List[MessageNode]:
+        """Messages with index in [start, stop), oldest first, in O(log n + stop - start)"""
+        start, stop = max(start, 0), min(stop, len(self))
+        nodes = []
+        node = self._node_at(stop)
+        while node is not None and node.length > start:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        return nodes
+
+    def common_prefix(self, messages: Sequence[Tuple[str, str]]) -> int:
+        """
+        Length of the longest common prefix with `messages` ((role, content), oldest first)
+        
+        The lists are compared message by message back from the end of the
+        shorter one, where they usually part, so nothing is hashed for a new
+        conversation and only the prefix before that point is. That prefix is
+        confirmed against the stored checkpoint digests (binary search, as a
+        prefix that matches implies every shorter one does), and the few
+        messages after the last matching checkpoint are compared directly.
+        """
+        node = self._node_at(min(len(self), len(messages)))
+        while node is not None and not _same(node, messages[node.length - 1]):
+            node = node.parent
+        if node is None:
+            return 0
+        
+        # Digests of messages[:c] for every checkpoint c up to node
+        digests = [0]
+        digest = 0
+        for index in range(node.length - node.length % DIGEST_INTERVAL):
+            role, content = messages[index]
+            digest = message_digest(digest, role, content)
+            if (index + 1) % DIGEST_INTERVAL == 0:
+                digests.append(digest)
+        
+        low, high = 0, len(digests) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._node_at(middle * DIGEST_INTERVAL).digest == digests[middle]:
+                low = middle
+            else:
+                high = middle - 1
+        
+        # The lists part within the checkpoint interval after `low`, or not at all before node
+        start = low * DIGEST_INTERVAL
+        end = node.length if low == len(digests) - 1 else start + DIGEST_INTERVAL
+        for index, stored in enumerate(self.slice(start, end), start):
+            if not _same(stored, messages[index]):
+                return index
+        return end
+    
+    def reconcile(self, messages: Sequence[Tuple[str, str]]) -> "History":
+        """
+        History matching `messages`: this one if it already does, otherwise
+        rewound to the common prefix and extended with the rest
+        """
+        common = self.common_prefix(messages)
+        if common == len(self) == len(messages):
+            return self
+        history = self.truncate(common)
+        for role, content in messages[common:]:
+            history = history.append(role, content)
+        return history
+
+    def to_list(self) -> List[Dict[str, str]]:
+        return [{"role": node.role, "content": node.content} for node in self]
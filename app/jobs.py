@@ -0,0 +1,181 @@
+"""
+Job queue - completions run in the background and are collected later
+
+A client behind a proxy that cuts long-held connections submits a job,
+gets its id at once and polls (or long-polls) for the result, so no
+connection has to stay open for the length of an upstream reply.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.cancellation import CancelToken
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """`max_queued` jobs are already waiting for a worker"""
+
+
+class JobFailed(Exception):
+    """Raised by a job's work to fail it with an HTTP status and detail"""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+@dataclass
+class Job:
+    """One submitted completion and its outcome"""
+    id: str
+    work: Callable[[CancelToken], Awaitable[Any]]
+    # Key id of the submitter; only it can read the job
+    owner: str = ""
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Any = None
+    error: Optional[Dict] = None
+    cancel: CancelToken = field(default_factory=CancelToken)
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def info(self) -> Dict:
+        return {
+            "id": self.id,
+            "object": "job",
+            "status": self.status,
+            "created": int(self.created_at),
+            "started": int(self.started_at) if self.started_at else None,
+            "finished": int(self.finished_at) if self.finished_at else None,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class JobQueue:
+    """
+    Runs submitted jobs on `workers` concurrent tasks.
+
+    At most `max_queued` jobs wait for a worker; submitting more raises
+    JobQueueFull. Finished jobs are kept for `ttl` seconds, then forgotten. Each
+    job's work gets a CancelToken, set when the queue shuts down.
+    """
+
+    def __init__(self, workers: int = 4, max_queued: int = 100, ttl: float = 3600.0):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.jobs: Dict[str, Job] = {}
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self._queue: Optional[asyncio.Queue] = None
+
+    @classmethod
+    def from_env(cls) -> "JobQueue":
+        """Build from JOBS_WORKERS, JOBS_MAX_QUEUED and JOBS_RESULT_TTL"""
+        return cls(
+            workers=int(os.getenv("JOBS_WORKERS", "4")),
+            max_queued=int(os.getenv("JOBS_MAX_QUEUED", "100")),
+            ttl=float(os.getenv("JOBS_RESULT_TTL", "3600"))
+        )
+
+    async def run(self):
+        """Work through submitted jobs until cancelled"""
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for job in self.jobs.values():
+                if not job.finished:
+                    job.cancel.cancel("server shutting down")
+            for worker in workers:
+                worker.cancel()
+
+    @property
+    def full(self) -> bool:
+        return self._queue is None or self._queue.full()
+
+    def submit(self, work: Callable[[CancelToken], Awaitable[Any]], owner: str = "") -> Job:
+        """Queue `work` (called with the job's CancelToken) and return its job"""
+        self._expire()
+        if self._queue is None:
+            raise JobQueueFull("Job queue is not running")
+        job = Job(id=f"job-{uuid.uuid4().hex[:24]}", work=work, owner=owner)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise JobQueueFull(f"{self.max_queued} jobs are already queued")
+        self.jobs[job.id] = job
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """The job, or None if it is unknown or has expired"""
+        self._expire()
+        return self.jobs.get(job_id)
+
+    async def wait(self, job_id: str, seconds: float) -> Optional[Job]:
+        """The job once it has finished, or as it is after `seconds`"""
+        job = self.get(job_id)
+        if job is not None and seconds > 0 and not job.finished:
+            try:
+                await asyncio.wait_for(job.done.wait(), seconds)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = await job.work(job.cancel)
+                job.status = "succeeded"
+            except JobFailed as e:
+                job.status = "failed"
+                job.error = {"status": e.status, "detail": e.detail}
+            except Exception as e:
+                logger.error(f"❌ Job {job.id} failed: {str(e)}", exc_info=True)
+                job.status = "failed"
+                job.error = {"status": 500, "detail": f"Error processing job: {str(e)}"}
+            finally:
+                job.finished_at = time.time()
+                job.work = None
+                job.done.set()
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [job.id for job in self.jobs.values() if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+            self.expired += 1
+
+    def stats(self) -> Dict:
+        statuses: Dict[str, int] = {}
+        for job in self.jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "max_queued": self.max_queued,
+            "result_ttl_seconds": self.ttl,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "jobs": statuses
+        }
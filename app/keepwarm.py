@@ -0,0 +1,259 @@
+"""
+Keep-warm - upstream connections, DNS and sessions ready before requests need them
+
+After an idle period the first request to an upstream pays for DNS, a TCP
+and TLS handshake (the upstream or a middlebox has closed the pooled
+connections) and possibly a browser round trip to re-harvest an expired
+session. A background task in the app lifespan pays those costs instead.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from starlette.concurrency import run_in_threadpool
+
+from app.clients.timeouts import AdaptiveTimeouts, host_key
+from app.upstreams import Upstream, UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+
+class DNSCache:
+    """
+    Caches getaddrinfo results for the upstream hosts.
+
+    Installed over socket.getaddrinfo, so requests, httpx and Selenium's
+    driver connections all use it. Other hosts resolve as usual. Entries
+    are re-resolved by refresh() before they expire, and a stale entry is
+    served if the resolver fails.
+    """
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self.hosts = set()
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[Tuple, Tuple[float, List]] = {}
+        self._lock = threading.Lock()
+        self._resolve = socket.getaddrinfo
+
+    def install(self):
+        if socket.getaddrinfo != self._getaddrinfo:
+            self._resolve = socket.getaddrinfo
+            socket.getaddrinfo = self._getaddrinfo
+
+    def uninstall(self):
+        if socket.getaddrinfo == self._getaddrinfo:
+            socket.getaddrinfo = self._resolve
+
+    def _getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        if host not in self.hosts:
+            return self._resolve(host, port, family, type, proto, flags)
+        key = (host, port, family, type, proto, flags)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return self._lookup(key, stale=entry)
+
+    def _lookup(self, key: Tuple, stale=None) -> List:
+        try:
+            result = self._resolve(*key)
+        except socket.gaierror:
+            if stale is None:
+                raise
+            logger.warning(f"Resolving {key[0]} failed, using the cached addresses")
+            return stale[1]
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+        return result
+
+    def refresh(self, host: str, port: int):
+        """Resolve `host` now, for every lookup seen so far plus the usual TCP one"""
+        self.hosts.add(host)
+        with self._lock:
+            keys = {key for key in self._entries if key[0] == host}
+        keys.add((host, port, 0, socket.SOCK_STREAM, 0, 0))
+        for key in keys:
+            self._lookup(key, stale=self._entries.get(key))
+
+    def stats(self) -> Dict:
+        return {"hosts": sorted(self.hosts), "entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def _session_expiry(session) -> Optional[float]:
+    """Earliest expiry (epoch seconds) of a session's cookies and bearer token, if any is known"""
+    expiries = [cookie.expires for cookie in session.cookies if cookie.expires]
+    auth = session.headers.get("Authorization", "")
+    if auth.startswith("Bearer ") and auth.count(".") == 2:
+        # JWT: the middle segment is base64url JSON, possibly with an "exp" claim
+        segment = auth[len("Bearer "):].split(".")[1]
+        try:
+            claims = json.loads(base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4)))
+            if isinstance(claims.get("exp"), (int, float)):
+                expiries.append(claims["exp"])
+        except (ValueError, AttributeError):
+            pass
+    return min(expiries) if expiries else None
+
+
+class KeepWarm:
+    """
+    Background upkeep of the upstream connections.
+
+    Off unless `interval` is set. Every `interval` seconds, for each upstream:
+
+    - its host is re-resolved into the DNS cache (when `dns_ttl` > 0)
+    - one TCP connect is timed, as a connect latency sample for `timeouts`
+    - if it served no requests since the last round, `connections` cheap
+      HEAD requests are sent concurrently over its shared connections, which
+      opens that many pooled connections or resets the idle timer of the
+      ones already open (busy upstreams keep their connections warm anyway)
+    - a harvested (hybrid) session whose cookies or token expire within
+      `refresh_ahead` seconds is re-harvested through the browser
+    """
+
+    def __init__(
+        self,
+        pool: UpstreamPool,
+        session_for: Callable[[Upstream], object],
+        harvester_for: Callable[[Upstream], object],
+        interval: float = 0.0,
+        connections: int = 0,
+        probe_path: str = "/",
+        probe_timeout: float = 10.0,
+        refresh_ahead: float = 300.0,
+        dns_ttl: float = 300.0,
+        timeouts: Optional[AdaptiveTimeouts] = None
+    ):
+        """
+        Args:
+            pool: Upstreams to keep warm
+            session_for: A session over the upstream's shared connections, or
+                None if it has none
+            harvester_for: SessionHarvester of an upstream, or None
+            timeouts: Adaptive timeouts fed with connect samples, if any
+        """
+        self.pool = pool
+        self.session_for = session_for
+        self.harvester_for = harvester_for
+        self.interval = interval
+        self.connections = connections
+        self.probe_path = probe_path
+        self.probe_timeout = probe_timeout
+        self.refresh_ahead = refresh_ahead
+        self.dns = DNSCache(dns_ttl) if dns_ttl > 0 else None
+        self.timeouts = timeouts
+        self.rounds = 0
+        self.probes = 0
+        self.probe_failures = 0
+        self.session_refreshes = 0
+        self._seen_requests: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls, pool: UpstreamPool, session_for, harvester_for, timeouts: Optional[AdaptiveTimeouts] = None) -> "KeepWarm":
+        """Build from KEEPWARM_INTERVAL, KEEPWARM_CONNECTIONS, KEEPWARM_PATH, KEEPWARM_REFRESH_AHEAD and KEEPWARM_DNS_TTL"""
+        return cls(
+            pool,
+            session_for,
+            harvester_for,
+            interval=float(os.getenv("KEEPWARM_INTERVAL", "0")),
+            connections=int(os.getenv("KEEPWARM_CONNECTIONS", "0")),
+            probe_path=os.getenv("KEEPWARM_PATH", "/"),
+            refresh_ahead=float(os.getenv("KEEPWARM_REFRESH_AHEAD", "300")),
+            dns_ttl=float(os.getenv("KEEPWARM_DNS_TTL", "300")),
+            timeouts=timeouts
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    async def run(self):
+        """Warm every upstream now and then every `interval` seconds until cancelled"""
+        if self.dns:
+            self.dns.install()
+        try:
+            while True:
+                for upstream in self.pool.upstreams:
+                    try:
+                        await self.warm(upstream)
+                    except Exception as e:
+                        logger.warning(f"Keep-warm of {upstream.name} failed: {e}")
+                self.rounds += 1
+                await asyncio.sleep(self.interval)
+        finally:
+            if self.dns:
+                self.dns.uninstall()
+
+    async def warm(self, upstream: Upstream):
+        parts = urlsplit(upstream.url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        if self.dns and parts.hostname:
+            await run_in_threadpool(self.dns.refresh, parts.hostname, port)
+        if self.timeouts and parts.hostname:
+            await run_in_threadpool(self._time_connect, parts.hostname, port, host_key(upstream.url))
+
+        harvester = self.harvester_for(upstream)
+        if harvester is not None and harvester.version > 0:
+            expiry = _session_expiry(harvester.session)
+            recently = harvester.refreshed_at and time.time() - harvester.refreshed_at < self.refresh_ahead
+            if expiry is not None and expiry - time.time() < self.refresh_ahead and not recently:
+                logger.info(f"Session for {upstream.name} expires in {expiry - time.time():.0f}s, refreshing")
+                await run_in_threadpool(harvester.refresh, harvester.version)
+                self.session_refreshes += 1
+
+        served = upstream.total_requests + upstream.total_failures
+        idle = self._seen_requests.get(upstream.name) == served
+        self._seen_requests[upstream.name] = served
+        session = self.session_for(upstream)
+        if session is None or self.connections <= 0 or (self.rounds and not idle):
+            return
+        url = f"{upstream.url.rstrip('/')}/{self.probe_path.lstrip('/')}"
+        results = await asyncio.gather(
+            *(run_in_threadpool(self._probe, session, url) for _ in range(self.connections))
+        )
+        self.probes += len(results)
+        self.probe_failures += results.count(False)
+
+    def _time_connect(self, host: str, port: int, key: str):
+        """Open and close one TCP connection, recording how long the connect took"""
+        limit = self.timeouts.phases["connect"].ceiling
+        started = time.monotonic()
+        try:
+            socket.create_connection((host, port), timeout=limit).close()
+        except socket.timeout:
+            self.timeouts.record_timeout(key, "connect", time.monotonic() - started)
+        except OSError as e:
+            logger.debug(f"Connect to {host}:{port} failed: {e}")
+        else:
+            self.timeouts.record(key, "connect", time.monotonic() - started)
+
+    def _probe(self, session, url: str) -> bool:
+        """One HEAD request; any HTTP status means the connection is up"""
+        try:
+            session.head(url, timeout=self.probe_timeout).close()
+            return True
+        except Exception as e:
+            logger.debug(f"Keep-warm probe of {url} failed: {e}")
+            return False
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "interval_seconds": self.interval,
+            "connections": self.connections,
+            "rounds": self.rounds,
+            "probes": self.probes,
+            "probe_failures": self.probe_failures,
+            "session_refreshes": self.session_refreshes,
+            "dns": self.dns.stats() if self.dns else None
+        }
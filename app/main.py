@@ -1,38 +1,103 @@
 """Main FastAPI server - OpenAI-compatible interface for chat websites"""
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import hmac
+import inspect
+import itertools
+import json
+import math
 import uuid
 import time
 import logging
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Union
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
+from typing import TYPE_CHECKING
 
+from app import tracing
+from app.cancellation import CancelToken, DeadlineExceeded, RequestCancelled
+from app.config import settings
 from app.models import (
     ChatCompletionRequest,
     ChatCompletionResponse,
     ChatCompletionChoice,
     ChatMessage,
     ChatRole,
+    ChatTurn,
+    Priority,
     UsageInfo,
+    ForkRequest,
+    JobResponse,
     ErrorResponse
 )
-from app.clients.chat_http_client import ChatHTTPClient
-from app.clients.chat_selenium_client import ChatSeleniumClient
+from app.clients import load_backend
+from app.clients.timeouts import adaptive_timeouts
+from app.upstreams import Upstream, UpstreamPool
+from app.backend_router import BackendRouter, FailoverClient
+from app.history import History
+from app.jobs import JobFailed, JobQueue, JobQueueFull
+from app.keepwarm import KeepWarm
+from app.output_limits import OutputLimit
+from app.ratelimit import ANONYMOUS_KEY, FairScheduler, RateLimiter, UsageTracker, key_id
+
+if TYPE_CHECKING:
+    from app.clients.browser_host import BrowserHost
+    from app.clients.chat_hybrid_client import SessionHarvester
+    from app.clients.transport import ConnectionPool
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # Global state
 conversation_clients: Dict[str, object] = {}
-USE_SELENIUM = os.getenv("USE_SELENIUM", "false").lower() == "true"
-CHAT_WEBSITE_URL = os.getenv("CHAT_WEBSITE_URL", "https://example-chat.com")
+# Creation sequence numbers, used as stable cursors for listing conversations
+conversation_seq: Dict[str, int] = {}
+_seq_counter = itertools.count(1)
+# http, selenium, hybrid (browser login, HTTP traffic) or auto (per-request
+# failover between http and selenium); USE_SELENIUM picks the default
+CHAT_BACKEND = settings.chat_backend
+BACKEND_DESCRIPTIONS = {
+    "http": "HTTP (reverse-engineered API)",
+    "selenium": "Selenium (browser automation)",
+    "hybrid": "Hybrid (browser session, HTTP requests)",
+    "auto": "Auto (HTTP and Selenium with failover)"
+}
+AUTO_BACKENDS = ("http", "selenium")
+CHAT_WEBSITE_URL = settings.chat_website_url
+upstream_pool = UpstreamPool.from_env()
+rate_limiter = RateLimiter.from_env()
+scheduler = FairScheduler(upstream_pool.capacity)
+usage_tracker = UsageTracker.from_env()
+# Selenium mode: one browser host per upstream (tabs share the account's cookies)
+browser_hosts: Dict[str, "BrowserHost"] = {}
+# Hybrid mode: one harvested browser session per upstream
+session_harvesters: Dict[str, "SessionHarvester"] = {}
+# HTTP/2 (CHAT_HTTP2) or keep-warm: one connection pool per upstream, shared by
+# its conversations (each keeps its own session, so cookies are not shared)
+upstream_pools: Dict[str, "ConnectionPool"] = {}
+# Auto mode: scores backends and orders per-request failover
+backend_router = BackendRouter(list(AUTO_BACKENDS))
+# Keeps upstream connections, DNS and harvested sessions warm (KEEPWARM_*)
+keep_warm = KeepWarm.from_env(
+    upstream_pool,
+    session_for=lambda upstream: _warm_session(upstream),
+    harvester_for=lambda upstream: session_harvesters.get(upstream.name),
+    timeouts=adaptive_timeouts
+)
+# Sampled request traces (TRACE_SAMPLE_RATE), exported to TRACE_FILE
+tracer = tracing.Tracer.from_env()
+# Background completions (/v1/jobs), run by JOBS_WORKERS workers; long polls wait up to JOBS_MAX_WAIT seconds
+job_queue = JobQueue.from_env()
+JOBS_MAX_WAIT = float(os.getenv("JOBS_MAX_WAIT", "30"))
+# Reply pieces buffered per WebSocket turn before the upstream read waits for the client
+WS_DELTA_QUEUE = int(os.getenv("WS_DELTA_QUEUE", "64"))
+# /debug endpoints are only served when DEBUG_TOKEN is set; one capture at a time
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+_debug_capture = asyncio.Lock()
 
 
 @asynccontextmanager
@@ -40,9 +105,27 @@ async def lifespan(app: FastAPI):
     """Application lifespan manager"""
     logger.info("🚀 Chat Website API Server starting...")
     logger.info(f"Target: {CHAT_WEBSITE_URL}")
-    logger.info(f"Mode: {'Selenium (browser automation)' if USE_SELENIUM else 'HTTP (reverse-engineered API)'}")
+    if len(upstream_pool.upstreams) > 1:
+        logger.info(f"Upstreams: {', '.join(u.name for u in upstream_pool.upstreams)} ({upstream_pool.strategy})")
+    logger.info(f"Mode: {BACKEND_DESCRIPTIONS[CHAT_BACKEND]}")
+    # Import the primary backend now rather than on the first request
+    load_backend("http" if CHAT_BACKEND == "auto" else CHAT_BACKEND)
+    background_tasks = [asyncio.create_task(usage_tracker.run()), asyncio.create_task(job_queue.run())]
+    if CHAT_BACKEND == "auto":
+        background_tasks.append(asyncio.create_task(
+            backend_router.run_probes(_probe_backend, float(os.getenv("BACKEND_PROBE_INTERVAL", "30")))
+        ))
+    if keep_warm.enabled:
+        background_tasks.append(asyncio.create_task(keep_warm.run()))
     yield
     logger.info("🛑 Shutting down server...")
+    for task in background_tasks:
+        task.cancel()
+    for task in background_tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
     # Close all clients
     for client in conversation_clients.values():
         try:
@@ -50,6 +133,13 @@ async def lifespan(app: FastAPI):
                 client.close()
         except Exception as e:
             logger.error(f"Error closing client: {e}")
+    for host in browser_hosts.values():
+        host.close()
+    for harvester in session_harvesters.values():
+        harvester.close()
+    for pool in upstream_pools.values():
+        pool.close()
+    tracer.close()
 
 
 app = FastAPI(
@@ -58,29 +148,524 @@ app = FastAPI(
     version="1.0.0",
     lifespan=lifespan
 )
+app.add_middleware(tracing.TracingMiddleware, tracer=tracer)
 
 
-def _get_or_create_client(conversation_id: str = None):
+def _get_or_create_client(conversation_id: str = None, upstream: Optional[Upstream] = None):
     """Get existing client or create new one"""
     if conversation_id and conversation_id in conversation_clients:
-        return conversation_clients[conversation_id]
+        client = conversation_clients[conversation_id]
+        # Only plain HTTP clients can move; the pool keeps other conversations sticky
+        if upstream and CHAT_BACKEND == "http" and client.base_url != upstream.url:
+            client.set_upstream(
+                upstream.url, upstream.api_endpoint, upstream.headers, upstream.cookies,
+                pool=_upstream_pool(upstream)
+            )
+        return client
     
-    if USE_SELENIUM:
-        client = ChatSeleniumClient(headless=True)
+    if CHAT_BACKEND == "auto":
+        client = FailoverClient(
+            backend_router,
+            {
+                name: functools.partial(_create_backend_client, name, upstream=upstream)
+                for name in AUTO_BACKENDS
+            },
+            conversation_id
+        )
     else:
-        client = ChatHTTPClient(conversation_id=conversation_id)
+        client = _create_backend_client(CHAT_BACKEND, conversation_id, upstream)
     
     if conversation_id:
-        conversation_clients[conversation_id] = client
+        _register_client(conversation_id, client)
     
     return client
 
 
+def _create_backend_client(backend: str, conversation_id: Optional[str] = None, upstream: Optional[Upstream] = None):
+    """Create a client of one backend for the given upstream"""
+    host_key = upstream.name if upstream else "default"
+    client_class = load_backend(backend)
+    if backend == "selenium":
+        from app.clients.browser_host import BrowserHost
+        if host_key not in browser_hosts:
+            browser_hosts[host_key] = BrowserHost.from_env(headless=True)
+        factory = functools.partial(
+            client_class,
+            headless=True,
+            base_url=upstream.url if upstream else None,
+            cookies=upstream.cookies if upstream else None,
+            host=browser_hosts[host_key]
+        )
+        if CHAT_BACKEND == "selenium":
+            # Driven from its own thread; auto mode's failover already runs off the loop
+            from app.clients.selenium_actor import SeleniumActor
+            return SeleniumActor(factory)
+        return factory()
+    if backend == "hybrid":
+        from app.clients.chat_hybrid_client import SessionHarvester
+        if host_key not in session_harvesters:
+            session_harvesters[host_key] = SessionHarvester(
+                base_url=upstream.url if upstream else None,
+                cookies=upstream.cookies if upstream else None
+            )
+        return client_class(
+            session_harvesters[host_key],
+            conversation_id=conversation_id,
+            api_endpoint=upstream.api_endpoint if upstream else None
+        )
+    return client_class(
+        conversation_id=conversation_id,
+        base_url=upstream.url if upstream else None,
+        api_endpoint=upstream.api_endpoint if upstream else None,
+        headers=upstream.headers if upstream else None,
+        cookies=upstream.cookies if upstream else None,
+        pool=_upstream_pool(upstream)
+    )
+
+
+def _upstream_pool(upstream: Optional[Upstream]):
+    """
+    Shared connection pool of an upstream, or None for private connections per client
+
+    Connections are shared with HTTP/2 (one multiplexed connection) and with
+    keep-warm connections, which only help if any conversation can use them.
+    """
+    if upstream is None or not (settings.chat_http2 or (keep_warm.enabled and keep_warm.connections > 0)):
+        return None
+    if upstream.name not in upstream_pools:
+        from app.clients.transport import ConnectionPool
+        upstream_pools[upstream.name] = ConnectionPool(size=upstream.max_concurrency)
+    return upstream_pools[upstream.name]
+
+
+def _warm_session(upstream: Upstream):
+    """Session whose connections keep-warm keeps open for an upstream"""
+    if CHAT_BACKEND == "hybrid":
+        harvester = session_harvesters.get(upstream.name)
+        return harvester.session if harvester and harvester.version > 0 else None
+    if CHAT_BACKEND in ("http", "auto"):
+        pool = _upstream_pool(upstream)
+        return pool.session() if pool else None
+    return None
+
+
+async def _send_message(
+    conversation_id: str,
+    user_message: str,
+    history: History,
+    tenant: str,
+    weight: float,
+    priority: str,
+    deadline: float,
+    cancel: CancelToken,
+    sample: bool = False,
+    on_delta: Optional[Callable[[str], None]] = None,
+    stop: Union[str, List[str], None] = None,
+    max_tokens: Optional[int] = None
+) -> Dict[str, str]:
+    """
+    Send one message through the fair scheduler and the upstream pool
+    
+    The message continues `history` (see _apply_history). The client gets
+    whatever is left of the request's `deadline` (time.monotonic()) once a
+    slot is free, and `cancel` to abandon the upstream work early. With
+    `sample`, the message goes to a temporary fork instead, so extra
+    choices (request `n`) never enter the conversation. `on_delta` is
+    called from the client's thread with each piece of the reply.
+    
+    The reply ends at the first `stop` sequence or after `max_tokens`, and
+    the upstream read stops there; the result's "finish_reason" is "stop"
+    or "length".
+    """
+    limit = OutputLimit(stop, max_tokens, on_delta) if stop or max_tokens else None
+    response = await _send_limited(
+        conversation_id, user_message, history, tenant, weight, priority, deadline, cancel,
+        sample, limit or on_delta
+    )
+    if limit is None:
+        return {**response, "finish_reason": "stop"}
+    content, finish_reason = limit.finish(response["content"])
+    return {**response, "content": content, "finish_reason": finish_reason}
+
+
+async def _send_limited(
+    conversation_id: str,
+    user_message: str,
+    history: History,
+    tenant: str,
+    weight: float,
+    priority: str,
+    deadline: float,
+    cancel: CancelToken,
+    sample: bool,
+    on_delta: Optional[Callable[[str], None]]
+) -> Dict[str, str]:
+    """_send_message without the output limits"""
+    try:
+        return await _send_in_slot(
+            conversation_id, user_message, history, tenant, weight, priority, deadline, cancel, sample, on_delta
+        )
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+
+async def _send_in_slot(
+    conversation_id: str,
+    user_message: str,
+    history: History,
+    tenant: str,
+    weight: float,
+    priority: str,
+    deadline: float,
+    cancel: CancelToken,
+    sample: bool,
+    on_delta: Optional[Callable[[str], None]]
+) -> Dict[str, str]:
+    """
+    Wait for a scheduler slot and an upstream, then send
+    
+    Running out of time while queued raises DeadlineExceeded, which the
+    upstream pool does not count against the upstream.
+    """
+    queued_at = tracing.now()
+    async with scheduler.slot(tenant, weight=weight, priority=priority):
+        async with upstream_pool.acquire(conversation_id, rebindable=CHAT_BACKEND == "http") as upstream:
+            tracing.add_span("queue", queued_at, upstream=upstream.name)
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise DeadlineExceeded("Request deadline passed while queued")
+            with tracing.span("client"):
+                client = _get_or_create_client(conversation_id, upstream)
+            if not sample:
+                _apply_history(client, history)
+                with tracing.span("upstream", backend=CHAT_BACKEND):
+                    return await _client_send(client, user_message, timeout, cancel, on_delta)
+            
+            with tracing.span("client"):
+                # Backends that cannot fork are refused n > 1 by _admit_completion
+                sample_client = client.fork(None)
+                _apply_history(sample_client, history)
+            try:
+                with tracing.span("upstream", backend=CHAT_BACKEND, sample=True):
+                    return await _client_send(sample_client, user_message, timeout, cancel, on_delta)
+            finally:
+                sample_client.close()
+
+
+async def _client_send(client, user_message: str, timeout: float, cancel: CancelToken, on_delta=None) -> Dict[str, str]:
+    """
+    Await an actor's send_message; blocking clients run in the threadpool
+    
+    If the caller is cancelled, this still waits for the thread to return,
+    or for the actor to stop its command or give up its hung tab (`cancel`
+    makes either stop early), so the scheduler and upstream slots around
+    it stay held while the upstream is being driven.
+    """
+    actor = inspect.iscoroutinefunction(client.send_message)
+    if actor:
+        call = asyncio.ensure_future(client.send_message(user_message, timeout, cancel, on_delta))
+    else:
+        call = asyncio.ensure_future(run_in_threadpool(client.send_message, user_message, timeout, cancel, on_delta))
+    try:
+        return await asyncio.shield(call)
+    except asyncio.CancelledError:
+        cancel.cancel("cancelled")
+        if actor:
+            # The actor finishes only once its command has stopped or its worker was restarted
+            call.cancel()
+        while not call.done():
+            try:
+                await asyncio.wait({call})
+            except asyncio.CancelledError:
+                pass
+        if not call.cancelled():
+            call.exception()
+        raise
+
+
+def _apply_history(client, history: History):
+    """Make `client` continue from `history` if it does not already"""
+    if client.get_conversation_history() is history:
+        return
+    if hasattr(client, "set_history"):
+        client.set_history(history)
+    elif history:
+        # Browser conversations keep their history in the page
+        logger.warning(f"{type(client).__name__} cannot rewind or seed its history; sending only the new message")
+
+
+def _request_timeout(http_request: Request) -> float:
+    """Deadline in seconds from the X-Request-Timeout header, else CHAT_TIMEOUT"""
+    value = http_request.headers.get("x-request-timeout")
+    if value is None:
+        return settings.chat_timeout
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = 0
+    if not timeout > 0:
+        raise HTTPException(status_code=400, detail="X-Request-Timeout must be a positive number of seconds")
+    return timeout
+
+
+async def _wait_for_disconnect(http_request: Request):
+    """Return once the client has gone away (the request body is already read)"""
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _until_done_or_disconnected(work, http_request: Optional[Request], cancel: CancelToken, timeout: float):
+    """
+    Await `work` unless the client disconnects or `timeout` passes first
+    
+    Without `http_request` (background jobs) only the timeout applies.
+    
+    Either way `cancel` is set, so threads stop waiting on the upstream (the
+    slots they hold are released when they return), and 499 or 504 is raised.
+    """
+    work = asyncio.ensure_future(work)
+    # If abandoned, its outcome arrives after the response has been sent
+    work.add_done_callback(lambda future: future.cancelled() or future.exception())
+    watchers = {asyncio.ensure_future(_wait_for_disconnect(http_request))} if http_request else set()
+    try:
+        done, _ = await asyncio.wait({work} | watchers, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for watcher in watchers:
+            watcher.cancel()
+    if work in done:
+        return work.result()
+    
+    disconnected = bool(watchers & done)
+    cancel.cancel("abandoned by the client" if disconnected else f"timed out after {timeout:g}s")
+    work.cancel()
+    logger.warning(f"⏹️ Upstream work cancelled: request {cancel.reason}")
+    if disconnected:
+        raise HTTPException(status_code=499, detail="Client closed request")
+    raise HTTPException(status_code=504, detail=f"No response within {timeout:g}s")
+
+
+async def _probe_backend(backend: str) -> bool:
+    """Send a probe message through a throwaway client of `backend`"""
+    upstream = upstream_pool.upstreams[0]
+    
+    def _probe():
+        client = _create_backend_client(backend, upstream=upstream)
+        try:
+            client.send_message(os.getenv("BACKEND_PROBE_MESSAGE", "ping"), timeout=30)
+            return True
+        finally:
+            client.close()
+    
+    return await run_in_threadpool(_probe)
+
+
+def _register_client(conversation_id: str, client):
+    """Store a conversation's client"""
+    conversation_clients[conversation_id] = client
+    conversation_seq[conversation_id] = next(_seq_counter)
+
+
+def _encode_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(str(seq).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 def _count_tokens(text: str) -> int:
     """Rough token count estimation (4 chars ≈ 1 token)"""
     return len(text) // 4
 
 
+def _bearer_token(http_request) -> str:
+    """API key from an `Authorization: Bearer ...` header, if any (HTTP or WebSocket)"""
+    auth = http_request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip()
+    return ""
+
+
+def _check_rate_limit(api_key: str, tenant: str, tokens: int):
+    """Raise 429 if `api_key` cannot spend `tokens` now"""
+    retry_after = rate_limiter.check(api_key, tokens)
+    if retry_after:
+        usage_tracker.record(tenant, rejected=1)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded, retry in {retry_after:.1f}s",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+
+def _tenant(api_key: str) -> str:
+    """Rate-limit, scheduling and usage identity: keys without configured limits share the anonymous one"""
+    return key_id(rate_limiter.resolve(api_key))
+
+
+def _record_usage(api_key: str, tenant: str, prompt_tokens: int, completion_tokens: int, estimated_tokens: int):
+    """Count a finished request and settle the token estimate charged when it was admitted"""
+    rate_limiter.settle(api_key, estimated_tokens, prompt_tokens + completion_tokens)
+    usage_tracker.record(
+        tenant,
+        requests=1,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens
+    )
+
+
+def _admit_completion(request: ChatCompletionRequest, api_key: str) -> Dict:
+    """
+    Check a completion request and charge it to `api_key`'s rate limits
+    
+    Raises 400 without a user message or for n > 1 on a backend that cannot
+    fork conversations, and 429 when rate limited. Returns
+    what _run_completion needs: the conversation id, the index and text of
+    the last user message, the tenant, the prompt token count and the token
+    estimate charged up front (settled by _record_usage).
+    """
+    # Generate or extract conversation ID from system prompt if present
+    conversation_id = str(uuid.uuid4())
+    for msg in request.messages:
+        if msg.role == ChatRole.SYSTEM and "conversation_id:" in msg.content:
+            # Allow specifying conversation_id in system prompt
+            try:
+                conversation_id = msg.content.split("conversation_id:")[-1].strip().split()[0]
+            except:
+                pass
+    
+    logger.info(f"📨 Chat request - Conversation: {conversation_id}, Model: {request.model}")
+    
+    # Extract user message (last user message in the request)
+    user_message = None
+    user_index = 0
+    for user_index in range(len(request.messages) - 1, -1, -1):
+        if request.messages[user_index].role == ChatRole.USER:
+            user_message = request.messages[user_index].content
+            break
+    
+    if not user_message:
+        raise HTTPException(
+            status_code=400,
+            detail="No user message found in request"
+        )
+    
+    n = request.n or 1
+    if n > 1 and CHAT_BACKEND == "selenium":
+        # Extra choices are sampled from forks; a fresh tab would answer without the conversation
+        raise HTTPException(
+            status_code=400,
+            detail="n > 1 is not supported in Selenium mode (browser conversations cannot be forked)"
+        )
+    
+    # Per-key rate limits
+    tenant = _tenant(api_key)
+    prompt_tokens = _count_tokens(user_message)
+    estimated_tokens = prompt_tokens + n * (request.max_tokens or 0)
+    _check_rate_limit(api_key, tenant, estimated_tokens)
+    return {
+        "conversation_id": conversation_id,
+        "user_index": user_index,
+        "user_message": user_message,
+        "tenant": tenant,
+        "prompt_tokens": prompt_tokens,
+        "estimated_tokens": estimated_tokens
+    }
+
+
+async def _run_completion(
+    request: ChatCompletionRequest,
+    admitted: Dict,
+    api_key: str,
+    timeout: float,
+    cancel: CancelToken,
+    http_request: Optional[Request] = None
+) -> ChatCompletionResponse:
+    """
+    Produce the completion for an admitted request (see _admit_completion)
+    
+    Shared by /v1/chat/completions and /v1/jobs. The stored history is
+    reconciled with the request's messages only now, so a job that waited
+    in the queue continues whatever its conversation holds by the time it
+    runs. Gives up with 504 after `timeout` seconds, and with 499 if
+    `http_request`'s client disconnects first.
+    """
+    conversation_id = admitted["conversation_id"]
+    user_message = admitted["user_message"]
+    tenant = admitted["tenant"]
+    prompt_tokens = admitted["prompt_tokens"]
+    n = request.n or 1
+    
+    # The turns before it are the history the client expects: continue the
+    # stored one, or rewind it where the client edited or regenerated turns.
+    # A client that sends only the new message (naming the conversation in
+    # its system prompt) continues the stored history as it is.
+    existing = conversation_clients.get(conversation_id)
+    stored = existing.get_conversation_history() if existing else History()
+    earlier = [
+        (msg.role.value, msg.content)
+        for msg in request.messages[:admitted["user_index"]]
+        if msg.role != ChatRole.SYSTEM
+    ]
+    history = stored.reconcile(earlier) if earlier else stored
+    if history is not stored:
+        logger.info(f"🔀 Reconciled history: {len(stored)} stored, {len(history)} expected by the client")
+    
+    # Send message to chat website
+    logger.info(f"📤 Sending message: {user_message[:100]}...")
+    start_time = time.time()
+    
+    # The first choice continues the conversation; the other n - 1 are sampled
+    # concurrently from temporary forks of the same history
+    priority = (request.priority or Priority.INTERACTIVE).value
+    weight = rate_limiter.limits_for(api_key).weight
+    deadline = time.monotonic() + timeout
+    responses = await _until_done_or_disconnected(
+        asyncio.gather(*(
+            _send_message(
+                conversation_id, user_message, history, tenant, weight, priority, deadline, cancel,
+                sample=index > 0, stop=request.stop, max_tokens=request.max_tokens
+            )
+            for index in range(n)
+        )),
+        http_request,
+        cancel,
+        timeout
+    )
+    
+    elapsed = time.time() - start_time
+    logger.info(f"✅ Received {n} response{'s' if n > 1 else ''} in {elapsed:.2f}s")
+    
+    # Create OpenAI-compatible response
+    completion_tokens = sum(_count_tokens(response["content"]) for response in responses)
+    _record_usage(api_key, tenant, prompt_tokens, completion_tokens, admitted["estimated_tokens"])
+    
+    return ChatCompletionResponse(
+        id=f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        created=int(time.time()),
+        model=request.model,
+        choices=[
+            ChatCompletionChoice(
+                index=index,
+                message=ChatMessage(
+                    role=ChatRole.ASSISTANT,
+                    content=response["content"]
+                ),
+                finish_reason=response["finish_reason"]
+            )
+            for index, response in enumerate(responses)
+        ],
+        usage=UsageInfo(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+    )
+
+
 @app.get("/", tags=["Health"])
 async def root():
     """Health check endpoint"""
@@ -88,7 +673,7 @@ async def root():
         "status": "ok",
         "message": "Chat Website API Wrapper is running",
         "target": CHAT_WEBSITE_URL,
-        "mode": "selenium" if USE_SELENIUM else "http",
+        "mode": CHAT_BACKEND,
         "active_conversations": len(conversation_clients)
     }
 
@@ -128,74 +713,18 @@ async def list_models():
 
 
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse, tags=["Chat"])
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
     """
     Create a chat completion (OpenAI-compatible endpoint)
     
     This endpoint mimics the OpenAI API but routes requests to GovChat.
     """
     try:
-        # Generate or extract conversation ID from system prompt if present
-        conversation_id = str(uuid.uuid4())
-        for msg in request.messages:
-            if msg.role == ChatRole.SYSTEM and "conversation_id:" in msg.content:
-                # Allow specifying conversation_id in system prompt
-                try:
-                    conversation_id = msg.content.split("conversation_id:")[-1].strip().split()[0]
-                except:
-                    pass
-        
-        logger.info(f"📨 Chat request - Conversation: {conversation_id}, Model: {request.model}")
-        
-        # Get or create client
-        client = _get_or_create_client(conversation_id)
-        
-        # Extract user message (last user message in the request)
-        user_message = None
-        for msg in reversed(request.messages):
-            if msg.role == ChatRole.USER:
-                user_message = msg.content
-                break
-        
-        if not user_message:
-            raise HTTPException(
-                status_code=400,
-                detail="No user message found in request"
-            )
-        
-        # Send message to chat website
-        logger.info(f"📤 Sending message: {user_message[:100]}...")
-        start_time = time.time()
-        
-        response = client.send_message(user_message)
-        
-        elapsed = time.time() - start_time
-        logger.info(f"✅ Received response in {elapsed:.2f}s")
-        
-        # Create OpenAI-compatible response
-        prompt_tokens = _count_tokens(user_message)
-        completion_tokens = _count_tokens(response["content"])
-        
-        return ChatCompletionResponse(
-            id=f"chatcmpl-{uuid.uuid4().hex[:12]}",
-            created=int(time.time()),
-            model=request.model,
-            choices=[
-                ChatCompletionChoice(
-                    index=0,
-                    message=ChatMessage(
-                        role=ChatRole.ASSISTANT,
-                        content=response["content"]
-                    ),
-                    finish_reason="stop"
-                )
-            ],
-            usage=UsageInfo(
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                total_tokens=prompt_tokens + completion_tokens
-            )
-        )
+        # Deadline for the whole request, queueing included
+        timeout = _request_timeout(http_request)
+        api_key = request.key or _bearer_token(http_request) or ANONYMOUS_KEY
+        admitted = _admit_completion(request, api_key)
+        return await _run_completion(request, admitted, api_key, timeout, CancelToken(), http_request)
     
     except HTTPException:
         raise
@@ -207,9 +736,268 @@ async def chat_completions(request: ChatCompletionRequest):
         )
 
 
+@app.post("/v1/jobs", response_model=JobResponse, status_code=202, tags=["Jobs"])
+async def submit_job(request: ChatCompletionRequest, http_request: Request):
+    """
+    Queue a chat completion and return its job at once
+    
+    Takes the same body as /v1/chat/completions. Poll GET /v1/jobs/{job_id}
+    (with `wait` to long-poll) for the result. X-Request-Timeout limits the
+    completion itself, counted from when a worker picks the job up.
+    """
+    timeout = _request_timeout(http_request)
+    api_key = request.key or _bearer_token(http_request) or ANONYMOUS_KEY
+    if job_queue.full:
+        raise HTTPException(status_code=503, detail="Too many queued jobs, retry later", headers={"Retry-After": "5"})
+    admitted = _admit_completion(request, api_key)
+    
+    async def work(cancel: CancelToken) -> ChatCompletionResponse:
+        try:
+            return await _run_completion(request, admitted, api_key, timeout, cancel)
+        except HTTPException as e:
+            raise JobFailed(e.status_code, e.detail)
+        except RequestCancelled as e:
+            raise JobFailed(499, str(e))
+    
+    try:
+        job = job_queue.submit(work, owner=key_id(api_key))
+    except JobQueueFull:
+        raise HTTPException(status_code=503, detail="Too many queued jobs, retry later", headers={"Retry-After": "5"})
+    logger.info(f"🗂️ Job {job.id} queued - Conversation: {admitted['conversation_id']}")
+    return job.info()
+
+
+@app.get("/v1/jobs/{job_id}", response_model=JobResponse, tags=["Jobs"])
+async def get_job(
+    job_id: str,
+    http_request: Request,
+    wait: float = Query(default=0, ge=0, description="Seconds to wait for the job to finish (capped at JOBS_MAX_WAIT)"),
+    key: Optional[str] = Query(default=None)
+):
+    """
+    State of a job, with its result once it has finished
+    
+    Finished jobs are kept for JOBS_RESULT_TTL seconds. Only the key that
+    submitted a job can read it.
+    """
+    api_key = key or _bearer_token(http_request) or ANONYMOUS_KEY
+    job = job_queue.get(job_id)
+    if job is None or job.owner != key_id(api_key):
+        raise HTTPException(status_code=404, detail="Job not found (unknown or expired)")
+    job = await job_queue.wait(job_id, min(wait, JOBS_MAX_WAIT))
+    return job.info()
+
+
+@app.websocket("/v1/chat/ws")
+async def chat_websocket(websocket: WebSocket, conversation_id: Optional[str] = None, key: Optional[str] = None):
+    """
+    Multi-turn chat over one WebSocket, bound to one conversation
+    
+    The server first sends {"type": "session", "conversation_id": ...}. Each
+    client frame {"content": "...", "max_tokens"?, "stop"?, "priority"?, "timeout"?}
+    is a user turn continuing the conversation; the reply streams back as
+    {"type": "delta", "content": ...} frames and ends with {"type": "done",
+    "content": <full reply>, "finish_reason", "usage": {...}}. {"type": "cancel"} abandons
+    the turn in progress. Failures are {"type": "error", "status", "detail"}
+    frames; the connection stays open. One turn runs at a time.
+    
+    The API key comes from the `key` query parameter or an Authorization
+    header.
+    """
+    await websocket.accept()
+    conversation_id = conversation_id or str(uuid.uuid4())
+    api_key = key or _bearer_token(websocket) or ANONYMOUS_KEY
+    await websocket.send_json({"type": "session", "conversation_id": conversation_id})
+    logger.info(f"🔌 WebSocket session - Conversation: {conversation_id}")
+    
+    turn: Optional[asyncio.Task] = None
+    cancel = CancelToken()
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+                if not isinstance(frame, dict):
+                    raise ValueError("frame is not an object")
+                if frame.get("type") == "cancel":
+                    cancel.cancel("cancelled by the client")
+                    continue
+                request = ChatTurn(**frame)
+            except ValueError as e:
+                # Invalid JSON and failed validation (pydantic's ValidationError is a ValueError)
+                await websocket.send_json({"type": "error", "status": 400, "detail": f"Invalid turn: {e}"})
+                continue
+            if turn and not turn.done():
+                await websocket.send_json({"type": "error", "status": 409, "detail": "A turn is already in progress"})
+                continue
+            cancel = CancelToken()
+            turn = asyncio.create_task(_websocket_turn(websocket, conversation_id, api_key, request, cancel))
+    except WebSocketDisconnect:
+        logger.info(f"🔌 WebSocket closed - Conversation: {conversation_id}")
+    finally:
+        if turn and not turn.done():
+            cancel.cancel("abandoned by the client")
+            await asyncio.wait({turn})
+
+
+async def _websocket_turn(websocket: WebSocket, conversation_id: str, api_key: str, request: ChatTurn, cancel: CancelToken):
+    """Run one WebSocket turn, streaming the reply as it arrives"""
+    loop = asyncio.get_running_loop()
+    # Bounded, so a slow reader holds back the upstream read instead of buffering it here
+    deltas: asyncio.Queue = asyncio.Queue(maxsize=WS_DELTA_QUEUE)
+    
+    def on_delta(text: str):
+        # Runs in the client's thread: wait for room in the queue, or for cancellation
+        future = asyncio.run_coroutine_threadsafe(deltas.put(text), loop)
+        with cancel.on_cancel(future.cancel):
+            try:
+                future.result()
+            except concurrent.futures.CancelledError:
+                cancel.raise_if_cancelled()
+                raise
+    
+    async def forward():
+        while True:
+            text = await deltas.get()
+            if text is None:
+                return
+            # Send whatever queued up behind it in the same frame
+            while not deltas.empty():
+                more = deltas.get_nowait()
+                if more is None:
+                    await websocket.send_json({"type": "delta", "content": text})
+                    return
+                text += more
+            await websocket.send_json({"type": "delta", "content": text})
+    
+    forwarder = asyncio.create_task(forward())
+    forwarder.add_done_callback(lambda task: task.cancelled() or task.exception())
+    try:
+        tenant = _tenant(api_key)
+        prompt_tokens = _count_tokens(request.content)
+        estimated_tokens = prompt_tokens + (request.max_tokens or 0)
+        _check_rate_limit(api_key, tenant, estimated_tokens)
+        
+        timeout = request.timeout or settings.chat_timeout
+        existing = conversation_clients.get(conversation_id)
+        history = existing.get_conversation_history() if existing else History()
+        work = asyncio.ensure_future(_send_message(
+            conversation_id, request.content, history, tenant,
+            rate_limiter.limits_for(api_key).weight, (request.priority or Priority.INTERACTIVE).value,
+            time.monotonic() + timeout, cancel, on_delta=on_delta,
+            stop=request.stop, max_tokens=request.max_tokens
+        ))
+        # If abandoned, its outcome arrives after the turn has ended
+        work.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            response = await asyncio.wait_for(asyncio.shield(work), timeout)
+        except asyncio.TimeoutError:
+            cancel.cancel(f"timed out after {timeout:g}s")
+            raise HTTPException(status_code=504, detail=f"No response within {timeout:g}s")
+        
+        await deltas.put(None)
+        await forwarder
+        completion_tokens = _count_tokens(response["content"])
+        _record_usage(api_key, tenant, prompt_tokens, completion_tokens, estimated_tokens)
+        await websocket.send_json({
+            "type": "done",
+            "content": response["content"],
+            "finish_reason": response["finish_reason"],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+    except HTTPException as e:
+        await _send_turn_error(websocket, e.status_code, e.detail)
+    except RequestCancelled as e:
+        await _send_turn_error(websocket, 499, str(e))
+    except Exception as e:
+        logger.error(f"❌ WebSocket turn error: {str(e)}", exc_info=True)
+        await _send_turn_error(websocket, 500, f"Error processing turn: {str(e)}")
+    finally:
+        forwarder.cancel()
+
+
+async def _send_turn_error(websocket: WebSocket, status: int, detail: str):
+    try:
+        await websocket.send_json({"type": "error", "status": status, "detail": detail})
+    except Exception:
+        # The socket is already gone
+        pass
+
+
+@app.get("/conversations", tags=["Conversations"])
+async def list_conversations(
+    limit: int = Query(default=50, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    min_idle_seconds: Optional[float] = None,
+    max_idle_seconds: Optional[float] = None,
+    min_messages: Optional[int] = None,
+    max_messages: Optional[int] = None
+):
+    """
+    List conversations, oldest first
+    
+    Pass the returned `next_cursor` as `cursor` to get the next page.
+    """
+    after_seq = _decode_cursor(cursor) if cursor else 0
+    now = time.time()
+    items = []
+    last_seq = None
+    
+    for conversation_id, client in conversation_clients.items():
+        seq = conversation_seq[conversation_id]
+        if seq <= after_seq:
+            continue
+        idle = now - client.last_used
+        size = len(client.get_conversation_history())
+        if ((min_idle_seconds is not None and idle < min_idle_seconds)
+                or (max_idle_seconds is not None and idle > max_idle_seconds)
+                or (min_messages is not None and size < min_messages)
+                or (max_messages is not None and size > max_messages)):
+            continue
+        if len(items) == limit:
+            break
+        upstream = upstream_pool.sticky_upstream(conversation_id)
+        items.append({
+            "conversation_id": conversation_id,
+            "messages": size,
+            "created_at": int(client.created_at),
+            "idle_seconds": round(idle, 1),
+            "upstream": upstream.name if upstream else None
+        })
+        last_seq = seq
+    else:
+        last_seq = None
+    
+    return {
+        "object": "list",
+        "data": items,
+        "next_cursor": _encode_cursor(last_seq) if last_seq is not None else None
+    }
+
+
 @app.get("/conversations/{conversation_id}", tags=["Conversations"])
-async def get_conversation_history(conversation_id: str):
-    """Get the conversation history"""
+async def get_conversation_history(
+    conversation_id: str,
+    request: Request,
+    limit: int = Query(default=100, ge=1, le=1000),
+    before: Optional[int] = Query(default=None, ge=0),
+    after: Optional[int] = Query(default=None, ge=-1),
+    format: Optional[str] = Query(default=None, pattern="^(json|ndjson)$")
+):
+    """
+    Get the conversation history
+    
+    Messages are indexed from 0. `after`/`before` select messages with a
+    greater/smaller index; at most `limit` (default 100, at most 1000) are
+    returned, taken from the start of the range when paging forward
+    (`after`) and from its end otherwise. Each page is looked up in
+    O(log n + limit), however long the conversation.
+    Use `format=ndjson` (or `Accept: application/x-ndjson`) to stream one
+    message per line.
+    """
     if conversation_id not in conversation_clients:
         raise HTTPException(
             status_code=404,
@@ -219,9 +1007,66 @@ async def get_conversation_history(conversation_id: str):
     client = conversation_clients[conversation_id]
     history = client.get_conversation_history()
     
+    total = len(history)
+    start = after + 1 if after is not None else 0
+    stop = min(before, total) if before is not None else total
+    if after is not None:
+        stop = min(stop, start + limit)
+    else:
+        start = max(start, stop - limit)
+    nodes = history.slice(start, stop)
+    
+    if format == "ndjson" or (format is None and "application/x-ndjson" in request.headers.get("accept", "")):
+        def _lines():
+            for index, node in enumerate(nodes, start):
+                yield json.dumps({"index": index, "role": node.role, "content": node.content}) + "\n"
+        return StreamingResponse(_lines(), media_type="application/x-ndjson")
+    
     return {
         "conversation_id": conversation_id,
-        "messages": history
+        "total": total,
+        "messages": [{"role": node.role, "content": node.content} for node in nodes],
+        "before": start if nodes and start > 0 else None,
+        "after": start + len(nodes) - 1 if nodes and start + len(nodes) < total else None
+    }
+
+
+@app.post("/conversations/{conversation_id}/fork", tags=["Conversations"])
+async def fork_conversation(conversation_id: str, fork: Optional[ForkRequest] = None):
+    """
+    Fork a conversation into a new one that shares its history
+    
+    Forks share the parent's messages instead of copying them, so branching
+    a long conversation into many alternatives is cheap.
+    """
+    if conversation_id not in conversation_clients:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Conversation {conversation_id} not found"
+        )
+    
+    fork = fork or ForkRequest()
+    new_id = fork.conversation_id or str(uuid.uuid4())
+    if new_id in conversation_clients:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Conversation {new_id} already exists"
+        )
+    
+    try:
+        client = conversation_clients[conversation_id].fork(new_id, fork.at)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    
+    _register_client(new_id, client)
+    upstream = upstream_pool.sticky_upstream(conversation_id)
+    if upstream:
+        upstream_pool.bind(new_id, upstream)
+    
+    return {
+        "conversation_id": new_id,
+        "parent_id": conversation_id,
+        "messages": len(client.get_conversation_history())
     }
 
 
@@ -241,6 +1086,8 @@ async def delete_conversation(conversation_id: str):
         logger.warning(f"Error closing client: {e}")
     
     del conversation_clients[conversation_id]
+    conversation_seq.pop(conversation_id, None)
+    upstream_pool.release_conversation(conversation_id)
     
     return {
         "status": "deleted",
@@ -254,10 +1101,117 @@ async def health_check():
     return {
         "status": "healthy",
         "active_conversations": len(conversation_clients),
-        "mode": "selenium" if USE_SELENIUM else "http"
+        "mode": CHAT_BACKEND
     }
 
 
+@app.get("/stats/upstreams", tags=["Stats"])
+async def upstream_stats():
+    """Per-upstream load, failure and latency statistics"""
+    return upstream_pool.stats()
+
+
+@app.get("/stats/browsers", tags=["Stats"])
+async def browser_stats():
+    """Browser and tab counts per upstream (Selenium mode)"""
+    return {name: host.stats() for name, host in browser_hosts.items()}
+
+
+@app.get("/stats/backends", tags=["Stats"])
+async def backend_stats():
+    """Backend scores, choices and failovers (auto mode)"""
+    return {
+        "mode": CHAT_BACKEND,
+        **backend_router.stats()
+    }
+
+
+@app.get("/stats/keepwarm", tags=["Stats"])
+async def keepwarm_stats():
+    """Keep-warm probes, session refreshes and DNS cache counters"""
+    return keep_warm.stats()
+
+
+@app.get("/stats/jobs", tags=["Stats"])
+async def job_stats():
+    """Job queue depth and job counts by status"""
+    return job_queue.stats()
+
+
+@app.get("/stats/timeouts", tags=["Stats"])
+async def timeout_stats():
+    """Observed upstream latencies and the connect, first-byte and idle timeouts derived from them"""
+    return adaptive_timeouts.stats()
+
+
+@app.get("/stats/keys", tags=["Stats"])
+async def key_stats():
+    """Per-key usage counters and scheduler state"""
+    return {
+        "scheduler": scheduler.stats(),
+        **usage_tracker.stats()
+    }
+
+
+def _check_debug_token(http_request: Request):
+    """Debug endpoints require DEBUG_TOKEN in an X-Debug-Token header"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(http_request.headers.get("x-debug-token", ""), DEBUG_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+    if _debug_capture.locked():
+        raise HTTPException(status_code=409, detail="Another profile or heap capture is running")
+
+
+@app.get("/debug/profile", tags=["Debug"])
+async def debug_profile(
+    http_request: Request,
+    seconds: float = Query(default=10, gt=0, le=120),
+    interval_ms: float = Query(default=10, ge=1, le=1000),
+    format: str = Query(default="collapsed", pattern="^(collapsed|json)$")
+):
+    """
+    Sample thread and event-loop task stacks of this worker for `seconds`
+    
+    Returns collapsed stacks (one `frame;frame;... count` line per distinct
+    stack) for flamegraph.pl or speedscope, or JSON with `format=json`.
+    Stacks are wall-clock: waiting threads and suspended tasks are included.
+    """
+    _check_debug_token(http_request)
+    from app.profiling import StackSampler
+    
+    async with _debug_capture:
+        sampler = StackSampler(asyncio.get_running_loop(), interval_ms / 1000)
+        await run_in_threadpool(sampler.run, seconds)
+    
+    if format == "json":
+        return {"samples": sampler.samples, "interval_ms": interval_ms, "stacks": sampler.stacks}
+    return PlainTextResponse(
+        sampler.collapsed(),
+        headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'}
+    )
+
+
+@app.get("/debug/heap", tags=["Debug"])
+async def debug_heap(
+    http_request: Request,
+    seconds: float = Query(default=10, gt=0, le=300),
+    limit: int = Query(default=25, ge=1, le=500),
+    group_by: str = Query(default="lineno", pattern="^(lineno|traceback|filename)$")
+):
+    """
+    Top allocation sites by growth over `seconds` (tracemalloc snapshot diff)
+    
+    Tracing is started for the window if it is not already on
+    (PYTHONTRACEMALLOC), so only allocations made during it are seen.
+    """
+    _check_debug_token(http_request)
+    from app.profiling import heap_diff
+    
+    async with _debug_capture:
+        return await run_in_threadpool(heap_diff, seconds, limit, 10, group_by)
+
+
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     """Global exception handler"""
@@ -275,11 +1229,11 @@ async def general_exception_handler(request: Request, exc: Exception):
 
 
 if __name__ == "__main__":
+    # Development only; run.py --production for multi-worker serving
     import uvicorn
     uvicorn.run(
-        "main:app",
+        "app.main:app",
         host="127.0.0.1",
         port=8000,
-        reload=True,
         log_level="info"
     )
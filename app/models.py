@@ -1,5 +1,5 @@
 """Data models for OpenAI-compatible API"""
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 from pydantic import BaseModel, Field
 from enum import Enum
 
@@ -11,6 +11,12 @@ class ChatRole(str, Enum):
     ASSISTANT = "assistant"
 
 
+class Priority(str, Enum):
+    """Scheduling priority classes"""
+    INTERACTIVE = "interactive"
+    BATCH = "batch"
+
+
 class ChatMessage(BaseModel):
     """Single chat message"""
     role: ChatRole
@@ -22,11 +28,17 @@ class ChatCompletionRequest(BaseModel):
     model: Any = Field(default="gpt-4", description="Model identifier (string or object)")
     messages: List[ChatMessage] = Field(..., description="List of messages")
     temperature: Optional[float] = Field(default=0.7, ge=0.0, le=2.0)
-    max_tokens: Optional[int] = Field(default=None)
+    max_tokens: Optional[int] = Field(default=None, ge=1, description="Cut the reply after this many tokens (finish_reason \"length\")")
+    stop: Optional[Union[str, List[str]]] = Field(default=None, description="Sequences that end the reply (not included in it)")
+    n: Optional[int] = Field(default=1, ge=1, le=16, description="Number of choices to generate in parallel")
     top_p: Optional[float] = Field(default=1.0, ge=0.0, le=1.0)
     stream: Optional[bool] = Field(default=False)
     prompt: Optional[str] = Field(default=None, description="System prompt")
     key: Optional[str] = Field(default="", description="API key")
+    priority: Optional[Priority] = Field(
+        default=Priority.INTERACTIVE,
+        description="Scheduling class when the upstream is saturated"
+    )
     
     class Config:
         json_schema_extra = {
@@ -87,6 +99,41 @@ class ChatCompletionResponse(BaseModel):
         }
 
 
+class ChatTurn(BaseModel):
+    """One turn sent over the /v1/chat/ws WebSocket"""
+    content: str = Field(..., min_length=1, description="The user's message")
+    max_tokens: Optional[int] = Field(default=None, ge=1)
+    stop: Optional[Union[str, List[str]]] = Field(default=None)
+    priority: Optional[Priority] = Field(default=Priority.INTERACTIVE)
+    timeout: Optional[float] = Field(default=None, gt=0, description="Seconds for this turn (default CHAT_TIMEOUT)")
+
+
+class JobStatus(str, Enum):
+    """Lifecycle of a /v1/jobs job"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class JobResponse(BaseModel):
+    """State of a background completion job"""
+    id: str
+    object: str = "job"
+    status: JobStatus
+    created: int
+    started: Optional[int] = None
+    finished: Optional[int] = None
+    result: Optional[ChatCompletionResponse] = Field(default=None, description="The completion, once succeeded")
+    error: Optional[Dict[str, Any]] = Field(default=None, description="{\"status\", \"detail\"}, once failed")
+
+
+class ForkRequest(BaseModel):
+    """Request to fork a conversation"""
+    conversation_id: Optional[str] = Field(default=None, description="ID for the new conversation (generated if omitted)")
+    at: Optional[int] = Field(default=None, ge=0, description="Keep only the first N messages (default: all)")
+
+
 class ErrorResponse(BaseModel):
     """Error response"""
     error: Dict[str, Any]
@@ -0,0 +1,104 @@
+"""Stop sequences and max_tokens, enforced on a reply while it streams in"""
+from typing import Callable, List, Optional, Tuple, Union
+
+# Same rough estimate as the usage counters (4 chars ≈ 1 token)
+CHARS_PER_TOKEN = 4
+
+
+class OutputLimitReached(Exception):
+    """
+    Raised from a delta callback to end generation early.
+
+    Clients stop reading (closing the upstream stream or leaving the page
+    alone) and return `text` as the reply.
+    """
+
+    def __init__(self, text: str, finish_reason: str):
+        super().__init__(f"Output limit reached ({finish_reason})")
+        self.text = text
+        self.finish_reason = finish_reason
+
+
+class OutputLimit:
+    """
+    Delta callback that cuts a reply at the first stop sequence or after
+    `max_tokens`, raising OutputLimitReached as soon as either is seen.
+
+    Text is passed on to `on_delta` as it is accepted; the tail that could
+    still turn out to be the start of a stop sequence is held back until it
+    is known not to be.
+    """
+
+    def __init__(
+        self,
+        stop: Union[str, List[str], None] = None,
+        max_tokens: Optional[int] = None,
+        on_delta: Optional[Callable[[str], None]] = None
+    ):
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stop = [sequence for sequence in (stop or []) if sequence]
+        self.max_chars = max_tokens * CHARS_PER_TOKEN if max_tokens else None
+        self.on_delta = on_delta
+        self.finish_reason: Optional[str] = None
+        # Deltas are kept as a list (joining on every delta would be quadratic);
+        # only the held-back tail is searched again together with the next delta
+        self._parts: List[str] = []
+        self._length = 0
+        self._pending = ""
+        self._emitted = 0
+        self._holdback = max((len(sequence) for sequence in self.stop), default=1) - 1
+
+    @property
+    def text(self) -> str:
+        """Everything received so far"""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def _find(self, text: str, offset: int = 0) -> Tuple[int, Optional[str]]:
+        """Where `text` (starting `offset` characters into the reply) ends: first stop sequence or the length limit"""
+        end, reason = len(text), None
+        for sequence in self.stop:
+            index = text.find(sequence)
+            if index != -1 and index < end:
+                end, reason = index, "stop"
+        if self.max_chars is not None and self.max_chars - offset < end:
+            end, reason = max(0, self.max_chars - offset), "length"
+        return end, reason
+
+    def _emit(self, text: str):
+        if text:
+            if self.on_delta:
+                self.on_delta(text)
+            self._emitted += len(text)
+
+    def __call__(self, delta: str):
+        # A stop sequence may straddle the previous delta and this one; it
+        # cannot start before the held-back tail, or it would have been found
+        window = self._pending + delta
+        offset = self._length - len(self._pending)
+        self._parts.append(delta)
+        self._length += len(delta)
+        end, reason = self._find(window, offset)
+        if reason:
+            self.finish_reason = reason
+            self._emit(window[:end])
+            raise OutputLimitReached(self.text[:offset + end], reason)
+        keep = max(0, len(window) - self._holdback)
+        self._emit(window[:keep])
+        self._pending = window[keep:]
+
+    def finish(self, content: str) -> Tuple[str, str]:
+        """
+        Final reply and finish_reason given the client's complete reply
+
+        Replies that were not streamed (or ended before a limit) are cut here.
+        """
+        if self.finish_reason:
+            return content, self.finish_reason
+        end, reason = self._find(content)
+        accepted = content[:end]
+        self._emit(accepted[self._emitted:])
+        self.finish_reason = reason or "stop"
+        return accepted, self.finish_reason
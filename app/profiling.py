@@ -0,0 +1,124 @@
+"""On-demand profiling of a live worker: sampled stacks and allocation diffs"""
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _thread_stack(frame) -> List[str]:
+    """Labels of a thread's frames, outermost first"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _task_stack(task: asyncio.Task) -> List[str]:
+    """Labels of a task's coroutine chain, outermost first (follows what each coroutine awaits)"""
+    labels = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        labels.append(_frame_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return labels
+
+
+class StackSampler:
+    """
+    Wall-clock sampling profiler over all threads and event-loop tasks.
+
+    Every `interval` seconds the sampler thread records the stack of each
+    other thread (sys._current_frames) and of each asyncio task of `loop`,
+    and counts identical stacks. Nothing runs in the profiled threads.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, interval: float = 0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Dict[str, int] = collections.Counter()
+
+    def run(self, seconds: float):
+        """Sample for `seconds` (blocks; run it off the event loop)"""
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._add(f"thread:{names.get(thread_id, thread_id)}", _thread_stack(frame))
+            if self.loop is not None:
+                try:
+                    tasks = list(asyncio.all_tasks(self.loop))
+                except RuntimeError:
+                    # The task set changed while being copied; catch it next time
+                    tasks = []
+                for task in tasks:
+                    stack = _task_stack(task)
+                    if stack:
+                        self._add(f"task:{task.get_name()}", stack)
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def _add(self, root: str, stack: List[str]):
+        # Collapsed format: the count follows the last space, so frames may contain spaces
+        self.stacks[";".join([root] + stack)] += 1
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope"""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+def heap_diff(seconds: float, limit: int = 25, frames: int = 10, group_by: str = "lineno") -> Dict:
+    """
+    Top allocation sites by growth over `seconds` (blocks; run it off the event loop)
+
+    tracemalloc is started for the window if it is not already tracing.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        traced, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    diffs = after.compare_to(before, group_by)
+    return {
+        "seconds": seconds,
+        "group_by": group_by,
+        "started_tracing": started,
+        "traced_bytes": traced,
+        "peak_bytes": peak,
+        "top": [
+            {
+                "site": [f"{frame.filename}:{frame.lineno}" for frame in diff.traceback],
+                "size_diff_bytes": diff.size_diff,
+                "size_bytes": diff.size,
+                "count_diff": diff.count_diff,
+                "count": diff.count
+            }
+            for diff in diffs[:limit]
+        ]
+    }
@@ -0,0 +1,288 @@
+"""Per-API-key rate limits, fair scheduling and usage accounting"""
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ANONYMOUS_KEY = "anonymous"
+
+# Per-key state kept at most (least recently used keys are dropped)
+MAX_TRACKED_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "1000"))
+
+# Lower rank is served first when the upstream is saturated
+PRIORITY_RANKS = {"interactive": 0, "batch": 1}
+
+
+def key_id(api_key: Optional[str]) -> str:
+    """Stable, non-secret identifier for an API key (safe to log and expose)"""
+    if not api_key or api_key == ANONYMOUS_KEY:
+        return ANONYMOUS_KEY
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if available now)"""
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        """Take tokens unconditionally; the bucket may go into debt"""
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        """Give back tokens taken in excess, never beyond capacity"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class KeyLimits:
+    """Request and token limits for a single key"""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, weight: float = 1.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.weight = weight
+
+
+class RateLimiter:
+    """
+    Per-key token buckets for requests and estimated tokens.
+
+    RATE_LIMIT_RPM / RATE_LIMIT_TPM set the default limits (0 means
+    unlimited); API_KEY_LIMITS is a JSON object mapping keys to
+    {"rpm": ..., "tpm": ..., "weight": ...} overrides. Only keys listed
+    there get buckets of their own: any other key, or none, shares the
+    anonymous bucket, so inventing new keys does not buy new limits.
+    """
+
+    def __init__(self, default: KeyLimits, overrides: Optional[Dict[str, KeyLimits]] = None, max_keys: int = MAX_TRACKED_KEYS):
+        self.default = default
+        self.overrides = overrides or {}
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        default = KeyLimits(
+            rpm=float(os.getenv("RATE_LIMIT_RPM", "0")),
+            tpm=float(os.getenv("RATE_LIMIT_TPM", "0")),
+        )
+        overrides = {
+            key: KeyLimits(
+                rpm=float(limits.get("rpm", default.rpm)),
+                tpm=float(limits.get("tpm", default.tpm)),
+                weight=float(limits.get("weight", 1.0)),
+            )
+            for key, limits in json.loads(os.getenv("API_KEY_LIMITS", "") or "{}").items()
+        }
+        return cls(default, overrides)
+
+    def resolve(self, api_key: Optional[str]) -> str:
+        """The key whose limits apply: `api_key` if configured, else the anonymous key"""
+        return api_key if api_key in self.overrides else ANONYMOUS_KEY
+
+    def limits_for(self, api_key: str) -> KeyLimits:
+        return self.overrides.get(api_key, self.default)
+
+    def _buckets_for(self, api_key: str) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        api_key = self.resolve(api_key)
+        buckets = self._buckets.get(api_key)
+        if buckets is None:
+            limits = self.limits_for(api_key)
+            buckets = (
+                TokenBucket(limits.rpm / 60.0, limits.rpm) if limits.rpm else None,
+                TokenBucket(limits.tpm / 60.0, limits.tpm) if limits.tpm else None,
+            )
+            self._buckets[api_key] = buckets
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(api_key)
+        return buckets
+
+    def check(self, api_key: str, estimated_tokens: int) -> float:
+        """
+        Admit a request or tell the caller how long to back off.
+
+        Returns:
+            0 if the request was admitted (and charged), otherwise the number
+            of seconds to wait before retrying
+        """
+        requests_bucket, tokens_bucket = self._buckets_for(api_key)
+        wait = 0.0
+        if requests_bucket:
+            wait = max(wait, requests_bucket.wait_time(1))
+        if tokens_bucket:
+            # Never ask for more than a full bucket, or large requests could never pass
+            wait = max(wait, tokens_bucket.wait_time(min(estimated_tokens, tokens_bucket.capacity)))
+        if wait > 0:
+            return wait
+
+        if requests_bucket:
+            requests_bucket.consume(1)
+        if tokens_bucket:
+            tokens_bucket.consume(estimated_tokens)
+        return 0.0
+
+    def settle(self, api_key: str, estimated_tokens: int, actual_tokens: int):
+        """
+        Correct the estimate charged by check() once the real count is known
+
+        The difference is charged if the request used more, and refunded if
+        it used less; the tokens are never charged twice.
+        """
+        _, tokens_bucket = self._buckets_for(api_key)
+        if tokens_bucket:
+            if actual_tokens > estimated_tokens:
+                tokens_bucket.consume(actual_tokens - estimated_tokens)
+            else:
+                tokens_bucket.refund(estimated_tokens - actual_tokens)
+
+
+class FairScheduler:
+    """
+    Weighted fair queueing between keys once upstream concurrency is saturated.
+
+    While slots are free, requests run immediately. Otherwise each request is
+    queued with a virtual finish tag (start + cost / weight) per key, and freed
+    slots go to the lowest (priority class, finish tag), so a key with many
+    queued requests cannot starve the others.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.active = 0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._queue: List = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def _release(self):
+        while self._queue:
+            _, finish_tag, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self._virtual_time = max(self._virtual_time, finish_tag)
+            future.set_result(None)
+            return
+        self.active -= 1
+        # Nothing waits: tags at or below the virtual time no longer affect anyone
+        self._last_finish = {key: tag for key, tag in self._last_finish.items() if tag > self._virtual_time}
+
+    @asynccontextmanager
+    async def slot(self, key: str, weight: float = 1.0, priority: str = "interactive", cost: float = 1.0):
+        """Hold one upstream slot for the duration of a request"""
+        if self.active < self.capacity and not self._queue:
+            self.active += 1
+        else:
+            start_tag = max(self._virtual_time, self._last_finish.get(key, 0.0))
+            finish_tag = start_tag + cost / max(weight, 1e-6)
+            self._last_finish[key] = finish_tag
+            future = asyncio.get_running_loop().create_future()
+            rank = PRIORITY_RANKS.get(priority, 0)
+            heapq.heappush(self._queue, (rank, finish_tag, next(self._seq), future))
+            try:
+                # The slot is handed over (active count unchanged) by _release
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict:
+        return {"capacity": self.capacity, "active": self.active, "queued": self.queued}
+
+
+class UsageTracker:
+    """
+    In-memory per-key usage counters, flushed periodically.
+
+    Recording is a dict update only; counters are written out (to
+    USAGE_LOG_FILE as JSON lines, or the log) by a background task.
+    """
+
+    FIELDS = ("requests", "rejected", "prompt_tokens", "completion_tokens")
+
+    def __init__(self, log_file: Optional[str] = None, flush_interval: float = 60.0, max_keys: int = MAX_TRACKED_KEYS):
+        self.log_file = log_file
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        # Totals since startup, least recently used keys first (the log keeps the full record)
+        self._totals: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self._pending: Dict[str, Dict[str, int]] = {}
+
+    @classmethod
+    def from_env(cls) -> "UsageTracker":
+        return cls(
+            log_file=os.getenv("USAGE_LOG_FILE") or None,
+            flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", "60")),
+        )
+
+    def record(self, key: str, **counts: int):
+        for counters in (self._totals, self._pending):
+            entry = counters.get(key)
+            if entry is None:
+                entry = counters[key] = dict.fromkeys(self.FIELDS, 0)
+            for name, value in counts.items():
+                entry[name] += value
+        self._totals.move_to_end(key)
+        while len(self._totals) > self.max_keys:
+            self._totals.popitem(last=False)
+
+    def flush(self):
+        """Write out counters accumulated since the last flush"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        record = {"timestamp": int(time.time()), "usage": pending}
+        if self.log_file:
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        else:
+            logger.info(f"Usage: {json.dumps(pending)}")
+
+    async def run(self):
+        """Flush periodically until cancelled"""
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self.flush()
+        finally:
+            self.flush()
+
+    def stats(self) -> Dict:
+        return {"keys": dict(self._totals)}
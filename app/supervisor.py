@@ -0,0 +1,299 @@
+"""
+Production launcher - one uvicorn worker process per core, supervised
+
+Workers are separate processes, so each has its own conversations, rate
+limit counters and browsers. Multi-worker mode suits clients that send the
+full message list with every request (the OpenAI convention, reconciled
+into history by each worker) and sticky connections such as /v1/chat/ws.
+"""
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _best_loop() -> str:
+    try:
+        import uvloop  # noqa: F401
+        return "uvloop"
+    except ImportError:
+        return "asyncio"
+
+
+def _best_http() -> str:
+    try:
+        import httptools  # noqa: F401
+        return "httptools"
+    except ImportError:
+        return "h11"
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process, or None where it cannot be read"""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def bind_socket(host: str, port: int, backlog: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _serve(options: Dict, shared: Optional[socket.socket], served, ready):
+    """
+    Worker process: serve the app on its own SO_REUSEPORT socket or the shared one
+
+    `served` counts requests and WebSocket sessions; `ready` is set once the
+    app's startup has completed.
+    """
+    import uvicorn
+    from app.main import app
+
+    async def counted(scope, receive, send):
+        if scope["type"] == "lifespan":
+            async def send_ready(message):
+                if message["type"] == "lifespan.startup.complete":
+                    ready.set()
+                await send(message)
+            return await app(scope, receive, send_ready)
+        with served.get_lock():
+            served.value += 1
+        await app(scope, receive, send)
+
+    sock = shared or bind_socket(options["host"], options["port"], options["backlog"], reuse_port=True)
+    config = uvicorn.Config(
+        counted,
+        loop=options["loop"],
+        http=options["http"],
+        backlog=options["backlog"],
+        timeout_keep_alive=options["keepalive"],
+        timeout_graceful_shutdown=options["graceful_timeout"],
+        log_level=options["log_level"]
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class _Worker:
+    """A worker process and what the supervisor tracks about it"""
+
+    def __init__(self, context, options: Dict, shared: Optional[socket.socket], max_requests: int):
+        self.served = context.Value("q", 0)
+        self.ready = context.Event()
+        self.max_requests = max_requests
+        self.replacement: Optional["_Worker"] = None
+        self.stop_deadline: Optional[float] = None
+        self.process = context.Process(
+            target=_serve,
+            args=(options, shared, self.served, self.ready),
+            name="chat-api-worker"
+        )
+        self.process.start()
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def retire_reason(self, max_rss_mb: int) -> Optional[str]:
+        if self.max_requests and self.served.value >= self.max_requests:
+            return f"served {self.served.value} requests"
+        if max_rss_mb:
+            rss = rss_bytes(self.pid)
+            if rss is not None and rss > max_rss_mb * 1024 * 1024:
+                return f"uses {rss / 1048576:.0f} MB (limit {max_rss_mb} MB)"
+        return None
+
+
+class Supervisor:
+    """
+    Starts `workers` uvicorn processes and keeps that many running.
+
+    With SO_REUSEPORT (Linux) every worker binds its own listening socket
+    and the kernel spreads connections across them; elsewhere the workers
+    share one socket bound here. A worker is retired after `max_requests`
+    requests (plus up to `max_requests_jitter`, so workers do not retire
+    together) or once its RSS passes `max_rss_mb`: a replacement is started
+    first, and when its app is up the old worker gets SIGTERM and finishes
+    in-flight requests for up to `graceful_timeout` seconds. Requests still
+    running after that, open WebSocket sessions and the old worker's
+    in-memory state (conversations, jobs) are lost. Workers (and pending
+    replacements) that die are restarted.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        workers: Optional[int] = None,
+        backlog: int = 2048,
+        keepalive: int = 75,
+        max_requests: int = 0,
+        max_requests_jitter: int = 0,
+        max_rss_mb: int = 0,
+        graceful_timeout: int = 30,
+        log_level: str = "info"
+    ):
+        self.workers = workers or _available_cores()
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_rss_mb = max_rss_mb
+        # Other platforms accept SO_REUSEPORT without spreading connections across sockets
+        self.reuse_port = sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+        self.options = {
+            "host": host,
+            "port": port,
+            "backlog": backlog,
+            "keepalive": keepalive,
+            "graceful_timeout": graceful_timeout,
+            "loop": _best_loop(),
+            "http": _best_http(),
+            "log_level": log_level
+        }
+        self.restarts = 0
+        self._workers: List[_Worker] = []
+        self._stopping_workers: List[_Worker] = []
+        self._shared: Optional[socket.socket] = None
+        self._stopping = False
+        # Spawned workers import the app fresh instead of inheriting the supervisor's state
+        self._context = multiprocessing.get_context("spawn")
+
+    @classmethod
+    def from_env(cls, host: str, port: int, workers: Optional[int] = None) -> "Supervisor":
+        """Build from WEB_CONCURRENCY, WEB_BACKLOG, WEB_KEEPALIVE, WEB_MAX_REQUESTS(_JITTER), WEB_MAX_RSS_MB and WEB_GRACEFUL_TIMEOUT"""
+        return cls(
+            host=host,
+            port=port,
+            workers=workers or int(os.getenv("WEB_CONCURRENCY", "0")) or None,
+            backlog=int(os.getenv("WEB_BACKLOG", "2048")),
+            keepalive=int(os.getenv("WEB_KEEPALIVE", "75")),
+            max_requests=int(os.getenv("WEB_MAX_REQUESTS", "0")),
+            max_requests_jitter=int(os.getenv("WEB_MAX_REQUESTS_JITTER", "0")),
+            max_rss_mb=int(os.getenv("WEB_MAX_RSS_MB", "0")),
+            graceful_timeout=int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30")),
+            log_level=os.getenv("LOG_LEVEL", "info").lower()
+        )
+
+    def describe(self) -> str:
+        return (
+            f"{self.workers} workers, {self.options['loop']} loop, {self.options['http']} parser, "
+            f"{'SO_REUSEPORT' if self.reuse_port else 'shared socket'}, backlog {self.options['backlog']}, "
+            f"keep-alive {self.options['keepalive']}s"
+        )
+
+    def _spawn(self) -> _Worker:
+        max_requests = 0
+        if self.max_requests:
+            max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        return _Worker(self._context, self.options, self._shared, max_requests)
+
+    def run(self):
+        """Run until SIGINT/SIGTERM, then stop the workers gracefully"""
+        if not self.reuse_port:
+            self._shared = bind_socket(self.options["host"], self.options["port"], self.options["backlog"], reuse_port=False)
+        else:
+            # Fail here, not in every worker, if the port is taken by something else
+            bind_socket(self.options["host"], self.options["port"], self.options["backlog"], reuse_port=True).close()
+
+        def stop(signum, frame):
+            self._stopping = True
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        logger.info(f"Supervisor {os.getpid()}: {self.describe()}")
+        self._workers = [self._spawn() for _ in range(self.workers)]
+
+        while True:
+            time.sleep(0.5)
+            if self._stopping:
+                break
+            self._check()
+        self._shutdown()
+
+    def _check(self):
+        for worker in list(self._workers):
+            if not worker.process.is_alive():
+                self._workers.remove(worker)
+                worker.process.join()
+                if worker.replacement:
+                    self._workers.append(worker.replacement)
+                else:
+                    logger.warning(f"Worker {worker.pid} exited ({worker.process.exitcode}), starting a replacement")
+                    self._workers.append(self._spawn())
+                self.restarts += 1
+            elif worker.replacement is None:
+                reason = worker.retire_reason(self.max_rss_mb)
+                if reason:
+                    logger.info(f"Worker {worker.pid} {reason}, starting its replacement")
+                    worker.replacement = self._spawn()
+            elif not worker.replacement.process.is_alive():
+                replacement = worker.replacement
+                replacement.process.join()
+                logger.warning(
+                    f"Replacement worker {replacement.pid} exited ({replacement.process.exitcode}) before it was ready, "
+                    f"starting another"
+                )
+                worker.replacement = self._spawn()
+            elif worker.replacement.ready.is_set():
+                self._workers.remove(worker)
+                self._workers.append(worker.replacement)
+                self._stop(worker)
+                self.restarts += 1
+
+        for worker in list(self._stopping_workers):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self._stopping_workers.remove(worker)
+            elif time.monotonic() > worker.stop_deadline:
+                logger.warning(f"Worker {worker.pid} did not stop in time, killing it")
+                worker.process.kill()
+
+    def _stop(self, worker: _Worker):
+        """SIGTERM: uvicorn stops accepting and finishes in-flight requests"""
+        worker.process.terminate()
+        worker.stop_deadline = time.monotonic() + self.options["graceful_timeout"] + 5
+        self._stopping_workers.append(worker)
+
+    def _shutdown(self):
+        logger.info("Supervisor stopping workers")
+        workers = self._workers + [w.replacement for w in self._workers if w.replacement] + self._stopping_workers
+        for worker in workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + self.options["graceful_timeout"] + 5
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        if self._shared:
+            self._shared.close()
@@ -0,0 +1,277 @@
+"""
+Lightweight request tracing - per-stage spans, Server-Timing and OTLP JSON export
+
+A sampled request gets a trace; `span()` records a stage of it wherever the
+request's context reaches (including threadpool threads). Unsampled requests
+only pay for a context-variable lookup per span.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+def now() -> int:
+    """Timestamp for add_span (nanoseconds since the epoch)"""
+    return time.time_ns()
+
+
+class Span:
+    """One timed stage of a trace"""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error", "_token")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict, start_ns: Optional[int] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current.reset(self._token)
+        self.trace.spans.append(self)
+        return False
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if self is self.trace.root else 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """Stands in for a span when the request is not sampled"""
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Trace:
+    """Spans of one sampled request"""
+
+    def __init__(self, trace_id: Optional[str] = None, remote_parent_id: Optional[str] = None):
+        self.trace_id = trace_id or f"{random.getrandbits(128):032x}"
+        self.remote_parent_id = remote_parent_id
+        self.spans: List[Span] = []
+        self.root: Optional[Span] = None
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.root.span_id}-01"
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: total time per stage name, plus the whole request"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            if span is not self.root:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration_ms
+        entries = [f"{name};dur={duration:.1f}" for name, duration in totals.items()]
+        entries.append(f"total;dur={self.root.duration_ms:.1f}")
+        return ", ".join(entries)
+
+
+def span(name: str, **attributes):
+    """
+    Time a stage of the current request: `with span("stage", key=value) as s:`
+
+    A no-op unless the request is being traced.
+    """
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def add_span(name: str, start_ns: int, **attributes):
+    """Record a stage that started at `start_ns` (from now()) and ends now"""
+    parent = _current.get()
+    if parent is None:
+        return
+    completed = Span(parent.trace, name, parent.span_id, attributes, start_ns)
+    completed.end_ns = time.time_ns()
+    parent.trace.spans.append(completed)
+
+
+def _otlp_attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Tracer:
+    """
+    Samples requests and exports finished traces.
+
+    A request is traced when an incoming W3C `traceparent` header says it is
+    sampled, or with probability `sample_rate`. Traces are written as OTLP
+    JSON (one ExportTraceServiceRequest per line) to a rotating file by a
+    background thread.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        export_file: Optional[str] = None,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 3,
+        service_name: str = "chat-api-wrapper"
+    ):
+        self.sample_rate = sample_rate
+        self.export_file = export_file
+        self.resource = {"attributes": [_otlp_attribute("service.name", service_name)]}
+        self.sampled = 0
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._export_logger: Optional[logging.Logger] = None
+        if export_file:
+            records: queue.Queue = queue.Queue(-1)
+            file_handler = logging.handlers.RotatingFileHandler(export_file, maxBytes=max_bytes, backupCount=backups)
+            file_handler.setFormatter(logging.Formatter("%(message)s"))
+            self._listener = logging.handlers.QueueListener(records, file_handler)
+            self._listener.start()
+            self._export_logger = logging.getLogger(f"{__name__}.export")
+            self._export_logger.propagate = False
+            self._export_logger.setLevel(logging.INFO)
+            self._export_logger.addHandler(logging.handlers.QueueHandler(records))
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        """Build from TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_FILE_MAX_BYTES and TRACE_FILE_BACKUPS"""
+        return cls(
+            sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0")),
+            export_file=os.getenv("TRACE_FILE") or None,
+            max_bytes=int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024))),
+            backups=int(os.getenv("TRACE_FILE_BACKUPS", "3")),
+            service_name=os.getenv("TRACE_SERVICE_NAME", "chat-api-wrapper")
+        )
+
+    def begin(self, name: str, traceparent: Optional[str] = None) -> Optional[Trace]:
+        """Start a trace with a root span in the current context, or None if not sampled"""
+        trace = None
+        match = _TRACEPARENT.match(traceparent.strip().lower()) if traceparent else None
+        if match and int(match.group(3), 16) & 1:
+            trace = Trace(match.group(1), match.group(2))
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            trace = Trace()
+        if trace is None:
+            return None
+        self.sampled += 1
+        trace.root = Span(trace, name, trace.remote_parent_id, {}).__enter__()
+        return trace
+
+    def finish(self, trace: Trace, **attributes):
+        """End the root span and export the trace"""
+        trace.root.set(**attributes)
+        trace.root.__exit__(None, None, None)
+        if self._export_logger:
+            self._export_logger.info(json.dumps({
+                "resourceSpans": [{
+                    "resource": self.resource,
+                    "scopeSpans": [{
+                        "scope": {"name": __name__},
+                        "spans": [span.to_otlp() for span in trace.spans]
+                    }]
+                }]
+            }, separators=(",", ":")))
+
+    def close(self):
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that traces sampled HTTP requests.
+
+    Traced responses carry a Server-Timing header summarizing the stages and
+    a traceparent header with the trace ID.
+    """
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        trace = self.tracer.begin(f"{scope['method']} {scope['path']}", traceparent)
+        if trace is None:
+            return await self.app(scope, receive, send)
+
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", trace.server_timing().encode("latin-1")),
+                    (b"traceparent", trace.traceparent().encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            if status["code"] >= 500:
+                trace.root.error = f"HTTP {status['code']}"
+            self.tracer.finish(trace, **{"http.method": scope["method"], "http.target": scope["path"], "http.status_code": status["code"]})
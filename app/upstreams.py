@@ -0,0 +1,233 @@
+"""Upstream pool - load balancing across several chat backends or accounts"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from app.cancellation import DeadlineExceeded, RequestCancelled
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Upstream:
+    """A single upstream chat target with its own credentials and limits"""
+    name: str
+    url: str
+    api_endpoint: str = ""
+    headers: Dict[str, str] = field(default_factory=dict)
+    cookies: Dict[str, str] = field(default_factory=dict)
+    max_concurrency: int = 32
+
+    # Runtime state
+    outstanding: int = 0
+    total_requests: int = 0
+    total_failures: int = 0
+    consecutive_failures: int = 0
+    ejected_until: float = 0.0
+    latency_ewma: Optional[float] = None
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+    @property
+    def saturated(self) -> bool:
+        return self.outstanding >= self.max_concurrency
+
+    def stats(self) -> Dict:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejected": self.ejected,
+            "latency_ewma_seconds": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+        }
+
+
+class UpstreamPool:
+    """
+    Routes requests across upstreams.
+
+    Picks the least-loaded healthy upstream (least outstanding requests or
+    power-of-two-choices), keeps conversations sticky to the upstream that
+    holds their history, and ejects upstreams after repeated failures.
+    """
+
+    STRATEGIES = ("least_outstanding", "p2c")
+
+    def __init__(
+        self,
+        upstreams: List[Upstream],
+        strategy: str = "least_outstanding",
+        eject_after: int = 3,
+        eject_seconds: float = 30.0,
+    ):
+        if not upstreams:
+            raise ValueError("At least one upstream must be configured")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.upstreams = upstreams
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._by_name = {u.name: u for u in upstreams}
+        self._sticky: Dict[str, str] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    @classmethod
+    def from_env(cls) -> "UpstreamPool":
+        """
+        Build the pool from the environment.
+
+        CHAT_UPSTREAMS (JSON list) or CHAT_UPSTREAMS_FILE (path to a JSON list)
+        configure several upstreams; otherwise a single upstream is built from
+        CHAT_WEBSITE_URL / CHAT_API_ENDPOINT.
+        """
+        raw = os.getenv("CHAT_UPSTREAMS", "")
+        path = os.getenv("CHAT_UPSTREAMS_FILE", "")
+        if not raw and path:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = f.read()
+
+        if raw:
+            upstreams = [
+                Upstream(
+                    name=entry.get("name") or f"upstream-{i}",
+                    url=entry["url"].rstrip("/"),
+                    api_endpoint=entry.get("api_endpoint", ""),
+                    headers=entry.get("headers", {}),
+                    cookies=entry.get("cookies", {}),
+                    max_concurrency=int(entry.get("max_concurrency", 32)),
+                )
+                for i, entry in enumerate(json.loads(raw))
+            ]
+        else:
+            upstreams = [
+                Upstream(
+                    name="default",
+                    url=settings.chat_website_url,
+                    api_endpoint=settings.chat_api_endpoint,
+                    max_concurrency=int(os.getenv("CHAT_MAX_CONCURRENCY", "32")),
+                )
+            ]
+
+        return cls(
+            upstreams,
+            strategy=os.getenv("CHAT_ROUTING", "least_outstanding"),
+            eject_after=int(os.getenv("UPSTREAM_EJECT_AFTER", "3")),
+            eject_seconds=float(os.getenv("UPSTREAM_EJECT_SECONDS", "30")),
+        )
+
+    @property
+    def capacity(self) -> int:
+        """Total concurrency across all upstreams"""
+        return sum(u.max_concurrency for u in self.upstreams)
+
+    def get(self, name: str) -> Optional[Upstream]:
+        return self._by_name.get(name)
+
+    def sticky_upstream(self, conversation_id: str) -> Optional[Upstream]:
+        """Upstream the conversation is bound to, if any"""
+        name = self._sticky.get(conversation_id)
+        return self._by_name.get(name) if name else None
+
+    def bind(self, conversation_id: str, upstream: Upstream):
+        self._sticky[conversation_id] = upstream.name
+
+    def release_conversation(self, conversation_id: str):
+        self._sticky.pop(conversation_id, None)
+
+    def _pick(self, conversation_id: Optional[str], rebindable: bool) -> Optional[Upstream]:
+        """Pick an upstream with free capacity, or None if all are saturated"""
+        sticky = self.sticky_upstream(conversation_id) if conversation_id else None
+        if sticky and (not sticky.ejected or not rebindable):
+            return None if sticky.saturated else sticky
+
+        healthy = [u for u in self.upstreams if not u.ejected]
+        # If everything is ejected, route anyway rather than fail every request
+        candidates = [u for u in (healthy or self.upstreams) if not u.saturated]
+        if not candidates:
+            return None
+
+        if self.strategy == "p2c" and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda u: (u.outstanding / u.max_concurrency, random.random()))
+
+    @asynccontextmanager
+    async def acquire(self, conversation_id: Optional[str] = None, rebindable: bool = True):
+        """
+        Reserve a slot on an upstream for the duration of one request.
+
+        Args:
+            conversation_id: Conversation to keep sticky
+            rebindable: Whether the conversation may move to another upstream
+                when its sticky upstream has been ejected
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            upstream = self._pick(conversation_id, rebindable)
+            while upstream is None:
+                await self._condition.wait()
+                upstream = self._pick(conversation_id, rebindable)
+            upstream.outstanding += 1
+
+        if conversation_id:
+            previous = self.sticky_upstream(conversation_id)
+            if previous and previous is not upstream:
+                logger.warning(f"Conversation {conversation_id} moved from ejected {previous.name} to {upstream.name}")
+            self.bind(conversation_id, upstream)
+
+        start_time = time.monotonic()
+        try:
+            yield upstream
+        except (asyncio.CancelledError, RequestCancelled, DeadlineExceeded):
+            # The caller went away or ran out of time; that says nothing about the upstream
+            raise
+        except BaseException:
+            self.record_failure(upstream)
+            raise
+        else:
+            self.record_success(upstream, time.monotonic() - start_time)
+        finally:
+            async with self._condition:
+                upstream.outstanding -= 1
+                self._condition.notify_all()
+
+    def record_success(self, upstream: Upstream, latency: float):
+        upstream.total_requests += 1
+        upstream.consecutive_failures = 0
+        upstream.ejected_until = 0.0
+        if upstream.latency_ewma is None:
+            upstream.latency_ewma = latency
+        else:
+            upstream.latency_ewma = 0.8 * upstream.latency_ewma + 0.2 * latency
+
+    def record_failure(self, upstream: Upstream):
+        upstream.total_requests += 1
+        upstream.total_failures += 1
+        upstream.consecutive_failures += 1
+        if upstream.consecutive_failures >= self.eject_after:
+            upstream.ejected_until = time.monotonic() + self.eject_seconds
+            logger.warning(f"Ejecting upstream {upstream.name} for {self.eject_seconds:.0f}s "
+                           f"after {upstream.consecutive_failures} consecutive failures")
+
+    def stats(self) -> Dict:
+        return {
+            "strategy": self.strategy,
+            "capacity": self.capacity,
+            "sticky_conversations": len(self._sticky),
+            "upstreams": [u.stats() for u in self.upstreams],
+        }
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Memory benchmark: bytes per stored conversation
+
+Compares the old list-of-dicts history with app.history.History for many
+live conversations that share a few common prompts (as agent frameworks
+send them). Run from the project root:
+
+    python benchmarks/bench_history_memory.py [conversations] [turns]
+"""
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.history import History  # noqa: E402
+
+SHARED_PROMPTS = [
+    "You are a thorough research expert. Research the latest trends in AI/ML "
+    "and summarize them for a technical audience.",
+    "You are an expert analyst. Analyze the research findings and provide "
+    "the key insights as a bulleted list.",
+]
+
+
+def _fresh(text: str) -> str:
+    """A new string object, as produced by parsing each request's JSON"""
+    return "".join(list(text))
+
+
+def _turns(conversation: int, turns: int):
+    for turn in range(turns):
+        if turn < len(SHARED_PROMPTS):
+            user = _fresh(SHARED_PROMPTS[turn])
+        else:
+            user = f"Follow-up question {turn} in conversation {conversation}: please expand on point {turn}."
+        yield user, f"Answer {turn} for conversation {conversation}. " + "Lorem ipsum dolor sit amet. " * 8
+
+
+def build_dict_histories(conversations: int, turns: int):
+    histories = []
+    for c in range(conversations):
+        history = []
+        for user, assistant in _turns(c, turns):
+            history.append({"role": _fresh("user"), "content": user})
+            history.append({"role": _fresh("assistant"), "content": assistant})
+        histories.append(history)
+    return histories
+
+
+def build_compact_histories(conversations: int, turns: int):
+    histories = []
+    for c in range(conversations):
+        history = History()
+        for user, assistant in _turns(c, turns):
+            history = history.append(_fresh("user"), user).append(_fresh("assistant"), assistant)
+        histories.append(history)
+    return histories
+
+
+def measure(builder, conversations: int, turns: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    histories = builder(conversations, turns)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del histories
+    return current / conversations
+
+
+def main():
+    conversations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+
+    print("=" * 60)
+    print(f"History memory: {conversations} conversations x {turns} turns")
+    print("=" * 60)
+    before = measure(build_dict_histories, conversations, turns)
+    after = measure(build_compact_histories, conversations, turns)
+    print(f"list of dicts : {before:10.0f} bytes/conversation")
+    print(f"History       : {after:10.0f} bytes/conversation")
+    print(f"saving        : {100 * (1 - after / before):9.1f}%")
+
+
+if __name__ == "__main__":
+    main()
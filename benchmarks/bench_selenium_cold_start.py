@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Selenium cold-start benchmark: time from launch to a usable chat input
+
+Launches a fresh browser per run for each launch profile and reports how
+long ChatSeleniumClient takes to become ready. Needs Chrome and a
+reachable chat page. Run from the project root:
+
+    python benchmarks/bench_selenium_cold_start.py [url] [runs]
+
+Set SELENIUM_USER_DATA_TEMPLATE to include a pre-seeded profile.
+"""
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.clients.browser_host import BrowserHost  # noqa: E402
+from app.clients.chat_selenium_client import ChatSeleniumClient  # noqa: E402
+
+
+def cold_start(url: str, profile: str) -> float:
+    host = BrowserHost(
+        headless=True,
+        tabs_per_browser=1,
+        max_browsers=1,
+        profile=profile,
+        user_data_template=os.getenv("SELENIUM_USER_DATA_TEMPLATE") or None
+    )
+    start = time.perf_counter()
+    client = ChatSeleniumClient(headless=True, base_url=url, host=host)
+    elapsed = time.perf_counter() - start
+    client.close()
+    host.close()
+    return elapsed
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else os.getenv("CHAT_WEBSITE_URL", "https://example-chat.com")
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print("=" * 60)
+    print(f"Selenium cold start: {url} ({runs} runs per profile)")
+    print("=" * 60)
+    for profile in ("default", "performance"):
+        timings = [cold_start(url, profile) for _ in range(runs)]
+        print(f"{profile:12s} median {statistics.median(timings):6.2f}s  "
+              f"min {min(timings):6.2f}s  max {max(timings):6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
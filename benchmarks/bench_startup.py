@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Startup benchmark: import-to-ready time and import-time RSS of a worker
+
+Imports app.main and runs the application lifespan startup in a fresh
+interpreter, then fails (exit code 1) if either exceeds its budget.
+Run from the project root:
+
+    python benchmarks/bench_startup.py [--max-seconds 2.0] [--max-rss-mb 120] [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Runs in a fresh interpreter so nothing is already imported
+_CHILD = r"""
+import asyncio, json, sys, time
+start = time.perf_counter()
+import app.main as main
+
+async def _ready():
+    async with main.lifespan(main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(_ready())
+rss_kb = 0
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({
+    "seconds": ready - start,
+    "rss_mb": rss_kb / 1024,
+    "selenium_loaded": "selenium" in sys.modules
+}))
+"""
+
+
+def measure() -> dict:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    result = subprocess.run(
+        [sys.executable, "-c", _CHILD],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--max-seconds", type=float, default=float(os.getenv("STARTUP_BUDGET_SECONDS", "2.0")))
+    parser.add_argument("--max-rss-mb", type=float, default=float(os.getenv("STARTUP_BUDGET_RSS_MB", "120")))
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = [measure() for _ in range(args.runs)]
+    seconds = statistics.median(s["seconds"] for s in samples)
+    rss_mb = statistics.median(s["rss_mb"] for s in samples)
+
+    print("=" * 60)
+    print(f"Startup ({args.runs} runs, median)")
+    print("=" * 60)
+    print(f"import-to-ready : {seconds:6.3f}s  (budget {args.max_seconds:.3f}s)")
+    print(f"RSS after start : {rss_mb:6.1f}MB (budget {args.max_rss_mb:.1f}MB)")
+    print(f"selenium loaded : {samples[0]['selenium_loaded']}")
+
+    over = []
+    if seconds > args.max_seconds:
+        over.append("time")
+    if rss_mb > args.max_rss_mb:
+        over.append("RSS")
+    if over:
+        print(f"FAIL: over budget ({', '.join(over)})")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Transport benchmark: connections and bytes on the wire per upstream transport
+
+Runs concurrent conversations with long histories against the local fake
+upstream (benchmarks/fake_upstream.py) with:
+
+  http1        one requests session per conversation, nothing compressed
+  http1+gzip   the same with compressed requests and responses
+  http2+gzip   one shared HTTP/2 session (h2c), compressed both ways
+
+Each configuration runs in a fresh interpreter since settings are read from
+the environment at import. Run from the project root:
+
+    python benchmarks/bench_transport.py [--conversations 64] [--turns 4] [--history-kb 32]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CONFIGS = {
+    "http1": {"CHAT_HTTP2": "false", "CHAT_COMPRESS_MIN_BYTES": "0"},
+    "http1+gzip": {"CHAT_HTTP2": "false", "CHAT_COMPRESS_MIN_BYTES": "16384"},
+    "http2+gzip": {"CHAT_HTTP2": "true", "CHAT_COMPRESS_MIN_BYTES": "16384"},
+}
+
+
+def run_config(args) -> dict:
+    """Run one configuration in this process (settings come from the environment)"""
+    sys.path.insert(0, str(ROOT))
+    sys.path.insert(0, str(ROOT / "benchmarks"))
+    import logging
+    import fake_upstream
+    from app.clients.chat_http_client import ChatHTTPClient
+    from app.clients.transport import HTTP2Session
+    from app.config import settings
+    from app.history import History
+    logging.disable(logging.INFO)
+
+    server, base_url = fake_upstream.start(http2=settings.chat_http2, delay=args.delay)
+    shared = HTTP2Session(prior_knowledge=True, max_connections=settings.chat_http2_max_connections) if settings.chat_http2 else None
+
+    filler = "Earlier context that the upstream needs to see again. " * 20
+    history = History()
+    while sum(len(m["content"]) for m in history.to_list()) < args.history_kb * 1024:
+        history = history.append("user", filler).append("assistant", filler)
+
+    def conversation(index: int):
+        client = ChatHTTPClient(conversation_id=f"bench-{index}", base_url=base_url, api_endpoint="/api/chat", session=shared)
+        if not args.compress_responses:
+            client.session.headers["Accept-Encoding"] = "identity"
+        client.set_history(history)
+        for turn in range(args.turns):
+            client.send_message(f"Question {turn} from conversation {index}")
+        client.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.conversations) as executor:
+        list(executor.map(conversation, range(args.conversations)))
+    elapsed = time.perf_counter() - start
+    if shared:
+        shared.close()
+    server.shutdown()
+    return dict(server.counters.snapshot(), seconds=elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--conversations", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--history-kb", type=int, default=32)
+    parser.add_argument("--delay", type=float, default=0.05, help="fake upstream latency (seconds)")
+    parser.add_argument("--child", choices=CONFIGS, help=argparse.SUPPRESS)
+    parser.add_argument("--compress-responses", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_config(args)))
+        return
+
+    print("=" * 72)
+    print(f"Transport ({args.conversations} conversations x {args.turns} turns, {args.history_kb}KB history)")
+    print("=" * 72)
+    print(f"{'config':<12} {'connections':>11} {'requests':>9} {'MB up':>8} {'MB down':>8} {'seconds':>8}")
+    for name, env in CONFIGS.items():
+        command = [
+            sys.executable, __file__, "--child", name,
+            "--conversations", str(args.conversations),
+            "--turns", str(args.turns),
+            "--history-kb", str(args.history_kb),
+            "--delay", str(args.delay)
+        ]
+        if name != "http1":
+            command.append("--compress-responses")
+        result = subprocess.run(
+            command, cwd=ROOT, env=dict(os.environ, **env), capture_output=True, text=True, check=True
+        )
+        r = json.loads(result.stdout.strip().splitlines()[-1])
+        print(
+            f"{name:<12} {r['connections']:>11} {r['requests']:>9} "
+            f"{r['bytes_in'] / 1e6:>8.2f} {r['bytes_out'] / 1e6:>8.2f} {r['seconds']:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Local fake chat upstream for benchmarks
+
+Answers POST /api/chat with a JSON reply after a fixed delay, over HTTP/1.1
+or HTTP/2 with prior knowledge (h2c, needs the h2 package). Gzip request
+bodies are accepted and responses are gzip/brotli-compressed when asked.
+Counts connections and bytes on the wire. Run standalone with:
+
+    python benchmarks/fake_upstream.py [port] [--http2] [--delay 0.05]
+"""
+import argparse
+import gzip
+import io
+import json
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = "This is a reply from the fake upstream. " * 40
+
+
+class Counters:
+    """Connections accepted and bytes received/sent by a fake upstream"""
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict:
+        return {
+            "connections": self.connections,
+            "requests": self.requests,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out
+        }
+
+
+def _reply(body: bytes, content_encoding: str, accept_encoding: str):
+    """Response body and Content-Encoding for a request"""
+    if content_encoding == "gzip":
+        body = gzip.decompress(body)
+    payload = json.loads(body)
+    last = payload["messages"][-1]["content"]
+    out = json.dumps({"message": {"content": f"{REPLY}({len(payload['messages'])}: {last})"}}).encode()
+    if "br" in accept_encoding:
+        try:
+            import brotli
+            return brotli.compress(out), "br"
+        except ImportError:
+            pass
+    if "gzip" in accept_encoding:
+        return gzip.compress(out), "gzip"
+    return out, None
+
+
+class _CountingSocket:
+    """Socket wrapper that counts bytes in both directions"""
+
+    def __init__(self, sock, counters: Counters):
+        self._sock = sock
+        self._counters = counters
+
+    def recv(self, size, *args):
+        data = self._sock.recv(size, *args)
+        self._counters.add(bytes_in=len(data))
+        return data
+
+    def recv_into(self, buffer, *args):
+        size = self._sock.recv_into(buffer, *args)
+        self._counters.add(bytes_in=size)
+        return size
+
+    def sendall(self, data, *args):
+        self._counters.add(bytes_out=len(data))
+        return self._sock.sendall(data, *args)
+
+    def send(self, data, *args):
+        size = self._sock.send(data, *args)
+        self._counters.add(bytes_out=size)
+        return size
+
+    def makefile(self, mode="rb", buffering=-1, **kwargs):
+        # Reads through the wrapper so they are counted; only used for rfile
+        return io.BufferedReader(socket.SocketIO(self, "rb"), buffering if buffering > 0 else io.DEFAULT_BUFFER_SIZE)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _HTTP1Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def get_request(self):
+        sock, address = super().get_request()
+        self.counters.add(connections=1)
+        return _CountingSocket(sock, self.counters), address
+
+
+class _HTTP1Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+        out, encoding = _reply(body, self.headers.get("Content-Encoding", ""), self.headers.get("Accept-Encoding", ""))
+        self.server.counters.add(requests=1)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(out)
+
+
+class _HTTP2Handler(socketserver.BaseRequestHandler):
+    """One h2c connection; each stream is answered on its own thread"""
+
+    def handle(self):
+        import h2.config
+        import h2.connection
+        import h2.events
+
+        counters = self.server.counters
+        counters.add(connections=1)
+        sock = _CountingSocket(self.request, counters)
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        lock = threading.Lock()
+        streams = {}
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+
+        def respond(stream_id, headers, body):
+            time.sleep(self.server.delay)
+            out, encoding = _reply(bytes(body), headers.get("content-encoding", ""), headers.get("accept-encoding", ""))
+            response_headers = [(":status", "200"), ("content-type", "application/json"), ("content-length", str(len(out)))]
+            if encoding:
+                response_headers.append(("content-encoding", encoding))
+            with lock:
+                conn.send_headers(stream_id, response_headers)
+                # Responses fit the default flow-control window
+                conn.send_data(stream_id, out, end_stream=True)
+                sock.sendall(conn.data_to_send())
+            counters.add(requests=1)
+
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            with lock:
+                events = conn.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        streams[event.stream_id] = (dict(event.headers), bytearray())
+                    elif isinstance(event, h2.events.DataReceived):
+                        streams[event.stream_id][1].extend(event.data)
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, body = streams.pop(event.stream_id)
+                        threading.Thread(target=respond, args=(event.stream_id, headers, body), daemon=True).start()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                sock.sendall(conn.data_to_send())
+
+
+class _HTTP2Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(port: int = 0, http2: bool = False, delay: float = 0.05):
+    """
+    Start a fake upstream on a background thread
+
+    Returns:
+        (server, base_url); server.counters holds the traffic counters
+    """
+    if http2:
+        server = _HTTP2Server(("127.0.0.1", port), _HTTP2Handler)
+    else:
+        server = _HTTP1Server(("127.0.0.1", port), _HTTP1Handler)
+    server.counters = Counters()
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("port", type=int, nargs="?", default=9100)
+    parser.add_argument("--http2", action="store_true")
+    parser.add_argument("--delay", type=float, default=0.05)
+    args = parser.parse_args()
+    server, url = start(args.port, args.http2, args.delay)
+    print(f"Fake upstream ({'h2c' if args.http2 else 'HTTP/1.1'}) on {url}/api/chat")
+    try:
+        while True:
+            time.sleep(5)
+            print(json.dumps(server.counters.snapshot()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,64 @@
 #!/usr/bin/env python
-"""Run the Chat Website API Wrapper Server"""
+"""
+Run the Chat Website API Wrapper Server
+
+    python run.py                  single process (development)
+    python run.py --production     one supervised worker per core (see app/supervisor.py)
+"""
+import argparse
 import os
 import sys
 import uvicorn
 from pathlib import Path
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
 
 # Add project root to path
 sys.path.insert(0, str(Path(__file__).parent))
 
+# Loads .env once for this process
+from app.config import settings
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat Website API Wrapper")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        default=os.getenv("RUN_MODE", "").lower() == "production",
+        help="multi-worker mode (also RUN_MODE=production)"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default WEB_CONCURRENCY or one per core)")
+    args = parser.parse_args()
+    
     # Read from environment or use defaults
-    use_selenium = os.getenv("USE_SELENIUM", "false").lower() == "true"
+    backend = settings.chat_backend
     host = os.getenv("HOST", "127.0.0.1")
     port = int(os.getenv("PORT", "8000"))
-    chat_url = os.getenv("CHAT_WEBSITE_URL", "https://example-chat.com")
+    chat_url = settings.chat_website_url
     
     print("=" * 60)
     print("🚀 Chat Website API Wrapper")
     print("=" * 60)
     print(f"Target: {chat_url}")
-    print(f"Mode: {'Selenium (browser automation)' if use_selenium else 'HTTP (reverse-engineered)'}")
+    print(f"Mode: {backend}")
     print(f"Host: {host}")
     print(f"Port: {port}")
     print(f"OpenAPI Docs: http://{host}:{port}/docs")
-    print("=" * 60)
-    print()
     
-    uvicorn.run(
-        "app.main:app",
-        host=host,
-        port=port,
-        reload=False,
-        log_level="info"
-    )
+    if args.production:
+        from app.supervisor import Supervisor
+        supervisor = Supervisor.from_env(host, port, args.workers)
+        print(f"Production: {supervisor.describe()}")
+        if supervisor.workers > 1 and backend in ("selenium", "hybrid", "auto"):
+            print(f"⚠️  Each worker launches its own browsers in {backend} mode")
+        print("=" * 60)
+        print()
+        supervisor.run()
+    else:
+        print("=" * 60)
+        print()
+        uvicorn.run(
+            "app.main:app",
+            host=host,
+            port=port,
+            reload=False,
+            log_level="info"
+        )
@@ -0,0 +1,84 @@
+"""Multi-turn conversations through /v1/chat/completions, with a fake backend client"""
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.history import History
+
+
+class FakeClient:
+    """Records how many messages each turn would send upstream"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.messages_history = History()
+        self.created_at = self.last_used = time.time()
+        self.sent = []
+
+    def get_conversation_history(self) -> History:
+        return self.messages_history
+
+    def set_history(self, history: History):
+        self.messages_history = history
+
+    def send_message(self, user_message, timeout=None, cancel=None, on_delta=None):
+        history = self.messages_history.append("user", user_message)
+        self.sent.append(len(history))
+        reply = f"reply to {user_message}"
+        self.messages_history = history.append("assistant", reply)
+        return {"role": "assistant", "content": reply}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    clients = []
+
+    def create(backend, conversation_id=None, upstream=None):
+        client = FakeClient(upstream.url if upstream else "")
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(main, "_create_backend_client", create)
+    with TestClient(main.app) as test_client:
+        yield test_client, clients
+    for conversation_id in list(main.conversation_clients):
+        main.conversation_clients.pop(conversation_id, None)
+
+
+def _chat(test_client, messages):
+    response = test_client.post("/v1/chat/completions", json={"model": "gpt-4", "messages": messages})
+    assert response.status_code == 200, response.text
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def test_conversation_id_in_system_prompt_continues_stored_history(api):
+    test_client, clients = api
+    system = {"role": "system", "content": "conversation_id: convention-test"}
+    for turn in range(3):
+        _chat(test_client, [system, {"role": "user", "content": f"turn {turn}"}])
+
+    client = clients[0]
+    assert client.sent == [1, 3, 5]
+    history = test_client.get("/conversations/convention-test").json()
+    assert history["total"] == 6
+    assert [m["content"] for m in history["messages"][::2]] == ["turn 0", "turn 1", "turn 2"]
+
+
+def test_full_message_list_rewinds_edited_turns(api):
+    test_client, clients = api
+    system = {"role": "system", "content": "conversation_id: rewind-test"}
+    first = _chat(test_client, [system, {"role": "user", "content": "one"}])
+    _chat(test_client, [system, {"role": "user", "content": "one"}, {"role": "assistant", "content": first},
+                        {"role": "user", "content": "two"}])
+    # The client edits its first message: the conversation branches from there
+    _chat(test_client, [system, {"role": "user", "content": "uno"}, {"role": "assistant", "content": first},
+                        {"role": "user", "content": "dos"}])
+
+    assert clients[0].sent == [1, 3, 3]
+    history = test_client.get("/conversations/rewind-test").json()
+    assert [m["content"] for m in history["messages"]] == ["uno", first, "dos", "reply to dos"]